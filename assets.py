@@ -0,0 +1,203 @@
+import functools
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from PIL import Image
+
+from render import ImageInput
+
+# Идентификатор изображения - SHA-256 его содержимого
+ASSET_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def close_mapping(buffer):
+    try:
+        buffer.close()
+    except BufferError:
+        # Изображение еще используется сборкой: mmap и дескриптор закроются, когда его отпустят
+        pass
+
+
+class AssetStore:
+    """Хранилище загруженных один раз изображений.
+
+    Файлы лежат на диске под именем, равным хешу содержимого, поэтому их
+    видят все процессы uvicorn, а повторная загрузка того же файла ничего
+    не меняет. Уменьшенные обложки хранятся в кеше обложек.
+
+    Фоны для каждого подходящего разрешения сохраняются рядом в виде сырых
+    RGBA-пикселей (variants/<id>_<ширина>x<высота>.rgba) и отображаются в
+    память через mmap: сборка с таким фоном не декодирует и не масштабирует
+    его, а страницы файла в кеше ОС общие для всех процессов.
+
+    Каждое отображение держит открытый дескриптор файла, поэтому открытыми
+    остаются только max_mapped последних использованных; остальные
+    закрываются при вытеснении (или, если вытесненный фон еще собирается,
+    когда сборка его отпустит).
+
+    После записи периодически запускается очистка, как в OutputStore:
+    удаляются изображения, которые не загружались и не использовались
+    дольше max_age секунд, затем самые давние, пока папка вместе с
+    вариантами фонов больше max_bytes. Варианты удаляются вместе с
+    исходным файлом.
+    """
+
+    def __init__(self, directory, max_age, max_bytes, janitor_interval, max_mapped=64):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.janitor_interval = janitor_interval
+        self.max_mapped = max_mapped
+        # (id, ширина, высота) -> (изображение, mmap)
+        self._mapped = OrderedDict()
+        self._mapped_lock = threading.Lock()
+        self._cleanup_lock = threading.Lock()
+        self._last_cleanup = 0.0
+
+    def path(self, asset_id):
+        return os.path.join(self.directory, asset_id)
+
+    def variant_path(self, asset_id, width, height):
+        return os.path.join(self.directory, "variants", f"{asset_id}_{width}x{height}.rgba")
+
+    def _write(self, path, write):
+        # Пишем во временный файл и переименовываем, чтобы не отдать недописанный файл
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as out:
+            write(out)
+        os.replace(tmp_path, path)
+
+    def _touch(self, path):
+        """Отмечает изображение как использованное; False, если файла нет."""
+        try:
+            if time.time() - os.stat(path).st_mtime > self.janitor_interval:
+                os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def save(self, asset_id, f):
+        path = self.path(asset_id)
+        if self._touch(path):
+            return
+        f.seek(0)
+        self._write(path, lambda out: shutil.copyfileobj(f, out))
+        self.maybe_cleanup()
+
+    def save_background(self, asset_id, image):
+        """Сохраняет фон, уже приведенный к размеру холста."""
+        path = self.variant_path(asset_id, *image.size)
+        if not os.path.exists(path):
+            self._write(path, lambda out: out.write(image.convert("RGBA").tobytes()))
+            self.maybe_cleanup()
+
+    def maybe_cleanup(self):
+        now = time.monotonic()
+        with self._cleanup_lock:
+            if now - self._last_cleanup < self.janitor_interval:
+                return
+            self._last_cleanup = now
+        self.cleanup()
+
+    def cleanup(self):
+        """Удаляет устаревшие изображения вместе с вариантами и возвращает количество удаленных файлов."""
+        # id изображения (или путь для посторонних и временных файлов) -> [время использования, объем, пути]
+        groups = {}
+        for directory in (self.directory, os.path.join(self.directory, "variants")):
+            try:
+                entries = [entry for entry in os.scandir(directory) if entry.is_file()]
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                # Вариант называется <id>_<ширина>x<высота>.rgba и удаляется вместе с исходным файлом
+                asset_id = entry.name.split("_", 1)[0]
+                key = asset_id if ASSET_ID_PATTERN.match(asset_id) and not entry.name.endswith(".tmp") \
+                    else entry.path
+                group = groups.setdefault(key, [0.0, 0, []])
+                group[0] = max(group[0], stat.st_mtime)
+                group[1] += stat.st_size
+                group[2].append(entry.path)
+        # Сначала самые давно использованные
+        ordered = sorted(groups.items(), key=lambda item: item[1][0])
+
+        removed = 0
+        removed_ids = set()
+        deadline = time.time() - self.max_age
+        total = sum(size for _, (_, size, _) in ordered)
+        for key, (mtime, size, paths) in ordered:
+            if mtime >= deadline and total <= self.max_bytes:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                removed += 1
+            total -= size
+            removed_ids.add(key)
+
+        # Отображения удаленных вариантов держат место на диске, пока открыты
+        with self._mapped_lock:
+            evicted = [self._mapped.pop(key)[1] for key in list(self._mapped) if key[0] in removed_ids]
+        for buffer in evicted:
+            close_mapping(buffer)
+        return removed
+
+    def load_background(self, asset_id, width, height):
+        """Подготовленный фон размера width x height из mmap или None, если его нет.
+
+        Изображение только для чтения и не занимает память процесса сверх
+        страниц файла; отображение переиспользуется, пока не вытеснено.
+        """
+        key = (asset_id, width, height)
+        with self._mapped_lock:
+            entry = self._mapped.get(key)
+            if entry is not None:
+                self._mapped.move_to_end(key)
+                return entry[0]
+        try:
+            with open(self.variant_path(asset_id, width, height), "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # ValueError - пустой файл
+            return None
+        if len(buffer) != width * height * 4:
+            buffer.close()
+            return None
+        image = Image.frombuffer("RGBA", (width, height), buffer, "raw", "RGBA", 0, 1)
+        with self._mapped_lock:
+            entry = self._mapped.get(key)
+            if entry is None:
+                entry = self._mapped[key] = (image, buffer)
+            self._mapped.move_to_end(key)
+            # Ссылки на вытесненные изображения не сохраняем, только их mmap
+            evicted = []
+            while len(self._mapped) > self.max_mapped:
+                evicted.append(self._mapped.popitem(last=False)[1][1])
+        if entry[0] is not image:
+            # Другой поток успел отобразить тот же файл раньше
+            image = None
+            evicted.append(buffer)
+        for evicted_buffer in evicted:
+            close_mapping(evicted_buffer)
+        return entry[0]
+
+    def get(self, asset_id):
+        """ImageInput для сохраненного изображения или None, если его нет."""
+        if not asset_id or not ASSET_ID_PATTERN.match(asset_id):
+            return None
+        path = self.path(asset_id)
+        if not self._touch(path):
+            return None
+        return ImageInput.from_path(asset_id, path, functools.partial(self.load_background, asset_id))
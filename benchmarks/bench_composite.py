@@ -0,0 +1,94 @@
+"""Сравнение способов наложения обложек: цикл paste с маской, один общий слой и compose_shelf.
+
+Замеряется только размещение обложек на уже подготовленном фоне, без
+декодирования и кодирования. Обложки бывают непрозрачными (обычный случай
+для JPEG и PNG без альфа-канала) и полупрозрачными.
+
+    python benchmarks/bench_composite.py [--repeat 20] [--json results.json]
+"""
+import argparse
+import io
+import time
+
+from common import median_ms, save_report, synthetic_image
+
+from PIL import Image
+
+from layout import compute_layout
+from render import BOOK_HEIGHT, BOOK_WIDTH, compose_shelf
+
+# (холст, число книг): 8 книг - прежний предел формы, 40 - все места на холсте 2560x1440
+CASES = [
+    ((1920, 1080), 8),
+    ((2560, 1440), 8),
+    ((2560, 1440), 40),
+]
+
+
+def paste_loop(background_image, books):
+    """Прежний алгоритм: отдельное смешивание с маской для каждой обложки."""
+    result_image = background_image.copy()
+    for book, position in zip(books, compute_layout(len(books), *result_image.size).positions):
+        result_image.paste(book, position, book)
+    return result_image
+
+
+def single_layer(background_image, books):
+    """Все обложки в одном прозрачном слое, который накладывается одним alpha_composite."""
+    result_image = background_image.copy()
+    layer = Image.new("RGBA", result_image.size, (0, 0, 0, 0))
+    for book, position in zip(books, compute_layout(len(books), *result_image.size).positions):
+        layer.paste(book, position)
+    result_image.alpha_composite(layer)
+    return result_image
+
+
+def layout_compose(background_image, books):
+    return compose_shelf(background_image, books, compute_layout(len(books), *background_image.size))
+
+
+VARIANTS = {"paste_loop": paste_loop, "single_layer": single_layer, "compose_shelf": layout_compose}
+
+
+def synthetic_covers(count, alpha):
+    covers = []
+    for index in range(count):
+        cover = Image.open(io.BytesIO(synthetic_image((BOOK_WIDTH, BOOK_HEIGHT), "PNG", seed=index)))
+        cover.putalpha(alpha)
+        covers.append(cover)
+    return covers
+
+
+def timings(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", help="файл для сохранения результатов")
+    args = parser.parse_args()
+
+    report = []
+    print(f"{'canvas':10} {'books':>5} {'covers':12} {'variant':14} {'median, ms':>11}")
+    for (width, height), count in CASES:
+        background = Image.new("RGBA", (width, height), (250, 240, 220, 255))
+        for covers_kind, alpha in (("opaque", 255), ("translucent", 200)):
+            books = synthetic_covers(count, alpha)
+            for variant, compose in VARIANTS.items():
+                result = median_ms(timings(lambda: compose(background, books), args.repeat))
+                report.append({"canvas": f"{width}x{height}", "books": count, "covers": covers_kind,
+                               "variant": variant, "median_ms": result})
+                print(f"{width}x{height:<5} {count:5} {covers_kind:12} {variant:14} {result:11.2f}")
+
+    if args.json:
+        save_report(args.json, "composite", report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Сравнение полного декодирования с декодированием в уменьшенном масштабе.
+
+Для каждого входного изображения замеряются задержка (медиана по нескольким
+повторам) и прирост пикового RSS процесса. Каждый вариант запускается в
+отдельном процессе, иначе пик памяти первого варианта скрыл бы второй.
+
+    python benchmarks/bench_decode.py [--repeat 5] [--json results.json]
+"""
+import argparse
+import io
+import multiprocessing
+import resource
+import time
+
+from common import median_ms, save_report, synthetic_image
+
+from PIL import Image
+
+from render import BOOK_HEIGHT, BOOK_WIDTH, decode_for_size, open_image
+
+# (название, формат, размер исходника, целевой размер)
+CASES = [
+    ("cover_jpeg_3000x4500", "JPEG", (3000, 4500), (BOOK_WIDTH, BOOK_HEIGHT)),
+    ("cover_png_3000x4500", "PNG", (3000, 4500), (BOOK_WIDTH, BOOK_HEIGHT)),
+    ("background_jpeg_2944x1656", "JPEG", (2944, 1656), (2560, 1440)),
+    ("background_png_2944x1656", "PNG", (2944, 1656), (2560, 1440)),
+]
+
+
+def full_decode(data, target_size):
+    return Image.open(io.BytesIO(data)).convert("RGBA").resize(target_size)
+
+
+def scaled_decode(data, target_size):
+    return decode_for_size(open_image(io.BytesIO(data)), *target_size).resize(target_size)
+
+
+VARIANTS = {"full": full_decode, "draft": scaled_decode}
+
+
+def max_rss_bytes():
+    # В Linux ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(variant, data, target_size, repeat, results):
+    decode = VARIANTS[variant]
+    rss_before = max_rss_bytes()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        decode(data, target_size)
+        timings.append(time.perf_counter() - started)
+    results.put({
+        "median_ms": median_ms(timings),
+        "peak_rss_delta_mb": (max_rss_bytes() - rss_before) / 2 ** 20,
+    })
+
+
+def run_isolated(variant, data, target_size, repeat):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(variant, data, target_size, repeat, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="файл для сохранения результатов")
+    args = parser.parse_args()
+
+    report = []
+    print(f"{'case':28} {'variant':8} {'median, ms':>11} {'peak RSS +MB':>13}")
+    for name, fmt, size, target_size in CASES:
+        data = synthetic_image(size, fmt)
+        for variant in VARIANTS:
+            result = run_isolated(variant, data, target_size, args.repeat)
+            report.append({"case": name, "variant": variant, **result})
+            print(f"{name:28} {variant:8} {result['median_ms']:11.1f} {result['peak_rss_delta_mb']:13.1f}")
+
+    if args.json:
+        save_report(args.json, "decode", report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Время этапов сборки (validate, decode, resize, composite, encode) для всех разрешений и числа книг.
+
+Замеряется тот же путь, что и у /upload/: render_image без кеша обложек,
+а длительность этапов берется из его собственных замеров (render.stage).
+Если книги не помещаются на холст, включается auto_scale.
+
+    python benchmarks/bench_stages.py [--repeat 3] [--counts 1,2,4,8,24,100]
+                                      [--profiles png,jpeg] [--json results.json]
+"""
+import argparse
+
+from common import median_ms, save_report, synthetic_image
+
+from encoders import make_profile
+from layout import make_layout_options, page_capacity
+from render import RESOLUTIONS, ImageInput, render_image
+
+STAGES = ("validate", "decode", "resize", "composite", "encode")
+
+# Исходные обложки крупнее книги на полке, как у сканов и фотографий
+COVER_SIZE = (600, 900)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--counts", default="1,2,4,8,24,100", help="число книг через запятую")
+    parser.add_argument("--resolutions", default=",".join(RESOLUTIONS))
+    parser.add_argument("--profiles", default="png", help="форматы вывода через запятую")
+    parser.add_argument("--format", default="JPEG", help="формат синтетических входных изображений")
+    parser.add_argument("--json", help="файл для сохранения результатов")
+    args = parser.parse_args()
+
+    counts = [int(count) for count in args.counts.split(",")]
+    covers = [ImageInput.from_bytes(synthetic_image(COVER_SIZE, args.format, seed=index))
+              for index in range(max(counts))]
+
+    report = []
+    print(f"{'canvas':10} {'books':>5} {'profile':8} " + " ".join(f"{stage:>9}" for stage in STAGES)
+          + f" {'total, ms':>10}")
+    for resolution in args.resolutions.split(","):
+        width, height = RESOLUTIONS[resolution]
+        background = ImageInput.from_bytes(synthetic_image((width, height), args.format, seed=-1))
+        for count in counts:
+            layout = make_layout_options(auto_scale=count > page_capacity(width, height))
+            for profile_name in args.profiles.split(","):
+                profile = make_profile(profile_name)
+                samples = {stage: [] for stage in STAGES}
+                for _ in range(args.repeat):
+                    _, timings = render_image(background, covers[:count], width, height, profile,
+                                              layout_options=layout)
+                    for stage in STAGES:
+                        samples[stage].append(timings.get(stage, 0.0))
+                result = {stage: median_ms(values) for stage, values in samples.items()}
+                total = sum(result.values())
+                report.append({"canvas": resolution, "books": count, "profile": profile_name,
+                               "auto_scale": layout.auto_scale, **{f"{stage}_ms": value
+                                                                   for stage, value in result.items()},
+                               "total_ms": total})
+                print(f"{resolution:10} {count:5} {profile_name:8} "
+                      + " ".join(f"{result[stage]:9.1f}" for stage in STAGES) + f" {total:10.1f}")
+
+    if args.json:
+        save_report(args.json, "stages", report)
+
+
+if __name__ == "__main__":
+    main()
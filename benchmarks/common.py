@@ -0,0 +1,58 @@
+"""Общее для бенчмарков: воспроизводимые синтетические изображения, статистика и отчеты в JSON."""
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PIL
+from PIL import Image
+
+
+def synthetic_image(size, fmt, seed=0):
+    """Изображение из случайного шума с фиксированным seed: одинаковое от запуска к запуску.
+
+    Шум сжимается плохо, как и настоящие фотографии обложек, поэтому это
+    худший для декодирования и кодирования случай.
+    """
+    rng = random.Random(seed)
+    width, height = size
+    channels = [Image.frombytes("L", size, rng.randbytes(width * height)) for _ in range(3)]
+    buffer = io.BytesIO()
+    Image.merge("RGB", channels).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def percentiles(samples):
+    """p50, p95 и p99 в миллисекундах по длительностям в секундах."""
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {"p50_ms": at(0.50), "p95_ms": at(0.95), "p99_ms": at(0.99)}
+
+
+def median_ms(samples):
+    return statistics.median(samples) * 1000
+
+
+def environment():
+    """Условия запуска, чтобы результаты разных машин не сравнивали вслепую."""
+    return {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def save_report(path, benchmark, results):
+    with open(path, "w") as f:
+        json.dump({"benchmark": benchmark, "environment": environment(), "results": results}, f, indent=2)
@@ -0,0 +1,52 @@
+"""Сравнение двух отчетов бенчмарка (--json) одного вида: изменение каждого числового показателя.
+
+Строки сопоставляются по нечисловым полям и по числу книг, одновременных
+запросов и т. п., то есть по всему, что не заканчивается на _ms, _mb и _second.
+
+    python benchmarks/compare.py before.json after.json
+"""
+import argparse
+import json
+
+MEASURE_SUFFIXES = ("_ms", "_mb", "_second")
+
+
+def is_measure(name, value):
+    return isinstance(value, (int, float)) and name.endswith(MEASURE_SUFFIXES)
+
+
+def case_key(result):
+    return tuple(sorted((name, json.dumps(value)) for name, value in result.items()
+                        if not is_measure(name, value) and name != "statuses"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if before["benchmark"] != after["benchmark"]:
+        parser.error(f"разные бенчмарки: {before['benchmark']} и {after['benchmark']}")
+
+    baseline = {case_key(result): result for result in before["results"]}
+    for result in after["results"]:
+        old = baseline.get(case_key(result))
+        case = ", ".join(f"{name}={json.loads(value)}" for name, value in case_key(result))
+        if old is None:
+            print(f"{case}: нет в {args.before}")
+            continue
+        print(case)
+        for name, value in result.items():
+            if not is_measure(name, value) or not isinstance(old.get(name), (int, float)):
+                continue
+            change = (value - old[name]) / old[name] * 100 if old[name] else 0.0
+            print(f"    {name:24} {old[name]:10.1f} -> {value:10.1f}  {change:+6.1f}%")
+
+
+if __name__ == "__main__":
+    main()
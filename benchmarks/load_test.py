@@ -0,0 +1,157 @@
+"""Нагрузочный тест /upload/: несколько одновременных клиентов против локального uvicorn.
+
+Сервер запускается в отдельном процессе. Для каждого сценария (разрешение,
+число книг, число одновременных запросов) выводятся p50/p95/p99 и запросы в
+секунду по успешным ответам, коды всех ответов и пиковый RSS сервера с
+начала запуска. Режим cold отключает кеши готовых изображений и обложек, и
+каждый запрос собирается заново; в режиме warm повторные запросы отдаются
+из кеша.
+
+    python benchmarks/load_test.py [--requests 200] [--concurrency 1,4,16]
+                                   [--resolutions 1920x1080] [--books 8]
+                                   [--mode cold] [--workers 1] [--json results.json]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+from common import percentiles, save_report, synthetic_image
+
+from render import RESOLUTIONS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COVER_SIZE = (600, 900)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, workers, mode):
+    env = dict(os.environ)
+    if mode == "cold":
+        env["BOOKSHELF_RENDER_CACHE_MAX_BYTES"] = "0"
+        env["BOOKSHELF_TILE_CACHE_MAX_BYTES"] = "0"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=ROOT, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            # /ready отвечает 200 после прогрева, так что замер не включает запуск
+            if httpx.get(f"http://127.0.0.1:{port}/ready", timeout=1).status_code == 200:
+                return server
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Сервер не запустился за 30 секунд")
+
+
+def peak_rss_bytes(pid):
+    """Пиковый RSS процесса и его дочерних процессов (воркеров uvicorn). Только Linux."""
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+        for process_id in pids:
+            with open(f"/proc/{process_id}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return total
+
+
+async def run_scenario(base_url, files, data, total, concurrency):
+    latencies = []
+    statuses = Counter()
+    remaining = total
+
+    async def client_loop(client):
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            response = await client.post(f"{base_url}/upload/", files=files, data=data)
+            statuses[response.status_code] += 1
+            # Быстрые отказы 503 исказили бы задержку, поэтому она считается только по успешным ответам
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, statuses, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="запросов в каждом сценарии")
+    parser.add_argument("--concurrency", default="1,4,16", help="одновременных запросов через запятую")
+    parser.add_argument("--resolutions", default="1920x1080")
+    parser.add_argument("--books", default="8", help="число книг через запятую")
+    parser.add_argument("--mode", choices=("cold", "warm"), default="cold")
+    parser.add_argument("--workers", type=int, default=1, help="процессов uvicorn")
+    parser.add_argument("--json", help="файл для сохранения результатов")
+    args = parser.parse_args()
+
+    book_counts = [int(count) for count in args.books.split(",")]
+    covers = [synthetic_image(COVER_SIZE, "JPEG", seed=index) for index in range(max(book_counts))]
+
+    port = free_port()
+    server = start_server(port, args.workers, args.mode)
+    base_url = f"http://127.0.0.1:{port}"
+    report = []
+    try:
+        print(f"{'canvas':10} {'books':>5} {'conc':>4} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>7} "
+              f"{'RSS, MB':>8}  statuses")
+        for resolution in args.resolutions.split(","):
+            background = synthetic_image(RESOLUTIONS[resolution], "JPEG", seed=-1)
+            for count in book_counts:
+                files = [("background", ("background.jpg", background, "image/jpeg"))]
+                files += [("books", (f"book{index}.jpg", cover, "image/jpeg"))
+                          for index, cover in enumerate(covers[:count])]
+                data = {"resolution": resolution, "auto_scale": "true"}
+                for concurrency in [int(value) for value in args.concurrency.split(",")]:
+                    latencies, statuses, elapsed = asyncio.run(
+                        run_scenario(base_url, files, data, args.requests, concurrency))
+                    if not latencies:
+                        print(f"{resolution:10} {count:5} {concurrency:4} нет успешных ответов: {dict(statuses)}")
+                        continue
+                    rss = peak_rss_bytes(server.pid)
+                    result = {"canvas": resolution, "books": count, "concurrency": concurrency,
+                              "mode": args.mode, "workers": args.workers, **percentiles(latencies),
+                              "requests_per_second": len(latencies) / elapsed,
+                              "statuses": {str(code): number for code, number in sorted(statuses.items())},
+                              "peak_rss_mb": rss / 2 ** 20 if rss is not None else None}
+                    report.append(result)
+                    rss_text = f"{result['peak_rss_mb']:8.1f}" if rss is not None else f"{'-':>8}"
+                    print(f"{resolution:10} {count:5} {concurrency:4} {result['p50_ms']:8.1f} "
+                          f"{result['p95_ms']:8.1f} {result['p99_ms']:8.1f} "
+                          f"{result['requests_per_second']:7.1f} {rss_text}  {result['statuses']}")
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        save_report(args.json, "load", report)
+
+
+if __name__ == "__main__":
+    main()
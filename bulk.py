@@ -0,0 +1,221 @@
+"""Сборка полок из папки с обложками без сервера.
+
+Все обложки из папки (включая вложенные) делятся на полки по --per-shelf
+книг (по умолчанию - сколько помещается на холст), полки собираются тем же
+кодом, что и /upload/, в нескольких процессах. Про каждую полку в манифест
+(JSON Lines) пишется строка: файл результата и для каждой обложки ее путь,
+SHA-256, размер, формат, место на полке или ошибка.
+
+Повторный запуск пропускает полки, которые уже собраны: ключ полки - хеш
+фона, обложек и параметров сборки, как у кеша сервера. Обложки идут по
+времени изменения, поэтому новые файлы попадают в последние полки, и
+собираются только они.
+
+    python bulk.py covers/ background.jpg shelves/ [--resolution 1920x1080]
+                   [--per-shelf 24] [--auto-scale] [--format png] [--workers 4]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cache import LRUCache
+from config import TILE_CACHE_MAX_BYTES
+from encoders import make_profile
+from layout import LayoutOptions, compute_layout, make_layout_options, paginate
+from render import (ImageInput, RenderError, check_book_ratio, check_inputs, image_nbytes, load_book,
+                    open_image, parse_resolution, render_cache_key, render_image)
+from upload_limits import file_digest
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
+MANIFEST_NAME = "manifest.jsonl"
+
+# Кеш уменьшенных изображений в каждом процессе: фон у всех полок общий
+_tile_cache = None
+
+
+def scan_covers(directory, order="mtime", exclude=None):
+    """Пути обложек относительно directory: по времени изменения или по имени.
+
+    Папка exclude (например, папка с результатами внутри папки обложек) пропускается.
+    """
+    covers = []
+    excluded = os.path.realpath(exclude) if exclude else None
+    for root, dirnames, filenames in os.walk(directory):
+        dirnames[:] = [name for name in dirnames if os.path.realpath(os.path.join(root, name)) != excluded]
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, filename)
+                covers.append((os.path.getmtime(path) if order == "mtime" else 0, os.path.relpath(path, directory)))
+    return [path for _, path in sorted(covers)]
+
+
+def sha256_file(path):
+    with open(path, "rb") as f:
+        return file_digest(f)
+
+
+def read_manifest(path):
+    """Уже собранные полки: ключ -> запись манифеста (последняя, если ключ встречается несколько раз)."""
+    done = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    done[record["shelf"]] = record
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def cover_metadata(source, relative_path):
+    """Размер и формат обложки по заголовку или ошибка, из-за которой обложка пропущена."""
+    metadata = {"file": relative_path, "sha256": source.digest}
+    try:
+        with source.open() as f:
+            image = open_image(f)
+            metadata.update(width=image.width, height=image.height, format=image.format)
+            check_book_ratio(image.width, image.height)
+    except RenderError as e:
+        metadata["error"] = str(e)
+    return metadata
+
+
+def render_shelf(task):
+    """Собирает одну полку в процессе пула и возвращает запись для манифеста."""
+    global _tile_cache
+    if _tile_cache is None:
+        _tile_cache = LRUCache(TILE_CACHE_MAX_BYTES, sizeof=image_nbytes)
+
+    background = ImageInput.from_path(task["background_sha256"], task["background"])
+    covers = [(ImageInput.from_path(digest, os.path.join(task["covers_dir"], relative_path)), relative_path)
+              for relative_path, digest in task["covers"]]
+    books = [cover_metadata(source, relative_path) for source, relative_path in covers]
+
+    width, height = task["size"]
+    layout = LayoutOptions(*task["layout"])
+    # Заголовок может быть целым, а сам файл - обрезанным: такие обложки находим, декодируя каждую
+    # отдельно, чтобы одна испорченная обложка не останавливала всю полку. Декодированные
+    # обложки остаются в кеше, и сборка их уже не декодирует
+    shelf_layout = compute_layout(sum("error" not in metadata for metadata in books), width, height, layout)
+    for (source, _), metadata in zip(covers, books):
+        if "error" not in metadata:
+            try:
+                load_book(source, _tile_cache, shelf_layout.book_width, shelf_layout.book_height)
+            except RenderError as e:
+                metadata["error"] = str(e)
+    sources = [source for (source, _), metadata in zip(covers, books) if "error" not in metadata]
+
+    profile = make_profile(task["format"])
+    record = {"shelf": task["shelf"], "output": None, "resolution": f"{width}x{height}", "books": books}
+    if sources:
+        try:
+            image_data, _ = render_image(background, sources, width, height, profile, _tile_cache, layout)
+        except RenderError as e:
+            # Например, испорченный фон: полка записывается в манифест с ошибкой, остальные собираются
+            record["error"] = str(e)
+            record["rendered_at"] = time.time()
+            return record
+        output_path = os.path.join(task["output_dir"], f"shelf_{task['shelf'][:16]}.{profile.extension}")
+        # Пишем во временный файл и переименовываем, чтобы прерванный запуск не оставил половину файла
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(image_data)
+        os.replace(tmp_path, output_path)
+        record["output"] = os.path.basename(output_path)
+
+        positions = iter(compute_layout(len(sources), width, height, layout).positions)
+        for metadata in books:
+            if "error" not in metadata:
+                metadata["position"] = next(positions, None)
+    record["rendered_at"] = time.time()
+    return record
+
+
+def build_shelves(covers_dir, background_path, output_dir, resolution="1920x1080", per_shelf=None,
+                  layout=None, output_format="png", workers=None, order="mtime", log=print):
+    """Собирает недостающие полки. Возвращает счетчики собранных и пропущенных полок, ошибочных обложек и полок."""
+    width, height = parse_resolution(resolution)
+    layout = layout or make_layout_options()
+    profile = make_profile(output_format)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+
+    background = ImageInput.from_path(sha256_file(background_path), background_path)
+    # Неподходящий фон испортил бы все полки, поэтому проверяем его сразу
+    check_inputs(background, [], width, height)
+
+    paths = scan_covers(covers_dir, order, exclude=output_dir)
+    shelves = paginate(len(paths), width, height, layout, per_shelf)
+    done = read_manifest(manifest_path)
+    stats = {"rendered": 0, "skipped": 0, "cover_errors": 0, "shelf_errors": 0}
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        digests = list(pool.map(sha256_file, [os.path.join(covers_dir, path) for path in paths], chunksize=64))
+        tasks = []
+        for start, stop in shelves:
+            covers = list(zip(paths[start:stop], digests[start:stop]))
+            shelf = render_cache_key([background.digest] + [digest for _, digest in covers],
+                                     width, height, profile, layout)
+            previous = done.get(shelf)
+            if previous is not None and (previous["output"] is None
+                                         or os.path.exists(os.path.join(output_dir, previous["output"]))):
+                stats["skipped"] += 1
+                continue
+            tasks.append({"shelf": shelf, "background": background_path, "background_sha256": background.digest,
+                          "covers_dir": covers_dir, "covers": covers, "size": (width, height),
+                          "layout": list(layout), "format": output_format, "output_dir": output_dir})
+
+        log(f"Обложек: {len(paths)}, полок: {len(shelves)}, уже собрано: {stats['skipped']}, "
+            f"собрать: {len(tasks)}")
+        with open(manifest_path, "a") as manifest:
+            for future in as_completed([pool.submit(render_shelf, task) for task in tasks]):
+                record = future.result()
+                manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+                # Строка сразу попадает на диск: после прерывания собранные полки не повторяются
+                manifest.flush()
+                stats["rendered"] += 1
+                errors = [book for book in record["books"] if "error" in book]
+                stats["cover_errors"] += len(errors)
+                for book in errors:
+                    log(f"{book['file']}: {book['error']}")
+                if "error" in record:
+                    stats["shelf_errors"] += 1
+                    log(f"Полка {record['shelf'][:16]}: {record['error']}")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("covers", help="папка с обложками")
+    parser.add_argument("background", help="файл фона")
+    parser.add_argument("output", help="папка для полок и манифеста")
+    parser.add_argument("--resolution", default="1920x1080")
+    parser.add_argument("--per-shelf", type=int, help="книг на полке")
+    parser.add_argument("--auto-scale", action="store_true", help="уменьшать обложки, чтобы поместились все книги")
+    parser.add_argument("--margin", type=int, default=0)
+    parser.add_argument("--spacing", type=int, default=0)
+    parser.add_argument("--format", default="png", help="png, png-fast, jpeg, webp или fast")
+    parser.add_argument("--workers", type=int, help="число процессов (по умолчанию - по числу ядер)")
+    parser.add_argument("--order", choices=("mtime", "name"), default="mtime",
+                        help="порядок обложек: по времени изменения или по имени")
+    args = parser.parse_args(argv)
+
+    try:
+        layout = make_layout_options(args.margin, args.spacing, args.auto_scale)
+        stats = build_shelves(args.covers, args.background, args.output, args.resolution, args.per_shelf,
+                              layout, args.format, args.workers, args.order)
+    except RenderError as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return 1
+    print(f"Собрано полок: {stats['rendered']}, пропущено: {stats['skipped']}, "
+          f"обложек с ошибками: {stats['cover_errors']}, полок с ошибками: {stats['shelf_errors']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+import os
+
+# Настройки сервиса читаются из переменных окружения с префиксом BOOKSHELF_
+
+
+def _env_int(name, default):
+    return int(os.environ.get(f"BOOKSHELF_{name}", default))
+
+
+def _env_float(name, default):
+    return float(os.environ.get(f"BOOKSHELF_{name}", default))
+
+
+def _env_bool(name, default):
+    return os.environ.get(f"BOOKSHELF_{name}", str(int(default))).lower() in ("1", "true", "yes")
+
+
+# Пул потоков для рендеринга: число потоков и длина очереди ожидающих задач
+RENDER_WORKERS = _env_int("RENDER_WORKERS", os.cpu_count() or 1)
+RENDER_QUEUE_SIZE = _env_int("RENDER_QUEUE_SIZE", RENDER_WORKERS * 2)
+
+# Через сколько секунд клиенту стоит повторить запрос, если пул переполнен
+RETRY_AFTER_SECONDS = _env_int("RETRY_AFTER_SECONDS", 1)
+
+# Сохранение готовых изображений на диск (по умолчанию выключено)
+PERSIST_OUTPUT = _env_bool("PERSIST_OUTPUT", False)
+OUTPUT_DIR = os.environ.get("BOOKSHELF_OUTPUT_DIR", "generated")
+# Ограничения для папки с готовыми изображениями: возраст файла и общий объем
+OUTPUT_MAX_AGE_SECONDS = _env_int("OUTPUT_MAX_AGE_SECONDS", 24 * 60 * 60)
+OUTPUT_MAX_BYTES = _env_int("OUTPUT_MAX_BYTES", 512 * 1024 * 1024)
+# Как часто запускать очистку папки
+OUTPUT_JANITOR_INTERVAL_SECONDS = _env_int("OUTPUT_JANITOR_INTERVAL_SECONDS", 60)
+
+# Кеш готовых изображений в памяти
+RENDER_CACHE_MAX_BYTES = _env_int("RENDER_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+
+# Кеш декодированных и уменьшенных обложек и фонов (объем пикселей в байтах)
+TILE_CACHE_MAX_BYTES = _env_int("TILE_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+
+# Папка для изображений, загруженных один раз через /assets
+ASSET_DIR = os.environ.get("BOOKSHELF_ASSET_DIR", "assets")
+# Сколько подготовленных фонов из /assets держать отображенными в память (у каждого открыт файл)
+ASSET_MAPPED_MAX = _env_int("ASSET_MAPPED_MAX", 64)
+# Ограничения для папки с изображениями из /assets (вместе с вариантами фонов): время с последнего
+# использования и общий объем. Вариант фона 1920x1080 в RGBA занимает около 8 МБ
+ASSET_MAX_AGE_SECONDS = _env_int("ASSET_MAX_AGE_SECONDS", 24 * 60 * 60)
+ASSET_MAX_BYTES = _env_int("ASSET_MAX_BYTES", 1024 * 1024 * 1024)
+# Как часто запускать очистку папки
+ASSET_JANITOR_INTERVAL_SECONDS = _env_int("ASSET_JANITOR_INTERVAL_SECONDS", 60)
+
+# Максимальное число пикселей во входном изображении (защита от «бомб распаковки»)
+MAX_IMAGE_PIXELS = _env_int("MAX_IMAGE_PIXELS", 40_000_000)
+
+# Ограничения на размер загрузки: один файл и весь запрос целиком.
+# Оба проверяются во время чтения запроса: слишком большой файл обрывает загрузку сразу
+MAX_UPLOAD_FILE_BYTES = _env_int("MAX_UPLOAD_FILE_BYTES", 20 * 1024 * 1024)
+MAX_REQUEST_BYTES = _env_int("MAX_REQUEST_BYTES", 100 * 1024 * 1024)
+
+# Очередь фоновых задач сборки: база SQLite и папка с файлами задач
+JOBS_DIR = os.environ.get("BOOKSHELF_JOBS_DIR", "jobs")
+JOBS_DB = os.environ.get("BOOKSHELF_JOBS_DB", os.path.join(JOBS_DIR, "jobs.sqlite3"))
+# Сколько задач берется из очереди одновременно; собираются они в общем пуле сборки
+JOB_WORKERS = _env_int("JOB_WORKERS", RENDER_WORKERS)
+JOB_POLL_INTERVAL_SECONDS = _env_float("JOB_POLL_INTERVAL_SECONDS", 0.2)
+# Задача, которая выполняется дольше, считается брошенной и возвращается в очередь
+JOB_STALE_TIMEOUT_SECONDS = _env_int("JOB_STALE_TIMEOUT_SECONDS", 10 * 60)
+# Сколько хранить завершенные задачи и их результаты
+JOB_MAX_AGE_SECONDS = _env_int("JOB_MAX_AGE_SECONDS", 24 * 60 * 60)
+
+# Максимальное число книг в одном запросе
+MAX_BOOKS = _env_int("MAX_BOOKS", 500)
+
+# Профилирование отдельных запросов (заголовок X-Bookshelf-Profile: 1 или ?debug_profile=1).
+# По умолчанию выключено, тогда заголовок и параметр ничего не меняют
+PROFILING_ENABLED = _env_bool("PROFILING_ENABLED", False)
+PROFILES_DIR = os.environ.get("BOOKSHELF_PROFILES_DIR", "profiles")
+# Сколько строк сохранять в сводке и сколько последних профилей хранить
+PROFILE_TOP_N = _env_int("PROFILE_TOP_N", 25)
+PROFILE_KEEP = _env_int("PROFILE_KEEP", 50)
+
+# Индекс перцептивных хешей обложек: почти одинаковые обложки (другой формат, размер, пересжатие)
+# используют одну уменьшенную копию и один ключ кеша. Файл индекса сохраняется между перезапусками.
+# По умолчанию выключен: хеш 8x8 не видит мелких отличий, и обложки одной серии,
+# отличающиеся только названием, могут объединиться
+COVER_INDEX_ENABLED = _env_bool("COVER_INDEX_ENABLED", False)
+COVER_INDEX_PATH = os.environ.get("BOOKSHELF_COVER_INDEX_PATH", os.path.join("phash", "covers.idx"))
+# Наибольшее расстояние Хэмминга между 64-битными хешами, при котором обложки считаются одинаковыми
+PHASH_MAX_DISTANCE = _env_int("PHASH_MAX_DISTANCE", 2)
+
+# Быстрое превью полки (/upload/preview/, /render/preview/): холст во столько раз меньше, JPEG такого качества
+PREVIEW_SCALE = _env_int("PREVIEW_SCALE", 4)
+PREVIEW_QUALITY = _env_int("PREVIEW_QUALITY", 60)
+
+# Запуск процесса: загружать модули Pillow только для PNG, JPEG и WebP
+# и прогревать сборку синтетической полкой до того, как процесс начнет принимать запросы
+STARTUP_RESTRICT_PLUGINS = _env_bool("STARTUP_RESTRICT_PLUGINS", True)
+STARTUP_PREWARM = _env_bool("STARTUP_PREWARM", True)
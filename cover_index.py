@@ -0,0 +1,267 @@
+import contextlib
+import os
+import struct
+import threading
+from array import array
+
+from PIL import Image
+
+from render import RenderError, check_book_ratio, open_image
+
+# Файл индекса: заголовок с версией формата, затем записи фиксированного размера.
+# Запись: dHash, aHash, средний цвет, флаги, SHA-256 файла, SHA-256 канонической обложки.
+# Каноническая обложка хранится хешем, а не номером записи: номера в общем файле,
+# куда дописывают несколько процессов, в каждом процессе свои
+FILE_HEADER = b"BSCIDX02"
+RECORD = struct.Struct("<QQIB32s32s")
+
+# Флаг записи: обложка не индексируется (прозрачность, неподходящие пропорции, испорченный файл).
+# Запоминается, чтобы не декодировать такую обложку при каждом запросе
+NOT_INDEXED = 1
+
+# Миниатюра, по которой считаются хеши: dHash сравнивает соседние пиксели в строке 9x8
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+
+# Допустимое отличие среднего цвета по каждому каналу: хеши считаются по яркости и цвета не различают
+COLOR_TOLERANCE = 8
+
+
+def band_masks(max_distance):
+    """Делит 64 бита на max_distance + 1 полос (сдвиг, маска).
+
+    Хеши на расстоянии Хэмминга не больше max_distance совпадают хотя бы
+    в одной полосе целиком, поэтому кандидатов достаточно искать по точному
+    совпадению полос, а не перебирать весь индекс.
+    """
+    bands = max_distance + 1
+    bands_bits = [64 // bands + (1 if index < 64 % bands else 0) for index in range(bands)]
+    masks = []
+    shift = 0
+    for bits in bands_bits:
+        masks.append((shift, (1 << bits) - 1))
+        shift += bits
+    return masks
+
+
+def image_hashes(image):
+    """dHash, aHash и средний цвет изображения или None, если в нем есть прозрачность.
+
+    У JPEG декодирование сразу идет в уменьшенном масштабе (draft), поэтому
+    хеш обходится дешевле, чем уменьшение обложки до размера книги.
+    """
+    if image.format == "JPEG":
+        image.draft("RGB", (HASH_WIDTH * 8, HASH_HEIGHT * 8))
+    try:
+        image.load()
+    except OSError:
+        return None
+    if "A" in image.getbands() or "transparency" in image.info:
+        # Полупрозрачные обложки не объединяем: под прозрачными пикселями может быть что угодно
+        rgba = image.convert("RGBA")
+        if rgba.getextrema()[3][0] < 255:
+            return None
+        image = rgba
+    small = image.convert("RGB").resize((HASH_WIDTH, HASH_HEIGHT), Image.BOX)
+
+    gray = small.convert("L").tobytes()
+    dhash = 0
+    for row in range(HASH_HEIGHT):
+        line = gray[row * HASH_WIDTH:(row + 1) * HASH_WIDTH]
+        for column in range(HASH_WIDTH - 1):
+            dhash = (dhash << 1) | (line[column] > line[column + 1])
+
+    square = small.resize((HASH_HEIGHT, HASH_HEIGHT), Image.BOX)
+    pixels = square.convert("L").tobytes()
+    mean = sum(pixels) / len(pixels)
+    ahash = 0
+    for value in pixels:
+        ahash = (ahash << 1) | (value >= mean)
+
+    data = square.tobytes()
+    red, green, blue = (round(sum(data[offset::3]) / len(pixels)) for offset in range(3))
+    return dhash, ahash, (red << 16) | (green << 8) | blue
+
+
+def colors_close(first, second):
+    return all(abs(((first >> shift) & 0xFF) - ((second >> shift) & 0xFF)) <= COLOR_TOLERANCE
+               for shift in (16, 8, 0))
+
+
+class CoverIndex:
+    """Индекс перцептивных хешей обложек для объединения почти одинаковых файлов.
+
+    Одна и та же обложка в другом формате или размере имеет другой SHA-256
+    и без индекса декодируется и уменьшается заново. Индекс сопоставляет
+    каждому SHA-256 каноническую обложку - первую с похожими dHash и aHash
+    (расстояние Хэмминга не больше max_distance) и близким средним цветом, -
+    и сборка использует ее хеш: общую уменьшенную копию в кеше обложек и
+    общий ключ кеша готовых изображений.
+
+    Хеши лежат в array("Q"), поиск идет по полосам хеша (band_masks), так
+    что он не замедляется с ростом индекса до сотен тысяч обложек. Записи
+    дописываются в файл path и читаются при запуске; другие процессы видят
+    новые записи после перезапуска. Обложки, которые не индексируются,
+    тоже записываются, и повторно их файл не открывается.
+    """
+
+    def __init__(self, path, max_distance=2):
+        self.path = path
+        self.max_distance = max_distance
+        self._masks = band_masks(max_distance)
+        self._dhashes = array("Q")
+        self._ahashes = array("Q")
+        self._colors = array("L")
+        self._canonical = array("L")
+        self._digests = bytearray()
+        self._positions = {}
+        self._not_indexed = set()
+        self._bands = [{} for _ in self._masks]
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    def load(self):
+        """Читает файл индекса, если он еще не прочитан (иначе это сделает первый поиск)."""
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        if self._loaded:
+            return
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        if not data.startswith(FILE_HEADER):
+            # Файл другой версии или испорчен: индекс собирается заново
+            data = b""
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+        data = data[len(FILE_HEADER):]
+        # Недописанная последняя запись (процесс упал во время записи) отбрасывается
+        for dhash, ahash, color, flags, digest, canonical in RECORD.iter_unpack(
+                data[:len(data) - len(data) % RECORD.size]):
+            if digest in self._positions or digest in self._not_indexed:
+                # Ту же обложку независимо записали два процесса: действует первая запись
+                continue
+            if flags & NOT_INDEXED:
+                self._not_indexed.add(digest)
+            else:
+                # Каноническая обложка записана раньше дубликата; если ее нет, обложка сама каноническая
+                self._append(dhash, ahash, color, digest, self._positions.get(canonical))
+        self._loaded = True
+
+    def _append(self, dhash, ahash, color, digest, canonical=None):
+        position = len(self._dhashes)
+        if canonical is None:
+            canonical = position
+        self._dhashes.append(dhash)
+        self._ahashes.append(ahash)
+        self._colors.append(color)
+        self._canonical.append(canonical)
+        self._digests += digest
+        self._positions[digest] = position
+        if canonical == position:
+            for table, (shift, mask) in zip(self._bands, self._masks):
+                table.setdefault((dhash >> shift) & mask, []).append(position)
+        return position
+
+    def _write(self, record):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Заголовок пишет тот процесс, который создал файл
+        with contextlib.suppress(FileExistsError):
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            try:
+                os.write(fd, FILE_HEADER)
+            finally:
+                os.close(fd)
+        # Одна запись - один write в режиме O_APPEND, поэтому записи процессов не перемешиваются
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, record)
+        finally:
+            os.close(fd)
+
+    def _digest_at(self, position):
+        return self._digests[position * 32:(position + 1) * 32].hex()
+
+    def _find(self, dhash, ahash, color):
+        seen = set()
+        for table, (shift, mask) in zip(self._bands, self._masks):
+            for position in table.get((dhash >> shift) & mask, ()):
+                if position in seen:
+                    continue
+                seen.add(position)
+                if ((dhash ^ self._dhashes[position]).bit_count() <= self.max_distance
+                        and (ahash ^ self._ahashes[position]).bit_count() <= self.max_distance
+                        and colors_close(color, self._colors[position])):
+                    return position
+        return None
+
+    def canonical_digest(self, source):
+        """SHA-256 канонической обложки для ImageInput или его собственный, если объединять не с чем."""
+        digest = bytes.fromhex(source.digest)
+        with self._lock:
+            self._load()
+            if digest in self._not_indexed:
+                self.skipped += 1
+                return source.digest
+            position = self._positions.get(digest)
+            if position is not None:
+                self.exact_hits += 1
+                return self._digest_at(self._canonical[position])
+
+        try:
+            with source.open() as f:
+                image = open_image(f)
+                # Неподходящую обложку нельзя подменять подходящей: ошибку должна сообщить сборка
+                check_book_ratio(*image.size)
+                hashes = image_hashes(image)
+        except RenderError:
+            hashes = None
+
+        with self._lock:
+            if digest in self._not_indexed:
+                return source.digest
+            position = self._positions.get(digest)
+            if position is not None:
+                return self._digest_at(self._canonical[position])
+            if hashes is None:
+                self.skipped += 1
+                self._not_indexed.add(digest)
+                self._write(RECORD.pack(0, 0, 0, NOT_INDEXED, digest, digest))
+                return source.digest
+            canonical = self._find(*hashes)
+            if canonical is None:
+                self.misses += 1
+            else:
+                self.near_hits += 1
+            position = self._append(*hashes, digest, canonical)
+            canonical_digest = self._digest_at(self._canonical[position])
+            self._write(RECORD.pack(*hashes, 0, digest, bytes.fromhex(canonical_digest)))
+            return canonical_digest
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            entries = len(self._dhashes)
+            canonical = sum(1 for position, value in enumerate(self._canonical) if position == value)
+            lookups = self.exact_hits + self.near_hits + self.misses + self.skipped
+            return {
+                "covers": entries,
+                "canonical": canonical,
+                "duplicates": entries - canonical,
+                "not_indexed": len(self._not_indexed),
+                "lookups": lookups,
+                "exact_hits": self.exact_hits,
+                "near_duplicate_hits": self.near_hits,
+                "misses": self.misses,
+                "skipped": self.skipped,
+                "bytes": (self._dhashes.itemsize + self._ahashes.itemsize + self._colors.itemsize
+                          + self._canonical.itemsize + 32) * entries + 32 * len(self._not_indexed),
+            }
@@ -0,0 +1,87 @@
+from collections import namedtuple
+import io
+
+from errors import RenderError
+
+
+class OutputProfile(namedtuple("OutputProfile", "name format media_type extension options")):
+    """Формат итогового изображения и параметры кодировщика Pillow."""
+
+    @property
+    def cache_tag(self):
+        # Входит в ключ кеша: разные параметры дают разные файлы
+        options = ",".join(f"{key}={value}" for key, value in sorted(self.options.items()))
+        return f"{self.format}:{options}"
+
+
+DEFAULT_PNG_COMPRESS_LEVEL = 6
+DEFAULT_JPEG_QUALITY = 90
+DEFAULT_WEBP_QUALITY = 85
+
+# Формат по MIME-типу из заголовка Accept
+MEDIA_TYPE_PROFILES = {
+    "image/png": "png",
+    "image/jpeg": "jpeg",
+    "image/webp": "webp",
+}
+
+
+def make_profile(name, quality=None, compress_level=None):
+    """Профиль кодирования по имени из формы: png, png-fast, jpeg, webp или fast.
+
+    fast - самое быстрое кодирование (JPEG среднего качества),
+    png-fast - PNG без потерь с минимальным сжатием.
+    """
+    if quality is not None and not 1 <= quality <= 100:
+        raise RenderError("Качество должно быть от 1 до 100", reason="invalid_quality")
+    if compress_level is not None and not 0 <= compress_level <= 9:
+        raise RenderError("Уровень сжатия PNG должен быть от 0 до 9", reason="invalid_compress_level")
+
+    if name == "png":
+        level = DEFAULT_PNG_COMPRESS_LEVEL if compress_level is None else compress_level
+        return OutputProfile(name, "PNG", "image/png", "png", {"compress_level": level})
+    if name == "png-fast":
+        return OutputProfile(name, "PNG", "image/png", "png", {"compress_level": 1})
+    if name == "jpeg":
+        return OutputProfile(name, "JPEG", "image/jpeg", "jpg",
+                             {"quality": quality or DEFAULT_JPEG_QUALITY})
+    if name == "webp":
+        return OutputProfile(name, "WEBP", "image/webp", "webp",
+                             {"quality": quality or DEFAULT_WEBP_QUALITY, "method": 4})
+    if name == "fast":
+        return OutputProfile(name, "JPEG", "image/jpeg", "jpg",
+                             {"quality": quality or 80, "subsampling": 2})
+    raise RenderError(f"Неизвестный формат {name}, доступны: png, png-fast, jpeg, webp, fast",
+                      reason="unknown_output_format")
+
+
+def profile_from_accept(accept):
+    """Имя профиля по заголовку Accept с учетом q-весов, по умолчанию png."""
+    best_name, best_weight = "png", 0.0
+    for item in (accept or "").split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        weight = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    weight = float(param[2:])
+                except ValueError:
+                    weight = 0.0
+        name = MEDIA_TYPE_PROFILES.get(media_type)
+        if name is not None and weight > best_weight:
+            best_name, best_weight = name, weight
+    return best_name
+
+
+def resolve_profile(output_format=None, quality=None, compress_level=None, accept=None):
+    """Профиль из поля формы output_format, а если его нет - из заголовка Accept."""
+    return make_profile(output_format or profile_from_accept(accept), quality, compress_level)
+
+
+def encode_image(image, profile):
+    if profile.format == "JPEG" and image.mode != "RGB":
+        # JPEG не поддерживает прозрачность
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format=profile.format, **profile.options)
+    return buffer.getvalue()
@@ -0,0 +1,11 @@
+class RenderError(Exception):
+    """Ошибка во входных данных, текст возвращается пользователю с кодом status_code.
+
+    reason - короткий код причины для метрик (например, book_ratio); без него
+    причина определяется по коду ответа.
+    """
+
+    def __init__(self, message, status_code=422, reason=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.reason = reason
@@ -0,0 +1,224 @@
+import contextlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from uuid import uuid4
+
+from errors import RenderError
+
+logger = logging.getLogger(__name__)
+
+# Состояния задачи
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    error TEXT,
+    error_code INTEGER,
+    result_path TEXT,
+    media_type TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+
+class JobQueue:
+    """Очередь задач сборки в SQLite.
+
+    Входные файлы и результат каждой задачи лежат в jobs_dir/<id>/, а
+    состояние - в базе. Задачу забирает первый свободный исполнитель в
+    транзакции BEGIN IMMEDIATE, поэтому одну очередь могут разбирать
+    несколько процессов uvicorn.
+    """
+
+    def __init__(self, db_path, jobs_dir):
+        self.db_path = db_path
+        self.jobs_dir = jobs_dir
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # autocommit: транзакции открываем явно там, где они нужны
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def initialize(self):
+        with self._init_lock:
+            if self._initialized:
+                return
+            os.makedirs(self.jobs_dir, exist_ok=True)
+            db_dir = os.path.dirname(self.db_path)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            with self._connect() as connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.executescript(SCHEMA)
+            self._initialized = True
+
+    def job_dir(self, job_id):
+        return os.path.join(self.jobs_dir, job_id)
+
+    def enqueue(self, params, files):
+        """Сохраняет входные файлы [(имя, файл)] и ставит задачу в очередь."""
+        self.initialize()
+        job_id = uuid4().hex
+        job_dir = self.job_dir(job_id)
+        os.makedirs(job_dir)
+        inputs = {}
+        for name, f in files:
+            path = os.path.join(job_dir, f"input_{name}")
+            f.seek(0)
+            with open(path, "wb") as out:
+                shutil.copyfileobj(f, out)
+            inputs[name] = path
+
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO jobs (id, status, params, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps({**params, "inputs": inputs}), time.time()))
+        return job_id
+
+    def claim(self):
+        """Забирает самую старую задачу из очереди или возвращает None."""
+        self.initialize()
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)).fetchone()
+                if row is not None:
+                    connection.execute("UPDATE jobs SET status = ?, started_at = ? WHERE id = ?",
+                                       (RUNNING, time.time(), row["id"]))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return {"id": row["id"], "params": json.loads(row["params"])}
+
+    def complete(self, job_id, data, media_type, extension):
+        result_path = os.path.join(self.job_dir(job_id), f"result.{extension}")
+        with open(result_path, "wb") as f:
+            f.write(data)
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, result_path = ?, media_type = ?, finished_at = ? WHERE id = ?",
+                (DONE, result_path, media_type, time.time(), job_id))
+
+    def fail(self, job_id, message, status_code):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, error_code = ?, finished_at = ? WHERE id = ?",
+                (FAILED, message, status_code, time.time(), job_id))
+
+    def get(self, job_id):
+        self.initialize()
+        with self._connect() as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def requeue_stale(self, timeout):
+        """Возвращает в очередь задачи, которые слишком долго выполняются (их исполнитель, вероятно, упал)."""
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = ?, started_at = NULL WHERE status = ? AND started_at < ?",
+                (QUEUED, RUNNING, time.time() - timeout))
+        return cursor.rowcount
+
+    def purge(self, max_age):
+        """Удаляет завершенные задачи старше max_age секунд вместе с их файлами."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                (DONE, FAILED, time.time() - max_age)).fetchall()
+            for row in rows:
+                shutil.rmtree(self.job_dir(row["id"]), ignore_errors=True)
+                connection.execute("DELETE FROM jobs WHERE id = ?", (row["id"],))
+        return len(rows)
+
+
+class JobWorkers:
+    """Потоки, разбирающие очередь задач.
+
+    handler(job) получает словарь с id и params и возвращает
+    (данные, MIME-тип, расширение файла). RenderError сохраняется как
+    ошибка задачи с ее кодом, прочие исключения - как внутренняя ошибка.
+    """
+
+    def __init__(self, queue, handler, workers, poll_interval, stale_timeout, max_age):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stale_timeout = stale_timeout
+        self.max_age = max_age
+        self._stop = threading.Event()
+        self._threads = []
+        self._last_maintenance = 0.0
+        self._maintenance_lock = threading.Lock()
+
+    def start(self):
+        self.queue.initialize()
+        self._stop.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"job-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _maintenance(self):
+        now = time.monotonic()
+        with self._maintenance_lock:
+            if now - self._last_maintenance < self.stale_timeout:
+                return
+            self._last_maintenance = now
+        self.queue.requeue_stale(self.stale_timeout)
+        self.queue.purge(self.max_age)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._maintenance()
+                job = self.queue.claim()
+            except sqlite3.Error:
+                logger.exception("Не удалось получить задачу из очереди")
+                job = None
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            self.run_job(job)
+
+    def run_job(self, job):
+        try:
+            data, media_type, extension = self.handler(job)
+        except RenderError as e:
+            self.queue.fail(job["id"], str(e), e.status_code)
+        except Exception:
+            logger.exception("Задача %s завершилась с ошибкой", job["id"])
+            self.queue.fail(job["id"], "Внутренняя ошибка сервера", 500)
+        else:
+            self.queue.complete(job["id"], data, media_type, extension)
@@ -0,0 +1,121 @@
+from collections import namedtuple
+
+from errors import RenderError
+
+# Размеры книги
+BOOK_WIDTH = 240
+BOOK_HEIGHT = 360
+
+# Меньше этого обложки не уменьшаем: на таких миниатюрах уже ничего не видно
+MIN_BOOK_HEIGHT = 12
+
+
+class LayoutOptions(namedtuple("LayoutOptions", "margin spacing auto_scale")):
+    """Параметры раскладки: отступ от краев холста, промежуток между книгами
+    и разрешение уменьшать обложки, чтобы поместились все книги."""
+
+    @property
+    def cache_tag(self):
+        return f"m{self.margin}:s{self.spacing}:a{int(self.auto_scale)}"
+
+
+DEFAULT_LAYOUT = LayoutOptions(margin=0, spacing=0, auto_scale=False)
+
+
+class ShelfLayout(namedtuple("ShelfLayout", "book_width book_height columns rows positions")):
+    """Размер обложки, сетка и координаты левых верхних углов обложек по порядку книг."""
+
+    @property
+    def capacity(self):
+        return self.columns * self.rows
+
+
+def grid_size(canvas_width, canvas_height, book_width, book_height, margin, spacing):
+    """Сколько обложек заданного размера помещается по горизонтали и вертикали."""
+    columns = (canvas_width - 2 * margin + spacing) // (book_width + spacing)
+    rows = (canvas_height - 2 * margin + spacing) // (book_height + spacing)
+    return max(columns, 0), max(rows, 0)
+
+
+def fit_book_size(count, canvas_width, canvas_height, options):
+    """Самый крупный размер обложки (не больше стандартного), при котором помещаются count книг.
+
+    Перебирается число рядов: для каждого высота обложки ограничена
+    высотой холста, ширина - пропорциями 2:3. Перебор не длиннее числа
+    книг и обрывается, когда обложки становятся меньше MIN_BOOK_HEIGHT.
+    """
+    columns, rows = grid_size(canvas_width, canvas_height, BOOK_WIDTH, BOOK_HEIGHT,
+                              options.margin, options.spacing)
+    if columns * rows >= count:
+        return BOOK_WIDTH, BOOK_HEIGHT
+
+    # С ростом числа рядов обложки только уменьшаются, поэтому первый подходящий вариант - самый крупный
+    available_height = canvas_height - 2 * options.margin + options.spacing
+    for rows in range(1, count + 1):
+        book_height = min(BOOK_HEIGHT, available_height // rows - options.spacing)
+        if book_height < MIN_BOOK_HEIGHT:
+            break
+        book_width = max(1, book_height * BOOK_WIDTH // BOOK_HEIGHT)
+        columns, _ = grid_size(canvas_width, canvas_height, book_width, book_height,
+                               options.margin, options.spacing)
+        if columns * rows >= count:
+            return book_width, book_height
+    raise RenderError(f"{count} книг не помещаются на холсте {canvas_width}x{canvas_height}", reason="books_do_not_fit")
+
+
+def compute_layout(count, canvas_width, canvas_height, options=DEFAULT_LAYOUT):
+    """Раскладка count книг: справа налево, начиная с нижнего ряда.
+
+    Без auto_scale обложки стандартного размера; если все книги не
+    помещаются, это ошибка, а не полка с частью книг.
+    """
+    if options.auto_scale:
+        book_width, book_height = fit_book_size(count, canvas_width, canvas_height, options)
+    else:
+        book_width, book_height = BOOK_WIDTH, BOOK_HEIGHT
+
+    columns, rows = grid_size(canvas_width, canvas_height, book_width, book_height,
+                              options.margin, options.spacing)
+    if count > columns * rows:
+        raise RenderError(f"{count} книг не помещаются на холсте {canvas_width}x{canvas_height}: помещается "
+                          f"не больше {columns * rows}, для большего числа включите auto_scale",
+                          reason="books_do_not_fit")
+    # Начинаем с правого нижнего угла
+    right = canvas_width - options.margin - book_width
+    bottom = canvas_height - options.margin - book_height
+    positions = []
+    for index in range(count):
+        row, column = divmod(index, columns)
+        positions.append((right - column * (book_width + options.spacing),
+                          bottom - row * (book_height + options.spacing)))
+    return ShelfLayout(book_width, book_height, columns, rows, positions)
+
+
+def page_capacity(canvas_width, canvas_height, options=DEFAULT_LAYOUT):
+    """Сколько обложек стандартного размера помещается на один холст."""
+    columns, rows = grid_size(canvas_width, canvas_height, BOOK_WIDTH, BOOK_HEIGHT,
+                              options.margin, options.spacing)
+    return columns * rows
+
+
+def paginate(count, canvas_width, canvas_height, options=DEFAULT_LAYOUT, per_page=None):
+    """Разбивает count книг на страницы: список диапазонов (start, stop).
+
+    По умолчанию на странице столько книг, сколько помещается обложек
+    стандартного размера. Больше можно только с auto_scale.
+    """
+    capacity = page_capacity(canvas_width, canvas_height, options)
+    if per_page is None:
+        per_page = capacity
+    if per_page < 1:
+        raise RenderError("На странице должна помещаться хотя бы одна книга", reason="invalid_per_page")
+    if per_page > capacity and not options.auto_scale:
+        raise RenderError(f"На холст {canvas_width}x{canvas_height} помещается не больше {capacity} книг, "
+                          f"для большего числа включите auto_scale", reason="page_overfull")
+    return [(start, min(start + per_page, count)) for start in range(0, count, per_page)]
+
+
+def make_layout_options(margin=0, spacing=0, auto_scale=False):
+    if margin < 0 or spacing < 0:
+        raise RenderError("Отступы не могут быть отрицательными", reason="negative_margin")
+    return LayoutOptions(margin, spacing, bool(auto_scale))
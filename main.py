@@ -1,124 +1,776 @@
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
-from PIL import Image
+import time
+
+# Начало импорта: время загрузки модулей тоже входит в отчет о запуске
+_import_started = time.perf_counter()
+
+from fastapi import FastAPI, File, UploadFile, Form, Request, Depends
+import asyncio
+import contextlib
+import hashlib
 import io
 import os
-from uuid import uuid4
+import shutil
+import tempfile
+import zipfile
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+
+from config import (RENDER_WORKERS, RENDER_QUEUE_SIZE, RETRY_AFTER_SECONDS,
+                    PERSIST_OUTPUT, OUTPUT_DIR, OUTPUT_MAX_AGE_SECONDS, OUTPUT_MAX_BYTES,
+                    OUTPUT_JANITOR_INTERVAL_SECONDS, RENDER_CACHE_MAX_BYTES,
+                    TILE_CACHE_MAX_BYTES, ASSET_DIR, ASSET_MAPPED_MAX, ASSET_MAX_AGE_SECONDS, ASSET_MAX_BYTES,
+                    ASSET_JANITOR_INTERVAL_SECONDS, MAX_UPLOAD_FILE_BYTES, MAX_REQUEST_BYTES,
+                    JOBS_DIR, JOBS_DB, JOB_WORKERS, JOB_POLL_INTERVAL_SECONDS,
+                    JOB_STALE_TIMEOUT_SECONDS, JOB_MAX_AGE_SECONDS, MAX_BOOKS, PROFILING_ENABLED,
+                    PROFILES_DIR, PROFILE_TOP_N, PROFILE_KEEP, COVER_INDEX_ENABLED, COVER_INDEX_PATH,
+                    PHASH_MAX_DISTANCE, PREVIEW_SCALE, PREVIEW_QUALITY, STARTUP_RESTRICT_PLUGINS,
+                    STARTUP_PREWARM)
+from cache import LRUCache
+from cover_index import CoverIndex
+from output_store import OutputStore
+from profiling import RequestProfiler
+from startup import StartupReport, prewarm_render, restrict_image_plugins
+from static_assets import StaticAssets
+from assets import AssetStore
+from encoders import OutputProfile, make_profile, resolve_profile
+from jobs import DONE, FAILED, JobQueue, JobWorkers
+from layout import LayoutOptions, make_layout_options, paginate
+from metrics import ERROR_REASON_KEY, CallbackMetric, Counter, Histogram, MetricsMiddleware, Registry
+from render import (CANVAS_HEIGHT, CANVAS_WIDTH, RESOLUTIONS, ImageInput, RenderError, check_inputs, image_nbytes, load_batch_inputs,
+                    parse_resolution, parse_resolutions, prepare_asset, render_cache_key, render_image,
+                    render_preview, render_resized)
+from upload_limits import RequestSizeLimitMiddleware, RequestTooLarge, check_upload_size, file_digest
+from worker_pool import PoolSaturated, RenderPool
+from zip_stream import ZipStream
+
+
+
+# Длительность этапов запуска, отдается на /ready и в метриках
+startup_report = StartupReport(_import_started)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Вся подготовка с побочными эффектами выполняется здесь, а не при импорте модуля.
+    # uvicorn начинает принимать запросы только после нее
+    if STARTUP_RESTRICT_PLUGINS:
+        with startup_report.phase("plugins"):
+            restrict_image_plugins()
+    # Имена с хешем и сжатые версии статических файлов готовятся один раз при запуске
+    with startup_report.phase("static"):
+        await run_in_threadpool(static_assets.build)
+    with startup_report.phase("jobs"):
+        await run_in_threadpool(job_queue.initialize)
+        # Исполнители фоновых задач работают все время жизни процесса
+        job_workers.start()
+    if cover_index is not None:
+        with startup_report.phase("cover_index"):
+            await run_in_threadpool(cover_index.load)
+    if STARTUP_PREWARM:
+        # Синтетическая сборка в пуле: первый настоящий запрос не ждет ленивой инициализации Pillow
+        with startup_report.phase("prewarm"):
+            await render_pool.run(prewarm_render, CANVAS_WIDTH, CANVAS_HEIGHT)
+    startup_report.mark_ready()
+    yield
+    startup_report.mark_stopping()
+    job_workers.stop()
+    render_pool.shutdown()
 
-app = FastAPI()
 
-# Добавляем middleware для отключения кеширования
+app = FastAPI(lifespan=lifespan)
+
+# Ограничение размера тела запроса и каждого файла в нем: лишнее не читается ни в память, ни во временные файлы
+app.add_middleware(RequestSizeLimitMiddleware, max_bytes=MAX_REQUEST_BYTES, max_file_bytes=MAX_UPLOAD_FILE_BYTES)
+
+# Добавляем middleware для отключения кеширования.
+# Ответы, которые сами задают Cache-Control (например, готовые изображения с ETag), не трогаем
 @app.middleware("http")
 async def add_no_cache_headers(request, call_next):
     response = await call_next(request)
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
+    if "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response.headers["Pragma"] = "no-cache"
+        response.headers["Expires"] = "0"
     return response
 
-# Папка для сохранения временных файлов
-OUTPUT_DIR = "generated"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Сохранение готовых изображений на диск включается переменной BOOKSHELF_PERSIST_OUTPUT
+output_store = OutputStore(OUTPUT_DIR, OUTPUT_MAX_AGE_SECONDS, OUTPUT_MAX_BYTES,
+                           OUTPUT_JANITOR_INTERVAL_SECONDS) if PERSIST_OUTPUT else None
+
+# Статические файлы с хешем в имени и заранее сжатые, страница ссылается на них
+static_assets = StaticAssets("static", "index.html")
+
+# Пул потоков для сборки изображений
+render_pool = RenderPool(max_workers=RENDER_WORKERS, max_queue=RENDER_QUEUE_SIZE)
+
+# Готовые PNG по ключу из хешей входных данных
+render_cache = LRUCache(RENDER_CACHE_MAX_BYTES)
+
+# Уже уменьшенные обложки и фоны по хешу файла и целевому размеру
+tile_cache = LRUCache(TILE_CACHE_MAX_BYTES, sizeof=image_nbytes)
+
+# Изображения, загруженные через /assets
+asset_store = AssetStore(ASSET_DIR, ASSET_MAX_AGE_SECONDS, ASSET_MAX_BYTES, ASSET_JANITOR_INTERVAL_SECONDS,
+                         ASSET_MAPPED_MAX)
+
+# Перцептивные хеши обложек: почти одинаковые обложки собираются из одной уменьшенной копии
+cover_index = CoverIndex(COVER_INDEX_PATH, PHASH_MAX_DISTANCE) if COVER_INDEX_ENABLED else None
+
+# Очередь фоновых задач сборки, общая для всех процессов через SQLite
+job_queue = JobQueue(JOBS_DB, JOBS_DIR)
+
+# Профилирование отдельных запросов, только если включено настройкой BOOKSHELF_PROFILING_ENABLED
+request_profiler = RequestProfiler(PROFILES_DIR, PROFILE_TOP_N, PROFILE_KEEP) if PROFILING_ENABLED else None
+
+# Метрики процесса в формате Prometheus, отдаются на /metrics
+metrics = Registry()
+http_requests = metrics.register(Counter(
+    "bookshelf_http_requests_total", "Запросы по маршруту, методу и коду ответа", ("path", "method", "status")))
+http_errors = metrics.register(Counter(
+    "bookshelf_http_errors_total", "Ответы с ошибкой по маршруту и причине", ("path", "reason")))
+http_duration = metrics.register(Histogram(
+    "bookshelf_http_request_duration_seconds", "Длительность запросов", ("path",)))
+http_bytes_in = metrics.register(Counter(
+    "bookshelf_http_request_bytes_total", "Принято байт в телах запросов", ("path",)))
+http_bytes_out = metrics.register(Counter(
+    "bookshelf_http_response_bytes_total", "Отправлено байт в телах ответов", ("path",)))
+stage_duration = metrics.register(Histogram(
+    "bookshelf_stage_duration_seconds",
+    "Длительность этапов сборки: read, validate, decode, resize, composite, encode, write", ("stage",)))
+metrics.register(CallbackMetric(
+    "bookshelf_render_pool_pending", "Выполняемые и ожидающие задачи в пуле сборки", lambda: render_pool.pending))
+metrics.register(CallbackMetric(
+    "bookshelf_render_pool_capacity", "Предел задач в пуле сборки (потоки + очередь)",
+    lambda: render_pool.max_workers + render_pool.max_queue))
+CACHES = {"render": lambda: render_cache, "tile": lambda: tile_cache}
+for stat, kind, documentation in (("hits", "counter", "Попадания в кеш"),
+                                  ("misses", "counter", "Промахи кеша"),
+                                  ("hit_rate", "gauge", "Доля попаданий в кеш"),
+                                  ("bytes", "gauge", "Объем кеша в байтах"),
+                                  ("entries", "gauge", "Записей в кеше")):
+    name = f"bookshelf_cache_{stat}_total" if kind == "counter" else f"bookshelf_cache_{stat}"
+    metrics.register(CallbackMetric(
+        name, documentation,
+        lambda stat=stat: {(cache,): get_cache().stats()[stat] for cache, get_cache in CACHES.items()},
+        ("cache",), kind))
+if cover_index is not None:
+    for stat, documentation in (("covers", "Обложек в индексе перцептивных хешей"),
+                                ("duplicates", "Обложек, объединенных с похожей обложкой из индекса")):
+        metrics.register(CallbackMetric(
+            f"bookshelf_cover_index_{stat}", documentation, lambda stat=stat: cover_index.stats()[stat]))
+
+metrics.register(CallbackMetric(
+    "bookshelf_startup_seconds", "Длительность этапов запуска процесса; total - от импорта до готовности",
+    lambda: {**{(phase,): seconds for phase, seconds in startup_report.phases.items()},
+             **({("total",): startup_report.total} if startup_report.total is not None else {})},
+    ("phase",)))
+
+# Снаружи остальных middleware, чтобы учитывать и отклоненные ими запросы
+app.add_middleware(MetricsMiddleware, requests=http_requests, errors=http_errors, duration=http_duration,
+                   bytes_in=http_bytes_in, bytes_out=http_bytes_out)
+
+# Готовое изображение можно хранить в браузере, но перед использованием нужно проверить ETag
+RENDER_CACHE_CONTROL = "private, no-cache"
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    # Только точное совпадение: ETag - хеш входных данных, и "*" без сборки не говорит, что она удалась бы
+    return etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+def record_stages(timings):
+    for name, seconds in timings.items():
+        stage_duration.observe(seconds, stage=name)
+
+
+def server_timing(timings):
+    """Заголовок Server-Timing: длительность этапов в миллисекундах."""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+def image_response(request, data, etag, profile, timings=None):
+    # Формат может выбираться по Accept, поэтому ответ зависит от этого заголовка
+    headers = {"ETag": etag, "Cache-Control": RENDER_CACHE_CONTROL, "Vary": "Accept"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    headers["Content-Disposition"] = f'attachment; filename="bookshelf.{profile.extension}"'
+    if timings:
+        headers["Server-Timing"] = server_timing(timings)
+    return Response(data, media_type=profile.media_type, headers=headers)
+
+
+def error_response(request, message, status_code, reason=None, **extra):
+    """Ответ {"error": ...}; reason - код причины для метрики bookshelf_http_errors_total."""
+    if reason is not None:
+        request.scope[ERROR_REASON_KEY] = reason
+    return JSONResponse({"error": message, **extra}, status_code=status_code)
+
+
+@app.exception_handler(RenderError)
+async def render_error_handler(request, exc):
+    return error_response(request, str(exc), exc.status_code, exc.reason)
+
+
+@app.exception_handler(RequestTooLarge)
+async def request_too_large_handler(request, exc):
+    return JSONResponse({"error": exc.detail}, status_code=413)
+
+
+@app.exception_handler(PoolSaturated)
+async def pool_saturated_handler(request, exc):
+    return JSONResponse({"error": "Сервер перегружен, повторите попытку позже"},
+                        status_code=503,
+                        headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+
+def output_profile(request: Request,
+                   output_format: str = Form(None),
+                   quality: int = Form(None),
+                   compress_level: int = Form(None)):
+    # Формат ответа: поле output_format или заголовок Accept, по умолчанию PNG
+    return resolve_profile(output_format, quality, compress_level, request.headers.get("Accept"))
+
+
+def layout_options(margin: int = Form(0), spacing: int = Form(0), auto_scale: bool = Form(False)):
+    return make_layout_options(margin, spacing, auto_scale)
+
+
+def check_book_count(books):
+    # Проверка на наличие хотя бы одной книги
+    if not books:
+        raise RenderError("Добавьте хотя бы одну книгу", reason="no_books")
+    if len(books) > MAX_BOOKS:
+        raise RenderError(f"Можно добавить не больше {MAX_BOOKS} книг", reason="too_many_books")
+    return books
+
+
+def uploaded_books(book1: UploadFile = File(None),
+                   book2: UploadFile = File(None),
+                   book3: UploadFile = File(None),
+                   book4: UploadFile = File(None),
+                   book5: UploadFile = File(None),
+                   book6: UploadFile = File(None),
+                   book7: UploadFile = File(None),
+                   book8: UploadFile = File(None),
+                   books: list[UploadFile] = File(None)):
+    """Книги из полей book1..book8 (так отправляет форма на странице) и из списка books любой длины."""
+    book_files = [book1, book2, book3, book4, book5, book6, book7, book8]
+    return check_book_count([book_file for book_file in book_files if book_file is not None] + (books or []))
+
+
+def asset_books(book1: str = Form(None),
+                book2: str = Form(None),
+                book3: str = Form(None),
+                book4: str = Form(None),
+                book5: str = Form(None),
+                book6: str = Form(None),
+                book7: str = Form(None),
+                book8: str = Form(None),
+                books: list[str] = Form(None)):
+    """Идентификаторы книг из /assets: поля book1..book8 и список books."""
+    asset_ids = [book1, book2, book3, book4, book5, book6, book7, book8]
+    return check_book_count([asset_id for asset_id in asset_ids if asset_id is not None] + (books or []))
+
+
+def canonical_books(book_inputs):
+    """Обложки под хешами канонических обложек из индекса: дубликаты берут общую уменьшенную копию."""
+    if cover_index is None:
+        return book_inputs
+    return [book.with_digest(cover_index.canonical_digest(book)) for book in book_inputs]
+
+
+async def resolve_canonical_books(book_inputs):
+    """canonical_books из цикла событий: в пул потоков - только если индекс включен."""
+    if cover_index is None:
+        return book_inputs
+    return await render_pool.run(canonical_books, book_inputs)
+
+
+async def render_shelf_response(request, background_input, book_inputs, canvas_width, canvas_height, profile,
+                                layout, timings=None):
+    """Готовая полка из кеша или из пула потоков. timings - уже замеренные этапы (например, read)."""
+    timings = dict(timings or {})
+    # Одинаковые входные данные дают одинаковый результат, поэтому ключ кеша служит и ETag
+    digests = [background_input.digest] + [book.digest for book in book_inputs]
+    cache_key = render_cache_key(digests, canvas_width, canvas_height, profile, layout)
+    etag = f'"{cache_key}"'
+    # Профилируемый запрос всегда собирается заново, иначе профилировать нечего
+    profiling = request_profiler is not None and request_profiler.requested(request)
+    if etag_matches(request, etag) and not profiling:
+        return image_response(request, None, etag, profile)
+
+    image_data = render_cache.get(cache_key) if not profiling else None
+    if image_data is not None:
+        record_stages(timings)
+        return image_response(request, image_data, etag, profile, timings)
+
+    # Декодирование, масштабирование и сборка выполняются в пуле потоков,
+    # чтобы не блокировать цикл событий для остальных запросов.
+    # Ошибки входных данных (RenderError) и переполнение пула превращаются в ответы обработчиками выше
+    render_args = (render_image, background_input, book_inputs, canvas_width, canvas_height, profile, tile_cache,
+                   layout)
+    profile_id = None
+    if profiling:
+        (image_data, render_timings), profile_id = await render_pool.run(request_profiler.run, *render_args)
+    else:
+        image_data, render_timings = await render_pool.run(*render_args)
+    timings.update(render_timings)
+
+    render_cache.put(cache_key, image_data)
+
+    if output_store is not None:
+        started = time.perf_counter()
+        await run_in_threadpool(output_store.save, image_data, f".{profile.extension}")
+        timings["write"] = time.perf_counter() - started
+
+    record_stages(timings)
+
+    # Возвращаем изображение пользователю прямо из памяти
+    response = image_response(request, image_data, etag, profile, timings)
+    if profile_id is not None:
+        response.headers["X-Profile-Id"] = profile_id
+    return response
 
-# Настройка статических файлов с отключенным кешированием
-app.mount("/static", StaticFiles(directory="static", html=True), name="static")
 
-# Размеры книги
-BOOK_WIDTH = 240
-BOOK_HEIGHT = 360
+async def read_uploads(uploads, timings=None):
+    """ImageInput для загруженных файлов.
 
-# Размер итогового изображения
-CANVAS_WIDTH = 1920
-CANVAS_HEIGHT = 1080
+    Starlette уже сохранил файлы во временные SpooledTemporaryFile; их размер
+    проверяется, хеш считается блоками, а Pillow читает их напрямую, без копии в bytes.
+    Время чтения записывается в timings["read"], если словарь передан.
+    """
+    started = time.perf_counter()
+    for upload in uploads:
+        check_upload_size(upload, MAX_UPLOAD_FILE_BYTES)
+    inputs = await run_in_threadpool(
+        lambda: [ImageInput.from_file(upload.file, file_digest(upload.file)) for upload in uploads])
+    if timings is not None:
+        timings["read"] = time.perf_counter() - started
+    return inputs
 
 
 @app.post("/upload/")
-async def upload_files(background: UploadFile = File(...), 
-                       book1: UploadFile = File(...), 
-                       book2: UploadFile = File(None), 
-                       book3: UploadFile = File(None),
-                       book4: UploadFile = File(None),
-                       book5: UploadFile = File(None),
-                       book6: UploadFile = File(None),
-                       book7: UploadFile = File(None),
-                       book8: UploadFile = File(None),
-                       resolution: str = Form('1920x1080')):  # Значение по умолчанию
+async def upload_files(request: Request,
+                       background: UploadFile = File(...),
+                       books: list = Depends(uploaded_books),
+                       resolution: str = Form('1920x1080'),  # Значение по умолчанию
+                       profile: OutputProfile = Depends(output_profile),
+                       layout: LayoutOptions = Depends(layout_options)):
     # Определяем размеры на основе выбранного разрешения
-    if resolution == '1280x720':
-        canvas_width, canvas_height = 1280, 720
-    elif resolution == '1600x900':
-        canvas_width, canvas_height = 1600, 900
-    elif resolution == '2560x1440':
-        canvas_width, canvas_height = 2560, 1440
-    else:  # По умолчанию 1920x1080
-        canvas_width, canvas_height = 1920, 1080
+    canvas_width, canvas_height = parse_resolution(resolution)
 
     # Читаем фон
     if background is None:
         return {"error": "Фон не загружен"}
 
-    background_image = Image.open(io.BytesIO(await background.read())).convert("RGBA")
-    bg_width, bg_height = background_image.size
+    timings = {}
+    inputs = await read_uploads([background] + books, timings)
+    book_inputs = await resolve_canonical_books(inputs[1:])
+    return await render_shelf_response(request, inputs[0], book_inputs, canvas_width, canvas_height,
+                                       profile, layout, timings)
 
-    # Проверка на допустимый размер с погрешностью 15%
-    width_tolerance = canvas_width * 0.15
-    height_tolerance = canvas_height * 0.15
 
-    if not (canvas_width - width_tolerance <= bg_width <= canvas_width + width_tolerance) or \
-       not (canvas_height - height_tolerance <= bg_height <= canvas_height + height_tolerance):
-        return {"error": f"Размер фона должен быть около {canvas_width}x{canvas_height} пикселей с погрешностью 15%."}
+async def preview_response(request, inputs, canvas_width, canvas_height, layout, timings=None):
+    """Превью полки из кеша или из пула потоков; inputs - фон и обложки."""
+    timings = dict(timings or {})
+    profile = make_profile("fast", PREVIEW_QUALITY)
+    background_input = inputs[0]
+    book_inputs = await resolve_canonical_books(inputs[1:])
 
-    background_image = background_image.resize((canvas_width, canvas_height))
+    digests = [background_input.digest] + [book.digest for book in book_inputs]
+    cache_key = f"preview{PREVIEW_SCALE}:" + render_cache_key(digests, canvas_width, canvas_height, profile, layout)
+    etag = f'"{cache_key}"'
+    if etag_matches(request, etag):
+        return image_response(request, None, etag, profile)
 
-    # Список книг
-    book_files = [book1, book2, book3, book4, book5, book6, book7, book8]
-    books = []
+    image_data = render_cache.get(cache_key)
+    if image_data is None:
+        image_data, render_timings = await render_pool.run(
+            render_preview, background_input, book_inputs, canvas_width, canvas_height, PREVIEW_SCALE, profile,
+            tile_cache, layout)
+        timings.update(render_timings)
+        render_cache.put(cache_key, image_data)
+    record_stages(timings)
+    return image_response(request, image_data, etag, profile, timings)
 
-    # Обрабатываем каждую загруженную книгу
-    for book_file in book_files:
-        if book_file is not None:
-            book_image = Image.open(io.BytesIO(await book_file.read())).convert("RGBA")
-            # Добавляем масштабирование книги до стандартного размера
-            book_image = book_image.resize((BOOK_WIDTH, BOOK_HEIGHT))
-            books.append(book_image)
 
-    # Проверка на наличие хотя бы одной книги
-    if not books:
-        return {"error": "Добавьте хотя бы одну книгу"}
+@app.post("/upload/preview/")
+async def upload_preview(request: Request,
+                         background: UploadFile = File(...),
+                         books: list = Depends(uploaded_books),
+                         resolution: str = Form('1920x1080'),
+                         layout: LayoutOptions = Depends(layout_options)):
+    """Быстрое превью полки для /upload/ с теми же полями.
+
+    Полка собирается на холсте в PREVIEW_SCALE раз меньше и кодируется в
+    JPEG невысокого качества, поэтому клиент может показать ее, пока
+    полноразмерное изображение еще собирается вторым запросом.
+    """
+    canvas_width, canvas_height = parse_resolution(resolution)
+    timings = {}
+    inputs = await read_uploads([background] + books, timings)
+    return await preview_response(request, inputs, canvas_width, canvas_height, layout, timings)
+
+
+@app.post("/upload/batch/")
+async def upload_batch(request: Request,
+                       background: UploadFile = File(...),
+                       books: list = Depends(uploaded_books),
+                       resolutions: str = Form(",".join(RESOLUTIONS)),
+                       profile: OutputProfile = Depends(output_profile),
+                       layout: LayoutOptions = Depends(layout_options)):
+    """Одна и та же полка в нескольких разрешениях, в одном ZIP-архиве.
+
+    Фон и обложки декодируются один раз, полки для разных разрешений
+    собираются параллельно в пуле потоков.
+    """
+    sizes = parse_resolutions(resolutions)
+
+    timings = {}
+    inputs = await read_uploads([background] + books, timings)
+    background_input = inputs[0]
+    book_inputs = await resolve_canonical_books(inputs[1:])
+
+    digests = [background_input.digest] + [book.digest for book in book_inputs]
+    # Меньшие разрешения уменьшаются из фона, проверенного только для самого большого,
+    # поэтому у пакетных полок свои ключи: одиночная сборка должна проверять фон сама
+    cache_keys = {size: "batch:" + render_cache_key(digests, *size, profile, layout) for size in sizes}
+    etag = '"{}"'.format(hashlib.sha256(":".join(cache_keys.values()).encode()).hexdigest())
+    if etag_matches(request, etag):
+        return image_response(request, None, etag, profile)
+
+    # Разрешения, которых уже нет в кеше, собираются из общих декодированных изображений
+    results = {size: render_cache.get(key) for size, key in cache_keys.items()}
+    missing = [size for size, data in results.items() if data is None]
+    if missing:
+        background_image, book_images, load_timings = await render_pool.run(
+            load_batch_inputs, background_input, book_inputs, missing, tile_cache, layout)
+        timings.update(load_timings)
+        # Не больше задач одновременно, чем потоков в пуле, чтобы пакет не занимал всю очередь
+        for start in range(0, len(missing), render_pool.max_workers):
+            wave = missing[start:start + render_pool.max_workers]
+            rendered = await asyncio.gather(*(
+                render_pool.run(render_resized, background_input, background_image, book_inputs, book_images,
+                                *size, profile, tile_cache, layout)
+                for size in wave))
+            for size, (image_data, render_timings) in zip(wave, rendered):
+                results[size] = image_data
+                render_cache.put(cache_keys[size], image_data)
+                # В Server-Timing - суммарное время этапа по всем разрешениям
+                for name, seconds in render_timings.items():
+                    timings[name] = timings.get(name, 0.0) + seconds
+    record_stages(timings)
+
+    def build_zip():
+        buffer = io.BytesIO()
+        # Изображения уже сжаты, повторно их не сжимаем
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+            for (width, height), image_data in results.items():
+                archive.writestr(f"bookshelf_{width}x{height}.{profile.extension}", image_data)
+        return buffer.getvalue()
+
+    archive_profile = profile._replace(media_type="application/zip", extension="zip")
+    return image_response(request, await run_in_threadpool(build_zip), etag, archive_profile, timings)
+
+
+def render_cached(sources, canvas_width, canvas_height, profile, layout):
+    """Собирает полку в текущем потоке или берет готовую из кеша. sources - фон и обложки."""
+    cache_key = render_cache_key([source.digest for source in sources], canvas_width, canvas_height,
+                                 profile, layout)
+    image_data = render_cache.get(cache_key)
+    if image_data is None:
+        image_data, timings = render_image(sources[0], sources[1:], canvas_width, canvas_height, profile,
+                                           tile_cache, layout)
+        record_stages(timings)
+        render_cache.put(cache_key, image_data)
+    return image_data
+
+
+def copy_uploads(uploads, directory):
+    """Копии загрузок на диске для ответа, который формируется уже после выхода из обработчика.
+
+    FastAPI закрывает загруженные файлы сразу после обработчика, до отправки ответа.
+    """
+    inputs = []
+    for index, upload in enumerate(uploads):
+        digest = file_digest(upload.file)
+        path = os.path.join(directory, f"input_{index}")
+        with open(path, "wb") as out:
+            shutil.copyfileobj(upload.file, out)
+        inputs.append(ImageInput.from_path(digest, path))
+    return inputs
+
+
+@app.post("/upload/pages/")
+async def upload_pages(background: UploadFile = File(...),
+                       books: list = Depends(uploaded_books),
+                       resolution: str = Form('1920x1080'),
+                       per_page: int = Form(None),
+                       profile: OutputProfile = Depends(output_profile),
+                       layout: LayoutOptions = Depends(layout_options)):
+    """Большая библиотека на нескольких холстах, в одном ZIP-архиве.
+
+    Книги делятся на страницы по per_page (по умолчанию - сколько помещается
+    на холст), страницы собираются параллельно в пуле потоков, и каждая
+    отправляется клиенту сразу, как только готова. Архив не собирается в
+    памяти целиком. Входные данные проверяются по заголовкам до начала
+    ответа; если страница все же не собралась, вместо нее в архиве текстовый
+    файл с ошибкой.
+    """
+    for upload in [background] + books:
+        check_upload_size(upload, MAX_UPLOAD_FILE_BYTES)
+    canvas_width, canvas_height = parse_resolution(resolution)
+    pages = paginate(len(books), canvas_width, canvas_height, layout, per_page)
+
+    workdir = tempfile.TemporaryDirectory(prefix="bookshelf-pages-")
+    try:
+        inputs = await run_in_threadpool(copy_uploads, [background] + books, workdir.name)
+        background_input = inputs[0]
+        book_inputs = await resolve_canonical_books(inputs[1:])
+        await render_pool.run(check_inputs, background_input, book_inputs, canvas_width, canvas_height)
+    except BaseException:
+        workdir.cleanup()
+        raise
+
+    async def rendered_pages():
+        # Не больше задач одновременно, чем потоков в пуле, чтобы не занимать всю очередь
+        waiting = list(enumerate(pages, start=1))
+        running = {}
+        try:
+            while waiting or running:
+                while waiting and len(running) < render_pool.max_workers:
+                    number, (start, stop) = waiting.pop(0)
+                    # Запрос уже принят: при занятом пуле страница ждет места, а не заменяется ошибкой
+                    task = asyncio.ensure_future(render_pool.run_waiting(
+                        render_cached, [background_input] + book_inputs[start:stop],
+                        canvas_width, canvas_height, profile, layout))
+                    running[task] = number
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield running.pop(task), task
+        finally:
+            for task in running:
+                task.cancel()
+
+    async def stream():
+        archive = ZipStream()
+        try:
+            async for number, task in rendered_pages():
+                try:
+                    chunk = archive.add(f"bookshelf_page{number:03}.{profile.extension}", task.result())
+                except RenderError as e:
+                    chunk = archive.add(f"bookshelf_page{number:03}.error.txt", str(e).encode())
+                yield chunk
+            yield archive.close()
+        finally:
+            await run_in_threadpool(workdir.cleanup)
+
+    headers = {"Content-Disposition": 'attachment; filename="bookshelf_pages.zip"',
+               "X-Page-Count": str(len(pages))}
+    return StreamingResponse(stream(), media_type="application/zip", headers=headers)
+
+
+def run_render_job(job):
+    """Выполняет задачу из очереди в потоке исполнителя."""
+    params = job["params"]
+    sources = [ImageInput.from_path(params["digests"][name], params["inputs"][name]) for name in params["order"]]
+    canvas_width, canvas_height = parse_resolution(params["resolution"])
+    profile = make_profile(params["output_format"], params["quality"], params["compress_level"])
+    layout = LayoutOptions(*params["layout"])
+    # Сборка идет в общем пуле: задачи и запросы вместе не занимают больше RENDER_WORKERS потоков
+    image_data = render_pool.call(
+        lambda: render_cached(sources[:1] + canonical_books(sources[1:]), canvas_width, canvas_height,
+                              profile, layout))
+    return image_data, profile.media_type, profile.extension
+
+
+job_workers = JobWorkers(job_queue, run_render_job, JOB_WORKERS, JOB_POLL_INTERVAL_SECONDS,
+                         JOB_STALE_TIMEOUT_SECONDS, JOB_MAX_AGE_SECONDS)
+
 
-    # Размещение книг на полке
-    result_image = background_image.copy()
-    rows = 3  # Количество рядов
-    cols = canvas_width // BOOK_WIDTH  # Максимальное число книг в ряду
+@app.post("/jobs", status_code=202)
+async def create_job(background: UploadFile = File(...),
+                     books: list = Depends(uploaded_books),
+                     resolution: str = Form('1920x1080'),
+                     profile: OutputProfile = Depends(output_profile),
+                     layout: LayoutOptions = Depends(layout_options)):
+    """Ставит сборку в очередь и сразу возвращает идентификатор задачи.
 
-    x_offset = canvas_width - BOOK_WIDTH  # Начинаем с правого края
-    y_offset = canvas_height - BOOK_HEIGHT  # Начинаем с нижнего ряда
+    Состояние задачи - GET /jobs/{id}, готовое изображение - GET /jobs/{id}/result.
+    Ошибки параметров видны сразу, а ошибки в изображениях - в состоянии задачи.
+    """
+    uploads = {"background": background}
+    for index, book_file in enumerate(books, start=1):
+        uploads[f"book{index}"] = book_file
+    for upload in uploads.values():
+        check_upload_size(upload, MAX_UPLOAD_FILE_BYTES)
 
-    for idx, book in enumerate(books):
-        # Добавляем книгу на изображение
-        result_image.paste(book, (x_offset, y_offset), book)
+    def enqueue():
+        params = {
+            "order": list(uploads),
+            "digests": {name: file_digest(upload.file) for name, upload in uploads.items()},
+            "resolution": resolution,
+            "output_format": profile.name,
+            "quality": profile.options.get("quality"),
+            "compress_level": profile.options.get("compress_level"),
+            "layout": list(layout),
+        }
+        return job_queue.enqueue(params, [(name, upload.file) for name, upload in uploads.items()])
 
-        # Смещаем по горизонтали
-        x_offset -= BOOK_WIDTH  # Сдвигаем влево
+    job_id = await run_in_threadpool(enqueue)
+    return JSONResponse({"id": job_id, "status": "queued",
+                         "status_url": f"/jobs/{job_id}", "result_url": f"/jobs/{job_id}/result"},
+                        status_code=202, headers={"Location": f"/jobs/{job_id}"})
 
-        # Если ряд заполнен, переходим на следующий
-        if x_offset < 0:
-            x_offset = canvas_width - BOOK_WIDTH  # Снова начинаем с правого края
-            y_offset -= BOOK_HEIGHT  # Переходим на следующий ряд
 
-        # Проверяем, если ряды закончились
-        if y_offset < 0:
-            break
+async def get_job_or_404(job_id):
+    job = await run_in_threadpool(job_queue.get, job_id)
+    if job is None:
+        raise RenderError("Задача не найдена", status_code=404, reason="job_not_found")
+    return job
 
-    # Сохраняем итоговое изображение
-    output_path = os.path.join(OUTPUT_DIR, f"bookshelf_{uuid4().hex}.png")
-    result_image.save(output_path)
 
-    # Возвращаем изображение пользователю
-    return FileResponse(output_path, media_type="image/png", filename="bookshelf.png")
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await get_job_or_404(job_id)
+    status = {"id": job_id, "status": job["status"]}
+    if job["status"] == DONE:
+        status["result_url"] = f"/jobs/{job_id}/result"
+    elif job["status"] == FAILED:
+        status["error"] = job["error"]
+    return status
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(request: Request, job_id: str):
+    job = await get_job_or_404(job_id)
+    if job["status"] == FAILED:
+        return error_response(request, job["error"], job["error_code"], "job_failed")
+    if job["status"] != DONE:
+        return error_response(request, "Задача еще не завершена", 409, "job_not_finished", status=job["status"])
+    extension = job["result_path"].rsplit(".", 1)[-1]
+    return FileResponse(job["result_path"], media_type=job["media_type"], filename=f"bookshelf.{extension}")
+
+
+@app.post("/assets")
+async def upload_asset(file: UploadFile = File(...), kind: str = Form('book')):
+    """Сохраняет изображение один раз и возвращает его идентификатор для /render/."""
+    if kind not in ("book", "background"):
+        raise RenderError("Тип изображения должен быть book или background", status_code=400,
+                          reason="invalid_asset_kind")
+
+    source, = await read_uploads([file])
+    # Проверяем и заранее уменьшаем изображение, чтобы последующие сборки брали его из кеша
+    info = await render_pool.run(prepare_asset, source, kind, tile_cache, asset_store.save_background)
+
+    await run_in_threadpool(asset_store.save, source.digest, file.file)
+    return info
+
+
+def stored_inputs(asset_ids):
+    """Изображения из /assets по идентификаторам, 404 - если какого-то уже нет."""
+    inputs = []
+    for asset_id in asset_ids:
+        source = asset_store.get(asset_id)
+        if source is None:
+            raise RenderError(f"Изображение {asset_id} не найдено, загрузите его заново", status_code=404,
+                              reason="asset_not_found")
+        inputs.append(source)
+    return inputs
+
+
+@app.post("/render/")
+async def render_assets(request: Request,
+                        background: str = Form(...),
+                        books: list = Depends(asset_books),
+                        resolution: str = Form('1920x1080'),
+                        profile: OutputProfile = Depends(output_profile),
+                        layout: LayoutOptions = Depends(layout_options)):
+    """То же, что /upload/, но вместо файлов принимает идентификаторы из /assets."""
+    canvas_width, canvas_height = parse_resolution(resolution)
+    inputs = stored_inputs([background] + books)
+    book_inputs = await resolve_canonical_books(inputs[1:])
+    return await render_shelf_response(request, inputs[0], book_inputs, canvas_width, canvas_height,
+                                       profile, layout)
+
+
+@app.post("/render/preview/")
+async def render_assets_preview(request: Request,
+                                background: str = Form(...),
+                                books: list = Depends(asset_books),
+                                resolution: str = Form('1920x1080'),
+                                layout: LayoutOptions = Depends(layout_options)):
+    """То же, что /upload/preview/, но по идентификаторам из /assets.
+
+    Страница загружает изображения через /assets один раз и по их
+    идентификаторам запрашивает и превью, и полноразмерную полку.
+    """
+    canvas_width, canvas_height = parse_resolution(resolution)
+    return await preview_response(request, stored_inputs([background] + books), canvas_width, canvas_height,
+                                  layout)
+
+
+def get_profile_or_404(profile_id):
+    summary = request_profiler.get(profile_id) if request_profiler is not None else None
+    if summary is None:
+        raise RenderError("Профиль не найден", status_code=404, reason="profile_not_found")
+    return summary
+
+
+@app.get("/profiles/{profile_id}")
+async def profile_summary(profile_id: str):
+    """Сводка профиля запроса: самые долгие функции и строки с наибольшими выделениями памяти."""
+    return await run_in_threadpool(get_profile_or_404, profile_id)
+
+
+@app.get("/profiles/{profile_id}/pstats")
+async def profile_stats(profile_id: str):
+    """Полный профиль cProfile для snakeviz или python -m pstats."""
+    await run_in_threadpool(get_profile_or_404, profile_id)
+    return FileResponse(request_profiler.path(profile_id, ".prof"), media_type="application/octet-stream",
+                        filename=f"{profile_id}.prof")
+
+
+@app.get("/covers/duplicates")
+async def cover_duplicates():
+    """Статистика индекса обложек: сколько обложек, сколько из них объединено с похожими."""
+    if cover_index is None:
+        raise RenderError("Индекс обложек выключен", status_code=404, reason="cover_index_disabled")
+    return await run_in_threadpool(cover_index.stats)
+
+
+@app.get("/ready")
+async def ready(request: Request):
+    """Готовность процесса для балансировщика: 200 после запуска и прогрева, 503 до и во время остановки."""
+    report = startup_report.as_dict()
+    if not startup_report.ready:
+        return error_response(request, "Сервер еще не готов", 503, "not_ready", **report)
+    return report
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Метрики процесса в текстовом формате Prometheus."""
+    return Response(metrics.expose(), media_type=Registry.CONTENT_TYPE)
+
+
+@app.api_route("/static/{name:path}", methods=["GET", "HEAD"])
+async def static_file(request: Request, name: str):
+    response = static_assets.response(request, name)
+    if response is None:
+        return JSONResponse({"error": "Файл не найден"}, status_code=404)
+    return response
+
 
 @app.get("/")
-async def read_root():
-    return FileResponse("index.html")  # Возвращаем HTML-страницу
+async def read_root(request: Request):
+    # Возвращаем HTML-страницу со ссылками на статические файлы с хешем в имени
+    return static_assets.index_response(request)
+
+
+# Все модули загружены и объекты созданы; дальше запуск продолжает lifespan
+startup_report.record("import", _import_started)
@@ -0,0 +1,199 @@
+import bisect
+import threading
+import time
+
+# Границы корзин гистограмм длительности, в секундах
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Ключ в scope запроса, под которым обработчик ошибки оставляет ее короткий код (RenderError.reason)
+ERROR_REASON_KEY = "bookshelf.error_reason"
+
+# Причина ошибки по коду ответа, если обработчик не указал ее сам
+ERROR_REASONS = {
+    400: "bad_request",
+    404: "not_found",
+    409: "not_ready",
+    413: "too_large",
+    415: "unsupported_format",
+    422: "invalid_input",
+    503: "overloaded",
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Для каждого набора меток: число наблюдений в каждой корзине (последняя - +Inf) и сумма
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(tuple(labels[name] for name in self.labelnames), ([0], 0.0))
+        return sum(counts)
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class CallbackMetric:
+    """Значение, которое считывается в момент запроса /metrics (например, из статистики кеша).
+
+    collect() возвращает число или словарь {значения меток: число}.
+    """
+
+    def __init__(self, name, documentation, collect, labelnames=(), kind="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Registry:
+    """Набор метрик процесса в текстовом формате Prometheus.
+
+    Метрики хранятся в памяти процесса: при нескольких процессах uvicorn
+    каждый отдает свои, и Prometheus суммирует их по экземплярам.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """Считает запросы, ошибки, длительность и байты запросов и ответов.
+
+    Путь в метках - шаблон маршрута (/jobs/{job_id}), а не сам URL, чтобы
+    число рядов не росло с числом задач.
+    """
+
+    def __init__(self, app, requests, errors, duration, bytes_in, bytes_out):
+        self.app = app
+        self.requests = requests
+        self.errors = errors
+        self.duration = duration
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500
+        received = sent = 0
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal status_code, sent
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", None) or ("/static" if scope["path"].startswith("/static/") else "other")
+            self.requests.inc(path=path, method=scope["method"], status=str(status_code))
+            if status_code >= 400:
+                reason = scope.get(ERROR_REASON_KEY) or ERROR_REASONS.get(status_code, "internal")
+                self.errors.inc(path=path, reason=reason)
+            self.duration.observe(time.perf_counter() - started, path=path)
+            self.bytes_in.inc(received, path=path)
+            self.bytes_out.inc(sent, path=path)
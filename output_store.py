@@ -0,0 +1,68 @@
+import os
+import threading
+import time
+from uuid import uuid4
+
+
+class OutputStore:
+    """Необязательное сохранение готовых изображений на диск.
+
+    После записи периодически запускается очистка: удаляются файлы старше
+    max_age секунд, затем самые старые файлы, пока общий объем папки
+    превышает max_bytes.
+    """
+
+    def __init__(self, directory, max_age, max_bytes, janitor_interval):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.janitor_interval = janitor_interval
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+
+    def save(self, data, suffix=".png"):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"bookshelf_{uuid4().hex}{suffix}")
+        with open(path, "wb") as f:
+            f.write(data)
+        self.maybe_cleanup()
+        return path
+
+    def maybe_cleanup(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_cleanup < self.janitor_interval:
+                return
+            self._last_cleanup = now
+        self.cleanup()
+
+    def cleanup(self):
+        """Удаляет устаревшие файлы и возвращает их количество."""
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        except FileNotFoundError:
+            return 0
+
+        files = []
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        # Сначала самые старые
+        files.sort()
+
+        removed = 0
+        deadline = time.time() - self.max_age
+        total = sum(size for _, size, _ in files)
+        for mtime, size, path in files:
+            if mtime >= deadline and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,116 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+from uuid import uuid4
+
+from errors import RenderError
+
+# Заголовок и параметр запроса, которые включают профилирование одного запроса
+PROFILE_HEADER = "X-Bookshelf-Profile"
+PROFILE_QUERY_PARAM = "debug_profile"
+
+PROFILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+class RequestProfiler:
+    """Профилирование отдельных запросов на сборку: cProfile и снимок tracemalloc.
+
+    Включается только настройкой сервиса и только для запроса с заголовком
+    X-Bookshelf-Profile: 1 или параметром ?debug_profile=1; остальные
+    запросы идут как обычно. Профилируется сборка в потоке пула (cProfile
+    видит только свой поток), tracemalloc учитывает выделения всего процесса
+    и включается лишь на время сборки, поэтому одновременно профилируется
+    один запрос.
+
+    Для каждого запуска в directory сохраняются <id>.prof (pstats, для
+    snakeviz и python -m pstats) и <id>.json с первыми top_n функциями по
+    суммарному времени и строками с наибольшим объемом выделенной памяти.
+    Хранятся последние keep запусков.
+    """
+
+    def __init__(self, directory, top_n=25, keep=50):
+        self.directory = directory
+        self.top_n = top_n
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def requested(request):
+        return (request.headers.get(PROFILE_HEADER) == "1"
+                or request.query_params.get(PROFILE_QUERY_PARAM) == "1")
+
+    def path(self, profile_id, suffix):
+        return os.path.join(self.directory, f"{profile_id}{suffix}")
+
+    def run(self, fn, *args, **kwargs):
+        """Выполняет fn под профилировщиком. Возвращает (результат fn, идентификатор профиля)."""
+        if not self._lock.acquire(blocking=False):
+            raise RenderError("Профилирование другого запроса еще не закончилось", status_code=409,
+                              reason="profile_busy")
+        try:
+            tracemalloc.start()
+            profiler = cProfile.Profile()
+            started = time.perf_counter()
+            profiler.enable()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                profiler.disable()
+                duration = time.perf_counter() - started
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            profile_id = self._save(profiler, snapshot, peak, duration)
+        finally:
+            self._lock.release()
+        return result, profile_id
+
+    def _save(self, profiler, snapshot, peak, duration):
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = uuid4().hex
+        profiler.dump_stats(self.path(profile_id, ".prof"))
+
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(self.top_n)
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        allocations = [{"line": str(stat.traceback), "size_bytes": stat.size, "count": stat.count}
+                       for stat in snapshot.statistics("lineno")[:self.top_n]]
+        summary = {
+            "id": profile_id,
+            "created": time.time(),
+            "duration_seconds": duration,
+            "peak_traced_bytes": peak,
+            "allocations": allocations,
+            "functions": output.getvalue(),
+        }
+        with open(self.path(profile_id, ".json"), "w") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        self._prune()
+        return profile_id
+
+    def _prune(self):
+        summaries = sorted((entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")),
+                           key=lambda entry: entry.stat().st_mtime)
+        for entry in summaries[:max(0, len(summaries) - self.keep)]:
+            profile_id = entry.name[:-len(".json")]
+            for suffix in (".json", ".prof"):
+                try:
+                    os.remove(self.path(profile_id, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, profile_id):
+        """Сводка профиля или None, если его нет."""
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        try:
+            with open(self.path(profile_id, ".json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,519 @@
+from PIL import Image, UnidentifiedImageError
+import contextlib
+import hashlib
+import io
+import threading
+import time
+
+from config import MAX_IMAGE_PIXELS
+from encoders import encode_image
+from errors import RenderError
+from layout import BOOK_HEIGHT, BOOK_WIDTH, DEFAULT_LAYOUT, compute_layout
+
+# Размер итогового изображения
+CANVAS_WIDTH = 1920
+CANVAS_HEIGHT = 1080
+
+# Поддерживаемые разрешения итогового изображения
+RESOLUTIONS = {
+    '1280x720': (1280, 720),
+    '1600x900': (1600, 900),
+    '1920x1080': (1920, 1080),
+    '2560x1440': (2560, 1440),
+}
+
+# Допустимое отклонение размера фона от выбранного разрешения
+BACKGROUND_TOLERANCE = 0.15
+
+# Допустимые соотношения сторон обложки (ширина / высота): от 1:2 до 1:1
+BOOK_MIN_RATIO = 1 / 2
+BOOK_MAX_RATIO = 1
+
+# Форматы, которые принимает сервис
+ACCEPTED_FORMATS = ("PNG", "JPEG", "WEBP")
+
+# Режимы, которые reduce() умеет уменьшать без предварительного перевода в RGBA
+REDUCIBLE_MODES = ("L", "LA", "RGB", "RGBA")
+
+# Защита от «бомб распаковки»: Pillow сам откажется открывать изображения
+# больше чем вдвое сверх лимита, а все, что больше лимита, отклоняем мы
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Версия алгоритма сборки входит в ключ кеша: ее нужно увеличивать,
+# если при тех же входных данных меняется итоговое изображение
+RENDER_VERSION = 2
+
+
+# Длительность этапов сборки, которую собирает collect_timings в текущем потоке
+_timings = threading.local()
+
+
+@contextlib.contextmanager
+def collect_timings():
+    """Собирает длительность этапов (stage) сборки в текущем потоке в словарь {этап: секунды}."""
+    timings = {}
+    _timings.current = timings
+    try:
+        yield timings
+    finally:
+        _timings.current = None
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Замеряет этап сборки. Вне collect_timings ничего не записывается."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = getattr(_timings, "current", None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - started
+
+
+def parse_resolution(resolution):
+    # Неизвестные значения приводим к разрешению по умолчанию
+    return RESOLUTIONS.get(resolution, (CANVAS_WIDTH, CANVAS_HEIGHT))
+
+
+def parse_resolutions(resolutions):
+    """Список разрешений через запятую, например '1280x720,1920x1080'. Повторы убираются."""
+    sizes = []
+    for resolution in resolutions.split(","):
+        resolution = resolution.strip()
+        if resolution not in RESOLUTIONS:
+            raise RenderError(f"Неизвестное разрешение {resolution}, доступны: {', '.join(RESOLUTIONS)}",
+                              reason="unknown_resolution")
+        if RESOLUTIONS[resolution] not in sizes:
+            sizes.append(RESOLUTIONS[resolution])
+    return sizes
+
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def render_cache_key(input_digests, canvas_width, canvas_height, profile, layout_options=DEFAULT_LAYOUT):
+    """Ключ готового изображения: хеши фона и книг по порядку плюс параметры раскладки и кодирования."""
+    key = hashlib.sha256(f"v{RENDER_VERSION}:{canvas_width}x{canvas_height}:{BOOK_WIDTH}x{BOOK_HEIGHT}:"
+                         f"{layout_options.cache_tag}:{profile.cache_tag}".encode())
+    for digest in input_digests:
+        key.update(b":" + digest.encode())
+    return key.hexdigest()
+
+
+def image_nbytes(image):
+    """Объем пикселей изображения в памяти, используется как размер записи в кеше."""
+    return image.width * image.height * len(image.getbands())
+
+
+class ImageInput:
+    """Исходное изображение: хеш содержимого и способ открыть файл для чтения.
+
+    prepared(width, height) - если задан, возвращает заранее подготовленную
+    версию нужного размера или None; так фон из /assets не декодируется заново.
+    """
+
+    def __init__(self, digest, open_file, prepared=None):
+        self.digest = digest
+        self._open_file = open_file
+        self.prepared = prepared
+
+    def open(self):
+        return self._open_file()
+
+    def with_digest(self, digest):
+        """Тот же файл под другим хешем (например, канонической обложки из индекса)."""
+        return ImageInput(digest, self._open_file, self.prepared)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(content_digest(data), lambda: io.BytesIO(data))
+
+    @classmethod
+    def from_path(cls, digest, path, prepared=None):
+        return cls(digest, lambda: open(path, "rb"), prepared)
+
+    @classmethod
+    def from_file(cls, f, digest):
+        """Уже открытый файл (например, загрузка Starlette) читается напрямую, без копии в память."""
+        def open_file():
+            f.seek(0)
+            # Файлом владеет вызывающий код, поэтому выход из with его не закрывает
+            return contextlib.nullcontext(f)
+        return cls(digest, open_file)
+
+
+def check_background_size(bg_width, bg_height, canvas_width, canvas_height):
+    # Проверка на допустимый размер с погрешностью 15%
+    width_tolerance = canvas_width * BACKGROUND_TOLERANCE
+    height_tolerance = canvas_height * BACKGROUND_TOLERANCE
+
+    if not (canvas_width - width_tolerance <= bg_width <= canvas_width + width_tolerance) or \
+       not (canvas_height - height_tolerance <= bg_height <= canvas_height + height_tolerance):
+        raise RenderError(f"Размер фона должен быть около {canvas_width}x{canvas_height} пикселей с погрешностью 15%.",
+                          reason="background_size")
+
+
+def background_key(digest, canvas_width, canvas_height):
+    return (digest, canvas_width, canvas_height)
+
+
+def derived_background_key(digest, canvas_width, canvas_height):
+    """Фон, уменьшенный из фона для большего холста в пакетной сборке.
+
+    Его размер проверен только для большего холста, поэтому он хранится
+    отдельно: попадание по background_key означает пройденную проверку.
+    """
+    return (digest, canvas_width, canvas_height, "derived")
+
+
+def book_key(digest, book_width=BOOK_WIDTH, book_height=BOOK_HEIGHT):
+    return (digest, book_width, book_height)
+
+
+def open_image(f):
+    """Читает только заголовок изображения: формат и размеры, без декодирования пикселей."""
+    try:
+        image = Image.open(f, formats=ACCEPTED_FORMATS)
+    except Image.DecompressionBombError:
+        raise RenderError("Изображение слишком большое", status_code=413, reason="image_too_large")
+    except (UnidentifiedImageError, OSError):
+        raise RenderError("Поддерживаются только изображения PNG, JPEG и WebP", status_code=415,
+                          reason="unsupported_format")
+
+    if image.width * image.height > MAX_IMAGE_PIXELS:
+        raise RenderError("Изображение слишком большое", status_code=413, reason="image_too_large")
+    return image
+
+
+def load_pixels(image):
+    try:
+        image.load()
+    except OSError:
+        raise RenderError("Файл изображения поврежден", status_code=400, reason="corrupt_image")
+    return image
+
+
+def to_rgba(image):
+    return load_pixels(image).convert("RGBA")
+
+
+def decode_for_size(image, target_width, target_height):
+    """Декодирует изображение в RGBA не крупнее, чем нужно для целевого размера.
+
+    JPEG сразу декодируется в уменьшенном масштабе (1/2, 1/4 или 1/8) через
+    draft(), остальные форматы после декодирования уменьшаются reduce() на
+    целый множитель. В обоих случаях результат не меньше целевого размера,
+    окончательное масштабирование делает resize().
+    """
+    if image.format == "JPEG":
+        image.draft(image.mode, (target_width, target_height))
+
+    factor = min(image.width // target_width, image.height // target_height)
+    if factor >= 2 and image.mode in REDUCIBLE_MODES:
+        # Уменьшаем до перевода в RGBA, чтобы не держать в памяти полноразмерную RGBA-копию
+        image = load_pixels(image).reduce(factor)
+        factor = 1
+
+    image = to_rgba(image)
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image
+
+
+def check_book_ratio(book_width, book_height):
+    if not BOOK_MIN_RATIO <= book_width / book_height <= BOOK_MAX_RATIO:
+        raise RenderError("Неподходящее соотношение сторон книги", reason="book_ratio")
+
+
+def load_background(background, canvas_width, canvas_height, tile_cache=None):
+    """Фон, приведенный к размеру холста. Попадание в кеш означает, что проверка размера уже пройдена."""
+    if background.prepared is not None:
+        # Подготовленные версии сохраняются только для подходящих разрешений
+        background_image = background.prepared(canvas_width, canvas_height)
+        if background_image is not None:
+            return background_image
+
+    key = background_key(background.digest, canvas_width, canvas_height)
+    if tile_cache is not None:
+        background_image = tile_cache.get(key)
+        if background_image is not None:
+            return background_image
+
+    with background.open() as f:
+        # Размер проверяем по заголовку, до декодирования пикселей
+        with stage("validate"):
+            background_image = open_image(f)
+            check_background_size(*background_image.size, canvas_width, canvas_height)
+        with stage("decode"):
+            background_image = decode_for_size(background_image, canvas_width, canvas_height)
+    # Фон, уже уменьшенный в браузере до размера холста, не масштабируется
+    if background_image.size != (canvas_width, canvas_height):
+        with stage("resize"):
+            background_image = background_image.resize((canvas_width, canvas_height))
+
+    if tile_cache is not None:
+        tile_cache.put(key, background_image)
+    return background_image
+
+
+def load_book(book, tile_cache=None, book_width=BOOK_WIDTH, book_height=BOOK_HEIGHT):
+    """Обложка, приведенная к размеру книги (по умолчанию стандартному)."""
+    key = book_key(book.digest, book_width, book_height)
+    if tile_cache is not None:
+        book_image = tile_cache.get(key)
+        if book_image is not None:
+            return book_image
+
+    with book.open() as f:
+        with stage("validate"):
+            book_image = open_image(f)
+            check_book_ratio(*book_image.size)
+        with stage("decode"):
+            book_image = decode_for_size(book_image, book_width, book_height)
+    # Добавляем масштабирование книги до нужного размера, если браузер не прислал обложку уже такой
+    if book_image.size != (book_width, book_height):
+        with stage("resize"):
+            book_image = book_image.resize((book_width, book_height))
+    # Прозрачность проверяем один раз, результат хранится вместе с обложкой в кеше
+    is_opaque(book_image)
+
+    if tile_cache is not None:
+        tile_cache.put(key, book_image)
+    return book_image
+
+
+def prepare_asset(source, kind, tile_cache, save_background=None):
+    """Проверяет загруженное изображение и заранее кладет его уменьшенные версии в кеш.
+
+    Обложка масштабируется до размера книги, фон - до каждого разрешения,
+    в допуск которого он попадает. Если передан save_background(digest, image),
+    версии фона сохраняются через него, а не в кеш. Возвращает описание изображения.
+    """
+    with source.open() as f:
+        image = open_image(f)
+        width, height = image.size
+
+        if kind == "background":
+            resolutions = []
+            for canvas_width, canvas_height in RESOLUTIONS.values():
+                try:
+                    check_background_size(width, height, canvas_width, canvas_height)
+                except RenderError:
+                    continue
+                resolutions.append((canvas_width, canvas_height))
+            if not resolutions:
+                raise RenderError("Размер фона не подходит ни к одному из разрешений", reason="background_size")
+        else:
+            check_book_ratio(width, height)
+            resolutions = [(BOOK_WIDTH, BOOK_HEIGHT)]
+
+        # Декодируем один раз в масштабе, достаточном для самого крупного целевого размера
+        image = decode_for_size(image, *max(resolutions))
+
+    for target_width, target_height in resolutions:
+        resized = image.resize((target_width, target_height))
+        if kind == "background" and save_background is not None:
+            save_background(source.digest, resized)
+        elif kind == "background":
+            tile_cache.put(background_key(source.digest, target_width, target_height), resized)
+        else:
+            tile_cache.put(book_key(source.digest), resized)
+    sizes = [f"{target_width}x{target_height}" for target_width, target_height in resolutions]
+
+    return {"id": source.digest, "kind": kind, "width": width, "height": height, "prepared": sizes}
+
+
+def is_opaque(image):
+    """Нет ли в изображении прозрачных пикселей. Результат запоминается в image.info."""
+    opaque = image.info.get("opaque")
+    if opaque is None:
+        opaque = image.mode != "RGBA" or image.getextrema()[3][0] == 255
+        image.info["opaque"] = opaque
+    return opaque
+
+
+def compose_shelf(background_image, books, layout):
+    """Размещает обложки (уже приведенные к размеру из layout) на копии фона.
+
+    Непрозрачные обложки копируются в холст без смешивания, обложки с
+    прозрачностью накладываются через маску, как раньше.
+    """
+    result_image = background_image.copy()
+
+    for book, position in zip(books, layout.positions):
+        if is_opaque(book):
+            result_image.paste(book, position)
+        else:
+            result_image.paste(book, position, book)
+
+    return result_image
+
+
+def load_books(books, layout, tile_cache=None):
+    """Обложки книг, уменьшенные до размера обложки в раскладке."""
+    # Проверка на наличие хотя бы одной книги
+    if not books:
+        raise RenderError("Добавьте хотя бы одну книгу", reason="no_books")
+
+    return [load_book(book, tile_cache, layout.book_width, layout.book_height)
+            for book in books]
+
+
+def render_bookshelf(background, books, canvas_width, canvas_height, tile_cache=None,
+                     layout_options=DEFAULT_LAYOUT):
+    """Собирает полку из фона и обложек (ImageInput). Выполняется в пуле потоков.
+
+    Уже уменьшенные фоны и обложки берутся из tile_cache, если он передан.
+    Закешированные изображения общие для всех потоков и не изменяются.
+    """
+    layout = compute_layout(len(books), canvas_width, canvas_height, layout_options)
+    background_image = load_background(background, canvas_width, canvas_height, tile_cache)
+    book_images = load_books(books, layout, tile_cache)
+    with stage("composite"):
+        return compose_shelf(background_image, book_images, layout)
+
+
+def encode_staged(result_image, profile):
+    with stage("encode"):
+        return encode_image(result_image, profile)
+
+
+def render_image(background, books, canvas_width, canvas_height, profile, tile_cache=None,
+                 layout_options=DEFAULT_LAYOUT):
+    """Собирает и кодирует полку. Возвращает байты файла и время этапов в секундах."""
+    with collect_timings() as timings:
+        result_image = render_bookshelf(background, books, canvas_width, canvas_height, tile_cache,
+                                        layout_options)
+        # Кодирование тоже нагружает процессор, поэтому выполняется в том же потоке
+        data = encode_staged(result_image, profile)
+    return data, timings
+
+
+def preview_tile(source, cached_image, preview_size, check_size):
+    """Уменьшенная копия для превью: из полноразмерной копии из кеша или из файла, дешевым фильтром."""
+    if cached_image is not None:
+        return cached_image.resize(preview_size, Image.BILINEAR)
+    with source.open() as f:
+        with stage("validate"):
+            image = open_image(f)
+            check_size(*image.size)
+        with stage("decode"):
+            image = decode_for_size(image, *preview_size)
+    with stage("resize"):
+        return image.resize(preview_size, Image.BILINEAR)
+
+
+def render_preview(background, books, canvas_width, canvas_height, scale, profile, tile_cache=None,
+                   layout_options=DEFAULT_LAYOUT):
+    """Та же полка на холсте в scale раз меньше: быстрое превью до полноразмерной сборки.
+
+    Раскладка считается для полного холста и уменьшается, поэтому превью
+    совпадает с итоговым изображением. Проверки входных данных те же.
+    Полноразмерные фон и обложки из tile_cache используются, если они
+    уже есть, но превью в кеш не попадает: JPEG декодируется сразу в
+    уменьшенном масштабе, остальное уменьшается reduce() и билинейным
+    фильтром. Возвращает байты файла и время этапов.
+    """
+    if not books:
+        raise RenderError("Добавьте хотя бы одну книгу", reason="no_books")
+    layout = compute_layout(len(books), canvas_width, canvas_height, layout_options)
+    preview_width, preview_height = max(1, canvas_width // scale), max(1, canvas_height // scale)
+    ratio_x, ratio_y = preview_width / canvas_width, preview_height / canvas_height
+    book_size = (max(1, round(layout.book_width * ratio_x)), max(1, round(layout.book_height * ratio_y)))
+    preview_layout = layout._replace(
+        book_width=book_size[0], book_height=book_size[1],
+        positions=[(round(x * ratio_x), round(y * ratio_y)) for x, y in layout.positions])
+
+    def cached(key):
+        return tile_cache.get(key) if tile_cache is not None else None
+
+    with collect_timings() as timings:
+        background_image = None
+        if background.prepared is not None:
+            background_image = background.prepared(canvas_width, canvas_height)
+        if background_image is None:
+            background_image = cached(background_key(background.digest, canvas_width, canvas_height))
+        background_image = preview_tile(
+            background, background_image, (preview_width, preview_height),
+            lambda width, height: check_background_size(width, height, canvas_width, canvas_height))
+        book_images = [
+            preview_tile(book, cached(book_key(book.digest, layout.book_width, layout.book_height)),
+                         book_size, check_book_ratio)
+            for book in books]
+        with stage("composite"):
+            result_image = compose_shelf(background_image, book_images, preview_layout)
+        data = encode_staged(result_image, profile)
+    return data, timings
+
+
+def check_inputs(background, books, canvas_width, canvas_height):
+    """Проверяет фон и все обложки по заголовкам, без декодирования.
+
+    Нужна там, где результат отправляется по частям: после начала ответа
+    сообщить об ошибке во входных данных кодом ответа уже нельзя.
+    """
+    with background.open() as f:
+        check_background_size(*open_image(f).size, canvas_width, canvas_height)
+    for book in books:
+        with book.open() as f:
+            check_book_ratio(*open_image(f).size)
+
+
+def load_batch_inputs(background, books, sizes, tile_cache=None, layout_options=DEFAULT_LAYOUT):
+    """Декодирует фон и обложки один раз для пакетной сборки нескольких разрешений.
+
+    Размер фона проверяется по самому большому из запрошенных разрешений,
+    меньшие получаются из него уменьшением (все разрешения 16:9). Обложки
+    загружаются в размере для самого большого холста; если на меньшем
+    холсте раскладка другая, render_resized уменьшает их из этих же обложек.
+    Возвращает также время этапов.
+    """
+    largest = max(sizes, key=lambda size: size[0] * size[1])
+    layout = compute_layout(len(books), *largest, layout_options)
+    with collect_timings() as timings:
+        background_image = load_background(background, *largest, tile_cache)
+        book_images = load_books(books, layout, tile_cache)
+    return background_image, book_images, timings
+
+
+def render_resized(background, background_image, books, book_images, canvas_width, canvas_height, profile,
+                   tile_cache=None, layout_options=DEFAULT_LAYOUT):
+    """Одна полка из пакета: фон и обложки берутся из уже декодированных."""
+    with collect_timings() as timings:
+        data = _render_resized(background, background_image, books, book_images, canvas_width, canvas_height,
+                               profile, tile_cache, layout_options)
+    return data, timings
+
+
+def _render_resized(background, background_image, books, book_images, canvas_width, canvas_height, profile,
+                    tile_cache, layout_options):
+    key = derived_background_key(background.digest, canvas_width, canvas_height)
+    if background_image.size == (canvas_width, canvas_height):
+        canvas_background = background_image
+    else:
+        canvas_background = tile_cache.get(key) if tile_cache is not None else None
+    if canvas_background is None:
+        with stage("resize"):
+            canvas_background = background_image.resize((canvas_width, canvas_height))
+        if tile_cache is not None:
+            tile_cache.put(key, canvas_background)
+
+    layout = compute_layout(len(books), canvas_width, canvas_height, layout_options)
+    book_size = (layout.book_width, layout.book_height)
+    canvas_books = []
+    for book, book_image in zip(books, book_images[:len(layout.positions)]):
+        if book_image.size != book_size:
+            key = book_key(book.digest, *book_size)
+            resized = tile_cache.get(key) if tile_cache is not None else None
+            if resized is None:
+                with stage("resize"):
+                    resized = book_image.resize(book_size)
+                if tile_cache is not None:
+                    tile_cache.put(key, resized)
+            book_image = resized
+        canvas_books.append(book_image)
+    with stage("composite"):
+        result_image = compose_shelf(canvas_background, canvas_books, layout)
+    return encode_staged(result_image, profile)
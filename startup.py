@@ -0,0 +1,97 @@
+import contextlib
+import io
+import logging
+import time
+
+from PIL import Image
+
+from encoders import make_profile
+from layout import BOOK_HEIGHT, BOOK_WIDTH
+from render import ACCEPTED_FORMATS, ImageInput, render_image
+
+logger = logging.getLogger(__name__)
+
+# Модули Pillow для форматов, которые принимает и отдает сервис
+IMAGE_PLUGINS = {"PNG": "PngImagePlugin", "JPEG": "JpegImagePlugin", "WEBP": "WebPImagePlugin"}
+
+# Профили, которыми прогревается сборка: каждый кодировщик вызывается хотя бы раз
+PREWARM_PROFILES = ("png", "jpeg", "webp")
+
+
+def restrict_image_plugins(formats=ACCEPTED_FORMATS):
+    """Загружает модули Pillow только для formats и запрещает загрузку остальных.
+
+    Без этого первый Image.open или save с незнакомым форматом импортирует
+    все модули Pillow (несколько десятков форматов). Если Pillow уже
+    загрузил все модули, ничего не меняется. Возвращает загруженные форматы.
+    """
+    for name in formats:
+        __import__(f"PIL.{IMAGE_PLUGINS[name]}")
+    # Так Pillow отмечает, что все модули загружены: init() больше ничего не импортирует.
+    # Это внутренний атрибут (проверено на Pillow 11.0.0); если его нет, остаются обычные init()
+    if hasattr(Image, "_initialized"):
+        Image._initialized = 2
+    return [name for name in formats if name in Image.OPEN]
+
+
+def synthetic_input(size, color, fmt="PNG"):
+    image = Image.new("RGB", size, color)
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt)
+    return ImageInput.from_bytes(buffer.getvalue())
+
+
+def prewarm_render(canvas_width, canvas_height):
+    """Собирает синтетическую полку каждым кодировщиком без кешей.
+
+    Проходит весь путь обычной сборки: декодирование PNG и JPEG,
+    масштабирование, наложение и кодирование, - чтобы первый настоящий
+    запрос не платил за ленивую инициализацию Pillow и библиотек сжатия.
+    """
+    background = synthetic_input((canvas_width, canvas_height), "white", "JPEG")
+    # Обложка крупнее книги, чтобы выполнилось и масштабирование
+    book = synthetic_input((BOOK_WIDTH * 2, BOOK_HEIGHT * 2), "navy")
+    for name in PREWARM_PROFILES:
+        render_image(background, [book], canvas_width, canvas_height, make_profile(name))
+
+
+class StartupReport:
+    """Длительность этапов запуска процесса в секундах, по порядку.
+
+    started - время начала запуска по time.perf_counter(), например до
+    импорта модулей, чтобы импорт тоже попал в отчет.
+    """
+
+    def __init__(self, started=None):
+        self.started = time.perf_counter() if started is None else started
+        self.phases = {}
+        self.ready_at = None
+        # Процесс принимает запросы на сборку: запуск закончен и остановка еще не началась
+        self.ready = False
+
+    def record(self, name, since):
+        self.phases[name] = time.perf_counter() - since
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started)
+
+    def mark_ready(self):
+        self.ready_at = time.perf_counter()
+        self.ready = True
+        logger.info("Запуск занял %.3f с: %s", self.total,
+                    ", ".join(f"{name} {seconds:.3f} с" for name, seconds in self.phases.items()))
+
+    def mark_stopping(self):
+        self.ready = False
+
+    @property
+    def total(self):
+        return None if self.ready_at is None else self.ready_at - self.started
+
+    def as_dict(self):
+        return {"ready": self.ready, "total_seconds": self.total, "phases": dict(self.phases)}
@@ -0,0 +1,19 @@
+// Декодирование и уменьшение изображений перед загрузкой, вне основного потока страницы.
+// Получает { id, file, width, height, type, quality }, возвращает исходный размер
+// и файл ровно width x height, который сервер уже не масштабирует.
+self.onmessage = async (event) => {
+  const { id, file, width, height, type, quality } = event.data;
+  try {
+    const bitmap = await createImageBitmap(file);
+    const canvas = new OffscreenCanvas(width, height);
+    const context = canvas.getContext('2d');
+    context.imageSmoothingEnabled = true;
+    context.imageSmoothingQuality = 'high';
+    context.drawImage(bitmap, 0, 0, width, height);
+    const blob = await canvas.convertToBlob({ type, quality });
+    self.postMessage({ id, width: bitmap.width, height: bitmap.height, blob });
+    bitmap.close();
+  } catch (error) {
+    self.postMessage({ id, error: String(error) });
+  }
+};
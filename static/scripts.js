@@ -1,6 +1,78 @@
 // В начале файла добавляем получение кнопки
 const generateBtn = document.getElementById('generate-btn');
 
+// Размер книги на полке: обложки уменьшаются до него еще в браузере
+const BOOK_WIDTH = 240;
+const BOOK_HEIGHT = 360;
+
+// Изображения уменьшаются в Web Worker через OffscreenCanvas, и на сервер уходят
+// небольшие файлы ровно нужного размера. Без поддержки Worker и OffscreenCanvas
+// отправляются исходные файлы, и уменьшает их сервер.
+const resizeWorker = (window.Worker && window.OffscreenCanvas) ? new Worker('/static/resize-worker.js') : null;
+const pendingResizes = new Map();
+let resizeRequestId = 0;
+// Уже подготовленные файлы: проверка и загрузка используют один результат
+const preparedImages = new WeakMap();
+
+if (resizeWorker) {
+  resizeWorker.onmessage = (event) => {
+    const resolve = pendingResizes.get(event.data.id);
+    pendingResizes.delete(event.data.id);
+    resolve(event.data);
+  };
+}
+
+function readImageSize(file) {
+  return new Promise((resolve) => {
+    const img = new Image();
+    const url = URL.createObjectURL(file);
+    img.onload = () => {
+      URL.revokeObjectURL(url);
+      resolve({ width: img.width, height: img.height, blob: null });
+    };
+    img.onerror = () => {
+      URL.revokeObjectURL(url);
+      resolve({ error: 'Не удалось прочитать изображение' });
+    };
+    img.src = url;
+  });
+}
+
+// Исходный размер изображения и его копия размером width x height (blob, если есть Worker)
+function prepareImage(file, width, height) {
+  const key = `${width}x${height}`;
+  const cached = preparedImages.get(file);
+  if (cached && cached.key === key) {
+    return cached.promise;
+  }
+
+  let promise;
+  if (resizeWorker) {
+    // JPEG остается JPEG, остальное сохраняем в PNG, чтобы не потерять прозрачность
+    const type = file.type === 'image/jpeg' ? 'image/jpeg' : 'image/png';
+    promise = new Promise((resolve) => {
+      const id = ++resizeRequestId;
+      pendingResizes.set(id, resolve);
+      resizeWorker.postMessage({ id, file, width, height, type, quality: 0.92 });
+    });
+  } else {
+    promise = readImageSize(file);
+  }
+  preparedImages.set(file, { key, promise });
+  return promise;
+}
+
+function selectedSize() {
+  const selectedResolution = document.querySelector('.size-btn.selected')?.textContent || '1920x1080';
+  return selectedResolution.split('x').map(Number);
+}
+
+// Имя файла для уменьшенной копии или исходное имя, если копии нет
+function uploadName(name, prepared, file) {
+  if (!prepared.blob) return file.name;
+  return `${name}.${prepared.blob.type === 'image/jpeg' ? 'jpg' : 'png'}`;
+}
+
 // Проверка размера фона
 const bgErrorMessageDiv = document.createElement('div');
 bgErrorMessageDiv.style.color = 'red';
@@ -9,40 +81,33 @@ bgErrorMessageDiv.style.marginTop = '10px';
 const bgUploadSection = document.getElementById('bg-upload-section');
 bgUploadSection.appendChild(bgErrorMessageDiv);
 
-document.getElementById('bg-upload').addEventListener('change', function () {
+document.getElementById('bg-upload').addEventListener('change', async function () {
   const file = this.files[0];
   const generateBtn = document.getElementById('generate-btn');
   
   if (file) {
-    const img = new Image();
-    const reader = new FileReader();
-
-    reader.onload = (e) => {
-      img.src = e.target.result;
-      img.onload = () => {
-        const selectedResolution = document.querySelector('.size-btn.selected')?.textContent || '1920x1080';
-        const [expectedWidth, expectedHeight] = selectedResolution.split('x').map(Number);
-
-        const widthTolerance = expectedWidth * 0.15;
-        const heightTolerance = expectedHeight * 0.15;
-
-        if (
-          img.width < expectedWidth - widthTolerance ||
-          img.width > expectedWidth + widthTolerance ||
-          img.height < expectedHeight - heightTolerance ||
-          img.height > expectedHeight + heightTolerance
-        ) {
-          bgErrorMessageDiv.textContent = `Добавьте изображение размером около ${expectedWidth}x${expectedHeight}.`;
-          generateBtn.style.backgroundColor = '#ff4444';
-          generateBtn.disabled = true;
-        } else {
-          bgErrorMessageDiv.textContent = '';
-          generateBtn.style.backgroundColor = '#4CAF50';
-          generateBtn.disabled = false;
-        }
-      };
-    };
-    reader.readAsDataURL(file);
+    const [expectedWidth, expectedHeight] = selectedSize();
+    // Фон сразу уменьшается до размера холста, проверяется исходный размер
+    const img = await prepareImage(file, expectedWidth, expectedHeight);
+
+    const widthTolerance = expectedWidth * 0.15;
+    const heightTolerance = expectedHeight * 0.15;
+
+    if (
+      img.error ||
+      img.width < expectedWidth - widthTolerance ||
+      img.width > expectedWidth + widthTolerance ||
+      img.height < expectedHeight - heightTolerance ||
+      img.height > expectedHeight + heightTolerance
+    ) {
+      bgErrorMessageDiv.textContent = `Добавьте изображение размером около ${expectedWidth}x${expectedHeight}.`;
+      generateBtn.style.backgroundColor = '#ff4444';
+      generateBtn.disabled = true;
+    } else {
+      bgErrorMessageDiv.textContent = '';
+      generateBtn.style.backgroundColor = '#4CAF50';
+      generateBtn.disabled = false;
+    }
   }
 });
 
@@ -56,27 +121,21 @@ document.getElementById('book-upload-section').appendChild(bookErrorMessageDiv);
 let bookCount = 1;
 const MAX_BOOKS = 8;
 
-function validateBookSize(file) {
-  const img = new Image();
-  const reader = new FileReader();
-  
-  reader.onload = (e) => {
-    img.src = e.target.result;
-    img.onload = () => {
-      const aspectRatio = img.width / img.height;
-      // Проверяем соотношение сторон (должно быть примерно 2:3)
-      if (Math.abs(aspectRatio - (2/3)) > 0.1) {
-        bookErrorMessageDiv.textContent = "Неподходящее соотношение сторон книги";
-        generateBtn.style.backgroundColor = '#ff4444';
-        generateBtn.disabled = true;
-        return;
-      }
-      bookErrorMessageDiv.textContent = '';
-      generateBtn.style.backgroundColor = '#4CAF50';
-      generateBtn.disabled = false;
-    };
-  };
-  reader.readAsDataURL(file);
+async function validateBookSize(file) {
+  // Обложка сразу уменьшается до размера книги, проверяется исходный размер
+  const img = await prepareImage(file, BOOK_WIDTH, BOOK_HEIGHT);
+  const aspectRatio = img.width / img.height;
+  // Проверяем соотношение сторон (должно быть примерно 2:3)
+  if (img.error || Math.abs(aspectRatio - (2/3)) > 0.1) {
+    bookErrorMessageDiv.textContent = "Неподходящее соотношение сторон книги";
+    generateBtn.style.backgroundColor = '#ff4444';
+    generateBtn.disabled = true;
+    return false;
+  }
+  bookErrorMessageDiv.textContent = '';
+  generateBtn.style.backgroundColor = '#4CAF50';
+  generateBtn.disabled = false;
+  return true;
 }
 
 document.getElementById('add-book-btn').addEventListener('click', function () {
@@ -140,48 +199,134 @@ async function validateAndUploadBooks() {
 
   if (!validImages) return;
 
-  // Создаем FormData для отправки файлов
+  // Каждое изображение загружается один раз через /assets (уменьшенная копия, если браузер ее подготовил),
+  // а превью и полноразмерная полка собираются по идентификаторам
+  const [canvasWidth, canvasHeight] = selectedSize();
   const formData = new FormData();
-  formData.append('background', bgFile);
-  
-  // Добавляем книги
-  bookFiles.forEach((input, index) => {
-    if (input.files[0]) {
-      formData.append(`book${index + 1}`, input.files[0]);
+  try {
+    const background = await prepareImage(bgFile, canvasWidth, canvasHeight);
+    const uploads = [uploadAsset(background.blob || bgFile, uploadName('background', background, bgFile),
+                                 'background')];
+    const fields = ['background'];
+    for (let index = 0; index < bookFiles.length; index++) {
+      const file = bookFiles[index].files[0];
+      if (file) {
+        const book = await prepareImage(file, BOOK_WIDTH, BOOK_HEIGHT);
+        uploads.push(uploadAsset(book.blob || file, uploadName(`book${index + 1}`, book, file), 'book'));
+        fields.push(`book${index + 1}`);
+      }
     }
-  });
+    const ids = await Promise.all(uploads);
+    fields.forEach((field, index) => formData.append(field, ids[index]));
+  } catch (error) {
+    bookErrorMessageDiv.textContent = error.message;
+    return;
+  }
 
   // Добавляем выбранное разрешение
-  const selectedResolution = document.querySelector('.size-btn.selected')?.textContent || '1920x1080';
-  formData.append('resolution', selectedResolution);
+  formData.append('resolution', `${canvasWidth}x${canvasHeight}`);
+
+  // Превью и полноразмерная полка запрашиваются одновременно: превью приходит
+  // раньше и показывается, пока собирается и скачивается итоговое изображение
+  let finished = false;
+  fetch('/render/preview/', { method: 'POST', body: formData })
+    .then(response => response.ok ? response.blob() : null)
+    .then(blob => {
+      if (blob && !finished) {
+        showShelfImage(blob, true);
+      }
+    })
+    .catch(() => {});
 
   try {
-    const response = await fetch('/upload/', {
+    const response = await fetch('/render/', {
       method: 'POST',
       body: formData
     });
 
     if (response.ok) {
-      // Создаем ссылку для скачивания
+      showServerTiming(response);
       const blob = await response.blob();
-      const url = window.URL.createObjectURL(blob);
+      finished = true;
+      // Заменяем превью готовым изображением, по этой же ссылке оно скачивается
+      const url = showShelfImage(blob, false);
       const a = document.createElement('a');
       a.href = url;
       a.download = 'bookshelf.png';
       document.body.appendChild(a);
       a.click();
-      window.URL.revokeObjectURL(url);
       document.body.removeChild(a);
     } else {
+      finished = true;
+      hideShelfImage();
       const error = await response.json();
       bookErrorMessageDiv.textContent = error.error || 'Произошла ошибка при генерации изображения';
     }
   } catch (error) {
+    finished = true;
+    hideShelfImage();
     bookErrorMessageDiv.textContent = 'Ошибка при отправке данных на сервер';
     console.error('Error:', error);
   }
 }
 
+// Загружает изображение в /assets и возвращает его идентификатор
+async function uploadAsset(blob, name, kind) {
+  const data = new FormData();
+  data.append('file', blob, name);
+  data.append('kind', kind);
+  let response;
+  try {
+    response = await fetch('/assets', { method: 'POST', body: data });
+  } catch (error) {
+    console.error('Error:', error);
+    throw new Error('Ошибка при отправке данных на сервер');
+  }
+  const result = await response.json().catch(() => ({}));
+  if (!response.ok) {
+    throw new Error(result.error || 'Произошла ошибка при загрузке изображения');
+  }
+  return result.id;
+}
+
+// Показывает полку на странице (превью размыто до прихода готового изображения), возвращает ссылку на нее
+function showShelfImage(blob, isPreview) {
+  const img = document.getElementById('shelf-preview');
+  if (img.src) {
+    URL.revokeObjectURL(img.src);
+  }
+  const url = URL.createObjectURL(blob);
+  img.src = url;
+  img.classList.toggle('loading', isPreview);
+  img.style.display = 'block';
+  return url;
+}
+
+function hideShelfImage() {
+  const img = document.getElementById('shelf-preview');
+  if (img.src) {
+    URL.revokeObjectURL(img.src);
+  }
+  img.removeAttribute('src');
+  img.style.display = 'none';
+}
+
+// Показываем время этапов сборки из заголовка Server-Timing
+function showServerTiming(response) {
+  const header = response.headers.get('Server-Timing');
+  const container = document.getElementById('download-link-container');
+  if (!header) {
+    container.textContent = '';
+    return;
+  }
+  const stages = header.split(',').map(item => {
+    const [name, ...params] = item.trim().split(';');
+    const duration = params.find(param => param.startsWith('dur='));
+    return duration ? `${name}: ${duration.slice(4)} мс` : name;
+  });
+  container.textContent = `Время сборки: ${stages.join(', ')}`;
+}
+
 document.getElementById('generate-btn').addEventListener('click', validateAndUploadBooks);
 
 document.querySelectorAll('.size-btn').forEach(button => {
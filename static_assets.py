@@ -0,0 +1,162 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from collections import namedtuple
+
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # brotli не обязателен: без него отдаются gzip и исходные файлы
+    brotli = None
+
+# Файлы с именем, содержащим хеш содержимого, не меняются: их можно хранить сколько угодно
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Страницу и файлы по исходным именам браузер хранит, но перед использованием проверяет ETag
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Сжимаются только текстовые файлы: изображения уже сжаты
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+STATIC_URL_PATTERN = re.compile(r"""(["'])/static/([^"'?#]+)\1""")
+
+
+class StaticAsset(namedtuple("StaticAsset", "body media_type etag encodings")):
+    """Содержимое файла, его ETag и заранее сжатые версии {"br": ..., "gzip": ...}."""
+
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def hashed_name(name, digest):
+    base, extension = os.path.splitext(name)
+    return f"{base}.{digest}{extension}"
+
+
+def precompress(data, media_type):
+    """Сжатые версии, которые меньше исходника, по названию кодировки."""
+    if not media_type.startswith(COMPRESSIBLE_TYPES):
+        return {}
+    encodings = {}
+    if brotli is not None:
+        encodings["br"] = brotli.compress(data, quality=11)
+    # mtime=0: одинаковый файл дает одинаковый архив на всех процессах
+    encodings["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+    return {name: body for name, body in encodings.items() if len(body) < len(data)}
+
+
+def make_asset(data, media_type):
+    return StaticAsset(data, media_type, f'"{fingerprint(data)}"', precompress(data, media_type))
+
+
+def accepted_encodings(accept_encoding):
+    """Кодировки из Accept-Encoding, кроме запрещенных через q=0."""
+    accepted = set()
+    for item in (accept_encoding or "").split(","):
+        name, *params = [part.strip() for part in item.split(";")]
+        weight = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    weight = float(param[2:])
+                except ValueError:
+                    weight = 0.0
+        if weight > 0:
+            accepted.add(name.lower())
+    return accepted
+
+
+class StaticAssets:
+    """Статические файлы с хешем содержимого в имени и заранее сжатые.
+
+    При сборке (build) каждый файл из directory получает имя вида
+    scripts.<хеш>.js, сжимается в brotli (если установлен пакет brotli) и
+    gzip, а ссылки /static/... в странице index заменяются на имена с
+    хешем. Файлы с хешем отдаются с долгим immutable-кешированием, исходные
+    имена и страница - с ETag и проверкой при каждом использовании, так что
+    после изменения файла браузер сразу получает новую версию.
+    """
+
+    def __init__(self, directory, index_path):
+        self.directory = directory
+        self.index_path = index_path
+        self.index = None
+        self._hashed = {}
+        self._names = {}
+
+    def build(self):
+        assets = {}
+        names = {}
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    data = f.read()
+                media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                asset = make_asset(data, media_type)
+                names[name] = hashed_name(name, asset.etag.strip('"'))
+                assets[names[name]] = asset
+
+        with open(self.index_path, "rb") as f:
+            html = f.read().decode("utf-8")
+        html = STATIC_URL_PATTERN.sub(
+            lambda match: f"{match.group(1)}/static/{names.get(match.group(2), match.group(2))}{match.group(1)}",
+            html)
+
+        self._hashed = assets
+        self._names = names
+        self.index = make_asset(html.encode("utf-8"), "text/html; charset=utf-8")
+
+    def ensure_built(self):
+        if self.index is None:
+            self.build()
+
+    def response(self, request, name):
+        """Ответ для /static/<name> или None, если такого файла нет."""
+        self.ensure_built()
+        asset = self._hashed.get(name)
+        if asset is not None:
+            return asset_response(request, asset, IMMUTABLE_CACHE_CONTROL)
+        hashed = self._names.get(name)
+        if hashed is not None:
+            return asset_response(request, self._hashed[hashed], REVALIDATE_CACHE_CONTROL)
+        return None
+
+    def index_response(self, request):
+        self.ensure_built()
+        return asset_response(request, self.index, REVALIDATE_CACHE_CONTROL)
+
+
+def encoded_etag(etag, encoding):
+    # Сжатая версия - другое представление, поэтому у нее свой ETag
+    return f'{etag[:-1]}-{encoding}"' if encoding else etag
+
+
+def asset_response(request, asset, cache_control):
+    encoding = None
+    accepted = accepted_encodings(request.headers.get("Accept-Encoding"))
+    for name in ("br", "gzip"):
+        if name in asset.encodings and name in accepted:
+            encoding = name
+            break
+    headers = {"ETag": encoded_etag(asset.etag, encoding), "Cache-Control": cache_control,
+               "Vary": "Accept-Encoding"}
+
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        known = {encoded_etag(asset.etag, name) for name in [None, *asset.encodings]}
+        if known & {tag.strip() for tag in if_none_match.split(",")}:
+            return Response(status_code=304, headers=headers)
+
+    body = asset.body
+    if encoding is not None:
+        body = asset.encodings[encoding]
+        headers["Content-Encoding"] = encoding
+    if request.method == "HEAD":
+        headers["Content-Length"] = str(len(body))
+        return Response(status_code=200, media_type=asset.media_type, headers=headers)
+    return Response(body, media_type=asset.media_type, headers=headers)
@@ -31,11 +31,19 @@ def test_read_root():
 
 def test_no_cache_headers():
     """Тест заголовков кэширования"""
-    response = client.get("/")
+    # Ответы API не кешируются совсем
+    response = client.get("/metrics")
     assert response.headers["Cache-Control"] == "no-cache, no-store, must-revalidate"
     assert response.headers["Pragma"] == "no-cache"
     assert response.headers["Expires"] == "0"
 
+    # Страницу браузер хранит, но проверяет по ETag
+    response = client.get("/")
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert "Pragma" not in response.headers
+    not_modified = client.get("/", headers={"If-None-Match": response.headers["ETag"]})
+    assert not_modified.status_code == 304
+
 def test_upload_success(sample_background, sample_book):
     """Тест успешной загрузки файлов"""
     files = {
@@ -166,4 +174,1133 @@ def test_widest_book_ratio(sample_background):
         "book1": ("book1.png", book, "image/png")
     }
     response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
-    assert response.status_code == 200
\ No newline at end of file
+    assert response.status_code == 200
+
+def test_upload_pool_saturated(sample_background, sample_book, monkeypatch):
+    """Тест отказа с кодом 503, когда пул рендеринга переполнен"""
+    import main
+    from worker_pool import PoolSaturated
+
+    class SaturatedPool:
+        async def run(self, fn, *args, **kwargs):
+            raise PoolSaturated()
+
+    monkeypatch.setattr(main, "render_pool", SaturatedPool())
+    main.render_cache.clear()
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+def test_render_pool_rejects_over_limit():
+    """Тест ограничения очереди пула рендеринга"""
+    import asyncio
+    import threading
+    from worker_pool import PoolSaturated, RenderPool
+
+    pool = RenderPool(max_workers=1, max_queue=0)
+    release = threading.Event()
+
+    async def scenario():
+        busy = asyncio.ensure_future(pool.run(release.wait))
+        await asyncio.sleep(0.05)
+        with pytest.raises(PoolSaturated):
+            await pool.run(lambda: None)
+        release.set()
+        await busy
+        assert await pool.run(lambda: 42) == 42
+
+    asyncio.run(scenario())
+    pool.shutdown()
+
+def test_render_pool_keeps_slot_until_thread_finishes():
+    """Тест пула: отмена ожидания не освобождает место, пока поток еще считает"""
+    import asyncio
+    import threading
+    from worker_pool import PoolSaturated, RenderPool
+
+    pool = RenderPool(max_workers=1, max_queue=0)
+    started = threading.Event()
+    release = threading.Event()
+
+    def work():
+        started.set()
+        release.wait()
+
+    async def scenario():
+        busy = asyncio.ensure_future(pool.run(work))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        busy.cancel()
+        await asyncio.sleep(0.05)
+        assert pool.pending == 1
+        with pytest.raises(PoolSaturated):
+            await pool.run(lambda: None)
+        release.set()
+        while pool.pending:
+            await asyncio.sleep(0.01)
+        assert await pool.run(lambda: 42) == 42
+
+    asyncio.run(scenario())
+    pool.shutdown()
+
+def test_render_pool_call_waits_for_slot():
+    """Тест пула: call из потока фоновой задачи ждет свободного места, а не получает отказ"""
+    import asyncio
+    import threading
+    from worker_pool import RenderPool
+
+    pool = RenderPool(max_workers=1, max_queue=0)
+    release = threading.Event()
+    results = []
+
+    async def scenario():
+        busy = asyncio.ensure_future(pool.run(release.wait))
+        await asyncio.sleep(0.05)
+        caller = threading.Thread(target=lambda: results.append(pool.call(lambda: 42)))
+        caller.start()
+        await asyncio.sleep(0.05)
+        assert results == [] and pool.pending == 1
+        release.set()
+        await busy
+        await asyncio.get_running_loop().run_in_executor(None, caller.join)
+
+    asyncio.run(scenario())
+    assert results == [42] and pool.pending == 0
+    pool.shutdown()
+
+def test_upload_does_not_write_files(sample_background, sample_book, tmp_path, monkeypatch):
+    """Тест ответа из памяти без сохранения файла на диск"""
+    monkeypatch.chdir(tmp_path)
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert response.status_code == 200
+    assert 'filename="bookshelf.png"' in response.headers["content-disposition"]
+    assert Image.open(io.BytesIO(response.content)).size == (1920, 1080)
+    assert list(tmp_path.iterdir()) == []
+
+def test_output_store_cleanup(tmp_path):
+    """Тест удаления старых файлов из папки generated"""
+    import os
+    import time
+    from output_store import OutputStore
+
+    store = OutputStore(str(tmp_path), max_age=3600, max_bytes=250, janitor_interval=0)
+    old_path = store.save(b"x" * 100)
+    os.utime(old_path, (time.time() - 7200, time.time() - 7200))
+    first = store.save(b"x" * 100)
+    os.utime(first, (time.time() - 10, time.time() - 10))
+    second = store.save(b"x" * 100)
+    store.save(b"x" * 100)
+
+    remaining = sorted(p.name for p in tmp_path.iterdir())
+    assert os.path.basename(old_path) not in remaining
+    assert os.path.basename(first) not in remaining
+    assert os.path.basename(second) in remaining
+    assert len(remaining) == 2
+
+def test_upload_etag_and_not_modified(sample_background, sample_book):
+    """Тест кеша готовых изображений: ETag и ответ 304"""
+    import main
+
+    def make_files():
+        sample_background.seek(0)
+        sample_book.seek(0)
+        return {
+            "background": ("background.png", sample_background, "image/png"),
+            "book1": ("book1.png", sample_book, "image/png")
+        }
+
+    main.render_cache.clear()
+    first = client.post("/upload/", files=make_files(), data={"resolution": "1920x1080"})
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert etag.startswith('"') and etag.endswith('"')
+    assert "no-store" not in first.headers["Cache-Control"]
+
+    hits = main.render_cache.hits
+    second = client.post("/upload/", files=make_files(), data={"resolution": "1920x1080"})
+    assert second.headers["ETag"] == etag
+    assert second.content == first.content
+    assert main.render_cache.hits == hits + 1
+
+    revalidated = client.post("/upload/", files=make_files(), data={"resolution": "1920x1080"},
+                              headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.content == b""
+
+    # "*" не заменяет проверку: неподходящий фон дает ошибку, а не 304
+    small_background = io.BytesIO()
+    Image.new('RGB', (100, 100), 'white').save(small_background, format='PNG')
+    files = make_files()
+    files["background"] = ("background.png", small_background.getvalue(), "image/png")
+    wildcard = client.post("/upload/", files=files, data={"resolution": "1920x1080"},
+                           headers={"If-None-Match": "*"})
+    assert wildcard.status_code == 422
+
+    files = make_files()
+    files["book2"] = ("book2.png", io.BytesIO(sample_book.getvalue()), "image/png")
+    other = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert other.headers["ETag"] != etag
+
+def test_tile_cache_reuses_resized_covers(sample_background, sample_book):
+    """Тест кеша уменьшенных обложек: повторная обложка не декодируется заново"""
+    import main
+
+    main.render_cache.clear()
+    main.tile_cache.clear()
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert response.status_code == 200
+    assert main.tile_cache.stats()["entries"] == 2
+
+    # Другой набор книг с той же обложкой: готового изображения в кеше нет, но обложка и фон есть
+    sample_background.seek(0)
+    sample_book.seek(0)
+    other_book = io.BytesIO()
+    Image.new('RGBA', (240, 360), 'red').save(other_book, format='PNG')
+    other_book.seek(0)
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png"),
+        "book2": ("book2.png", other_book, "image/png")
+    }
+    hits = main.tile_cache.hits
+    response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert response.status_code == 200
+    assert main.tile_cache.hits == hits + 2
+    assert main.tile_cache.stats()["entries"] == 3
+
+def test_lru_cache_respects_byte_budget():
+    """Тест вытеснения старых записей из кеша по объему"""
+    from cache import LRUCache
+
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    assert cache.get("a") == b"12345"
+    cache.put("c", b"12345")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    cache.put("huge", b"x" * 11)
+    assert "huge" not in cache
+    assert cache.stats()["bytes"] == 10
+
+def test_assets_upload_once_and_render(sample_background, sample_book, tmp_path, monkeypatch):
+    """Тест загрузки изображений один раз и сборки по идентификаторам"""
+    import main
+    from assets import AssetStore
+
+    monkeypatch.setattr(main, "asset_store", AssetStore(str(tmp_path), 3600, 1 << 30, 60))
+    main.render_cache.clear()
+
+    response = client.post("/assets", files={"file": ("background.png", sample_background, "image/png")},
+                           data={"kind": "background"})
+    assert response.status_code == 200
+    background_id = response.json()["id"]
+    assert "1920x1080" in response.json()["prepared"]
+
+    response = client.post("/assets", files={"file": ("book1.png", sample_book, "image/png")})
+    assert response.status_code == 200
+    book_id = response.json()["id"]
+
+    rendered = client.post("/render/", data={"background": background_id, "book1": book_id,
+                                             "resolution": "1920x1080"})
+    assert rendered.status_code == 200
+    assert rendered.headers["content-type"] == "image/png"
+
+    # Те же файлы через /upload/ дают тот же результат
+    sample_background.seek(0)
+    sample_book.seek(0)
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    uploaded = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert uploaded.headers["ETag"] == rendered.headers["ETag"]
+
+    # Превью по тем же идентификаторам совпадает с превью загруженных файлов
+    preview = client.post("/render/preview/", data={"background": background_id, "book1": book_id,
+                                                    "resolution": "1920x1080"})
+    assert preview.status_code == 200
+    assert preview.headers["content-type"] == "image/jpeg"
+    sample_background.seek(0)
+    sample_book.seek(0)
+    uploaded = client.post("/upload/preview/", files=files, data={"resolution": "1920x1080"})
+    assert uploaded.headers["ETag"] == preview.headers["ETag"]
+
+def test_assets_rejects_invalid_and_unknown(tmp_path, monkeypatch):
+    """Тест загрузки не изображения и сборки с неизвестным идентификатором"""
+    import main
+    from assets import AssetStore
+
+    monkeypatch.setattr(main, "asset_store", AssetStore(str(tmp_path), 3600, 1 << 30, 60))
+    response = client.post("/assets", files={"file": ("book.png", io.BytesIO(b"not an image"), "image/png")})
+    assert response.status_code == 415
+    assert list(tmp_path.iterdir()) == []
+
+    response = client.post("/render/", data={"background": "0" * 64, "book1": "../main.py"})
+    assert response.status_code == 404
+    response = client.post("/render/preview/", data={"background": "0" * 64, "book1": "0" * 64})
+    assert response.status_code == 404
+
+def test_wrong_background_size_rejected_before_decode(sample_book, monkeypatch):
+    """Тест отказа по размеру фона из заголовка, без декодирования пикселей"""
+    import main
+    import render
+
+    def fail_decode(image):
+        raise AssertionError("изображение не должно декодироваться")
+
+    monkeypatch.setattr(render, "to_rgba", fail_decode)
+    main.render_cache.clear()
+    main.tile_cache.clear()
+
+    background = io.BytesIO()
+    Image.new('RGBA', (800, 600), 'white').save(background, format='PNG')
+    background.seek(0)
+    files = {
+        "background": ("background.png", background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert response.status_code == 422
+    assert "1920x1080" in response.json()["error"]
+
+def test_wrong_book_ratio_rejected(sample_background):
+    """Тест отказа для обложки с неподходящим соотношением сторон"""
+    book = io.BytesIO()
+    Image.new('RGBA', (400, 200), 'blue').save(book, format='PNG')
+    book.seek(0)
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", book, "image/png")
+    }
+    response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert response.status_code == 422
+    assert response.json()["error"] == "Неподходящее соотношение сторон книги"
+
+def test_unsupported_format_rejected(sample_background):
+    """Тест отказа для неподдерживаемого формата файла"""
+    book = io.BytesIO()
+    Image.new('RGB', (240, 360), 'blue').save(book, format='GIF')
+    book.seek(0)
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.gif", book, "image/gif")
+    }
+    response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert response.status_code == 415
+
+def test_decompression_bomb_rejected(sample_background, sample_book, monkeypatch):
+    """Тест отказа для изображений с чрезмерным числом пикселей"""
+    import main
+    import render
+
+    monkeypatch.setattr(render, "MAX_IMAGE_PIXELS", 1000)
+    main.render_cache.clear()
+    main.tile_cache.clear()
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert response.status_code == 413
+
+def test_upload_file_size_limit(sample_background, sample_book, monkeypatch):
+    """Тест ограничения размера одного загружаемого файла"""
+    import main
+
+    monkeypatch.setattr(main, "MAX_UPLOAD_FILE_BYTES", 1024)
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert response.status_code == 413
+    assert "background.png" in response.json()["error"]
+
+def test_request_size_limit_middleware():
+    """Тест ограничения размера тела запроса по Content-Length и при потоковой передаче"""
+    from fastapi import FastAPI, Request
+    from upload_limits import RequestSizeLimitMiddleware
+
+    received = []
+    small_app = FastAPI()
+    small_app.add_middleware(RequestSizeLimitMiddleware, max_bytes=100)
+
+    @small_app.post("/echo")
+    async def echo(request: Request):
+        body = await request.body()
+        received.append(len(body))
+        return {"size": len(body)}
+
+    small_client = TestClient(small_app)
+    assert small_client.post("/echo", content=b"x" * 50).json() == {"size": 50}
+
+    response = small_client.post("/echo", content=b"x" * 500)
+    assert response.status_code == 413
+
+    def chunks():
+        for _ in range(10):
+            yield b"x" * 30
+
+    response = small_client.post("/echo", content=chunks())
+    assert response.status_code == 413
+    assert received == [50]
+
+def test_request_file_size_limit_while_streaming():
+    """Тест ограничения размера одного файла во время чтения multipart-запроса, до разбора формы"""
+    from fastapi import FastAPI, File, UploadFile
+    from upload_limits import PART_HEADERS_ALLOWANCE, MultipartPartLimit, RequestSizeLimitMiddleware, \
+        RequestTooLarge
+
+    received = []
+    small_app = FastAPI()
+    small_app.add_middleware(RequestSizeLimitMiddleware, max_bytes=10 * PART_HEADERS_ALLOWANCE, max_file_bytes=100)
+
+    @small_app.post("/upload")
+    async def upload(first: UploadFile = File(...), second: UploadFile = File(...)):
+        received.append((first.size, second.size))
+        return {}
+
+    small_client = TestClient(small_app)
+    # Два файла меньше лимита проходят, хотя вместе они больше его
+    files = {"first": ("a.bin", b"x" * 90, "application/octet-stream"),
+             "second": ("b.bin", b"y" * 90, "application/octet-stream")}
+    assert small_client.post("/upload", files=files).status_code == 200
+    # Большой файл в середине запроса отклоняется, даже если он не последний
+    files = {"first": ("a.bin", b"x" * (2 * PART_HEADERS_ALLOWANCE), "application/octet-stream"),
+             "second": ("b.bin", b"y" * 90, "application/octet-stream")}
+    assert small_client.post("/upload", files=files).status_code == 413
+    assert received == [(90, 90)]
+
+    body = (b"--limit\r\nContent-Disposition: form-data; name=\"first\"; filename=\"a.bin\"\r\n\r\n"
+            + b"x" * 90 + b"\r\n--limit\r\nContent-Disposition: form-data; name=\"second\"; "
+            + b"filename=\"b.bin\"\r\n\r\n" + b"y" * (2 * PART_HEADERS_ALLOWANCE) + b"\r\n--limit--\r\n")
+    limit = MultipartPartLimit(b"limit", 100)
+    # Маленькие блоки режут разделитель частей пополам; чтение обрывается вскоре после лимита
+    with pytest.raises(RequestTooLarge):
+        for start in range(0, len(body), 7):
+            limit.feed(body[start:start + 7])
+    assert start < PART_HEADERS_ALLOWANCE + 500
+
+def test_jpeg_cover_decoded_in_draft_mode():
+    """Тест декодирования большой JPEG-обложки в уменьшенном масштабе"""
+    from render import decode_for_size, open_image
+
+    cover = io.BytesIO()
+    Image.new('RGB', (1920, 2880), 'blue').save(cover, format='JPEG')
+    cover.seek(0)
+
+    image = decode_for_size(open_image(cover), 240, 360)
+    assert image.mode == "RGBA"
+    assert image.size == (240, 360)
+
+    cover = io.BytesIO()
+    Image.new('RGBA', (1000, 1500), 'blue').save(cover, format='PNG')
+    cover.seek(0)
+    image = decode_for_size(open_image(cover), 240, 360)
+    assert image.size == (250, 375)
+
+def test_output_formats(sample_background, sample_book):
+    """Тест выбора формата итогового изображения полем формы и заголовком Accept"""
+    cases = [
+        ({"output_format": "jpeg", "quality": "70"}, {}, "image/jpeg", "JPEG"),
+        ({"output_format": "webp"}, {}, "image/webp", "WEBP"),
+        ({"output_format": "png-fast"}, {}, "image/png", "PNG"),
+        ({"output_format": "fast"}, {}, "image/jpeg", "JPEG"),
+        ({}, {"Accept": "image/webp,image/png;q=0.8"}, "image/webp", "WEBP"),
+        ({}, {"Accept": "*/*"}, "image/png", "PNG"),
+    ]
+    etags = set()
+    for data, headers, media_type, image_format in cases:
+        sample_background.seek(0)
+        sample_book.seek(0)
+        files = {
+            "background": ("background.png", sample_background, "image/png"),
+            "book1": ("book1.png", sample_book, "image/png")
+        }
+        response = client.post("/upload/", files=files, data={"resolution": "1920x1080", **data},
+                               headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == media_type
+        assert Image.open(io.BytesIO(response.content)).format == image_format
+        etags.add(response.headers["ETag"])
+    assert len(etags) == 5
+
+def test_output_format_invalid(sample_background, sample_book):
+    """Тест неизвестного формата и недопустимого качества"""
+    for data in ({"output_format": "bmp"}, {"output_format": "jpeg", "quality": "0"}):
+        sample_background.seek(0)
+        sample_book.seek(0)
+        files = {
+            "background": ("background.png", sample_background, "image/png"),
+            "book1": ("book1.png", sample_book, "image/png")
+        }
+        response = client.post("/upload/", files=files, data=data)
+        assert response.status_code == 422
+        assert "error" in response.json()
+
+def test_encode_time_reported(sample_background, sample_book):
+    """Тест заголовка Server-Timing со временем кодирования"""
+    import main
+
+    main.render_cache.clear()
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert "encode;dur=" in response.headers["Server-Timing"]
+
+def test_upload_batch_all_resolutions(sample_book):
+    """Тест пакетной сборки полки во всех разрешениях одним запросом"""
+    import zipfile
+    import main
+
+    main.render_cache.clear()
+    background = io.BytesIO()
+    Image.new('RGBA', (2560, 1440), 'white').save(background, format='PNG')
+    background.seek(0)
+    files = {
+        "background": ("background.png", background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/batch/", files=files)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert sorted(archive.namelist()) == sorted([
+        "bookshelf_1280x720.png", "bookshelf_1600x900.png",
+        "bookshelf_1920x1080.png", "bookshelf_2560x1440.png"])
+    for name in archive.namelist():
+        size = tuple(map(int, name.split("_")[1].split(".")[0].split("x")))
+        assert Image.open(io.BytesIO(archive.read(name))).size == size
+    # Результаты пакета кешируются под своими ключами
+    assert main.render_cache.stats()["entries"] == 4
+
+    # Фон 2560x1440 не подходит для одиночной полки 1280x720, даже после пакетной сборки
+    background.seek(0)
+    sample_book.seek(0)
+    response = client.post("/upload/", files=files, data={"resolution": "1280x720"})
+    assert response.status_code == 422
+
+def test_upload_batch_unknown_resolution(sample_background, sample_book):
+    """Тест пакетной сборки с неизвестным разрешением"""
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/batch/", files=files, data={"resolutions": "1920x1080,800x600"})
+    assert response.status_code == 422
+
+def wait_for_job(job_client, job_id, timeout=10):
+    import time
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = job_client.get(f"/jobs/{job_id}").json()
+        if status["status"] in ("done", "failed"):
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f"задача {job_id} не завершилась")
+
+def test_jobs_queue_render(sample_background, sample_book, tmp_path, monkeypatch):
+    """Тест фоновой задачи сборки: постановка в очередь, опрос состояния, получение результата"""
+    import main
+    from jobs import JobQueue, JobWorkers
+
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), str(tmp_path / "jobs"))
+    monkeypatch.setattr(main, "job_queue", queue)
+    monkeypatch.setattr(main, "job_workers", JobWorkers(queue, main.run_render_job, 1, 0.01, 600, 3600))
+
+    with TestClient(main.app) as job_client:
+        files = {
+            "background": ("background.png", sample_background, "image/png"),
+            "book1": ("book1.png", sample_book, "image/png")
+        }
+        response = job_client.post("/jobs", files=files, data={"resolution": "1920x1080"})
+        assert response.status_code == 202
+        job_id = response.json()["id"]
+
+        status = wait_for_job(job_client, job_id)
+        assert status["status"] == "done"
+
+        result = job_client.get(f"/jobs/{job_id}/result")
+        assert result.status_code == 200
+        assert result.headers["content-type"] == "image/png"
+        assert Image.open(io.BytesIO(result.content)).size == (1920, 1080)
+
+        assert job_client.get("/jobs/unknown").status_code == 404
+
+def test_jobs_failed_render(sample_book, tmp_path, monkeypatch):
+    """Тест фоновой задачи с неподходящим фоном"""
+    import main
+    from jobs import JobQueue, JobWorkers
+
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), str(tmp_path / "jobs"))
+    monkeypatch.setattr(main, "job_queue", queue)
+    monkeypatch.setattr(main, "job_workers", JobWorkers(queue, main.run_render_job, 1, 0.01, 600, 3600))
+
+    background = io.BytesIO()
+    Image.new('RGBA', (800, 600), 'white').save(background, format='PNG')
+    background.seek(0)
+    with TestClient(main.app) as job_client:
+        files = {
+            "background": ("background.png", background, "image/png"),
+            "book1": ("book1.png", sample_book, "image/png")
+        }
+        job_id = job_client.post("/jobs", files=files).json()["id"]
+        status = wait_for_job(job_client, job_id)
+        assert status["status"] == "failed"
+        assert "1920x1080" in status["error"]
+        assert job_client.get(f"/jobs/{job_id}/result").status_code == 422
+
+def test_compose_shelf_opaque_and_translucent_covers():
+    """Тест наложения непрозрачных и полупрозрачных обложек на фон"""
+    from layout import compute_layout
+    from render import BOOK_HEIGHT, BOOK_WIDTH, compose_shelf
+
+    background = Image.new('RGBA', (1280, 720), (255, 255, 255, 255))
+    opaque = Image.new('RGBA', (BOOK_WIDTH, BOOK_HEIGHT), (0, 0, 255, 255))
+    translucent = Image.new('RGBA', (BOOK_WIDTH, BOOK_HEIGHT), (255, 0, 0, 128))
+    transparent = Image.new('RGBA', (BOOK_WIDTH, BOOK_HEIGHT), (0, 0, 0, 0))
+
+    result = compose_shelf(background, [opaque, translucent, transparent, opaque], compute_layout(4, 1280, 720))
+    bottom = 720 - BOOK_HEIGHT // 2
+    assert result.getpixel((1280 - BOOK_WIDTH // 2, bottom)) == (0, 0, 255, 255)
+    red = result.getpixel((1280 - BOOK_WIDTH * 3 // 2, bottom))
+    assert red[0] == 255 and 126 <= red[1] <= 128
+    assert result.getpixel((1280 - BOOK_WIDTH * 5 // 2, bottom)) == (255, 255, 255, 255)
+    assert result.getpixel((1280 - BOOK_WIDTH * 7 // 2, bottom)) == (0, 0, 255, 255)
+    # Фон не изменяется: он может лежать в кеше
+    assert background.getpixel((1280 - BOOK_WIDTH // 2, bottom)) == (255, 255, 255, 255)
+
+def test_default_layout_matches_fixed_grid():
+    """Тест раскладки по умолчанию: 8 книг в ряд справа налево, затем следующий ряд"""
+    from layout import BOOK_HEIGHT, BOOK_WIDTH, compute_layout
+
+    layout = compute_layout(10, 1920, 1080)
+    assert (layout.book_width, layout.book_height) == (BOOK_WIDTH, BOOK_HEIGHT)
+    assert (layout.columns, layout.rows) == (8, 3)
+    assert layout.positions[0] == (1920 - BOOK_WIDTH, 1080 - BOOK_HEIGHT)
+    assert layout.positions[7] == (0, 1080 - BOOK_HEIGHT)
+    assert layout.positions[8] == (1920 - BOOK_WIDTH, 1080 - 2 * BOOK_HEIGHT)
+    assert len(compute_layout(24, 1920, 1080).positions) == 24
+
+def test_auto_scale_layout_fits_all_books():
+    """Тест уменьшения обложек, чтобы поместились все книги"""
+    from layout import compute_layout, make_layout_options
+
+    options = make_layout_options(margin=10, spacing=4, auto_scale=True)
+    layout = compute_layout(200, 1920, 1080, options)
+    assert len(layout.positions) == 200
+    assert layout.book_height < 360
+    for x, y in layout.positions:
+        assert 10 <= x and x + layout.book_width <= 1910
+        assert 10 <= y and y + layout.book_height <= 1070
+
+def test_upload_many_books_with_auto_scale(sample_background, sample_book):
+    """Тест загрузки списка из более чем 8 книг с auto_scale"""
+    book_data = sample_book.getvalue()
+    files = [("background", ("background.png", sample_background, "image/png"))]
+    files += [("books", (f"book{index}.png", book_data, "image/png")) for index in range(30)]
+    response = client.post("/upload/", files=files, data={"auto_scale": "true", "spacing": "2"})
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.content)).size == (1920, 1080)
+
+def test_books_that_do_not_fit_rejected(sample_background, sample_book):
+    """Тест книг, которые не помещаются на холст без auto_scale: ошибка вместо полки с частью книг"""
+    from layout import compute_layout
+    from render import RenderError
+
+    with pytest.raises(RenderError):
+        compute_layout(25, 1920, 1080)
+
+    book_data = sample_book.getvalue()
+    for count, data in ((30, {}), (1, {"margin": "5000"})):
+        sample_background.seek(0)
+        files = [("background", ("background.png", sample_background, "image/png"))]
+        files += [("books", (f"book{index}.png", book_data, "image/png")) for index in range(count)]
+        response = client.post("/upload/", files=files, data=data)
+        assert response.status_code == 422
+        assert "не помещаются" in response.json()["error"]
+
+def test_negative_layout_margin_rejected(sample_background, sample_book):
+    """Тест отрицательного отступа"""
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/", files=files, data={"margin": "-5"})
+    assert response.status_code == 422
+    assert "error" in response.json()
+
+def test_upload_pages_streams_zip(sample_background, sample_book):
+    """Тест постраничной сборки большой библиотеки в потоковый ZIP"""
+    import zipfile
+
+    book_data = sample_book.getvalue()
+    files = [("background", ("background.png", sample_background, "image/png"))]
+    files += [("books", (f"book{index}.png", book_data, "image/png")) for index in range(30)]
+    response = client.post("/upload/pages/", files=files, data={"per_page": "12"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    assert response.headers["x-page-count"] == "3"
+
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert sorted(archive.namelist()) == [f"bookshelf_page00{number}.png" for number in (1, 2, 3)]
+    for name in archive.namelist():
+        assert Image.open(io.BytesIO(archive.read(name))).size == (1920, 1080)
+
+def test_upload_pages_wait_for_busy_pool(sample_background, sample_book, monkeypatch):
+    """Тест постраничной сборки при занятом пуле: страницы ждут места, а не заменяются ошибкой"""
+    import threading
+    import zipfile
+    import main
+    from worker_pool import RenderPool
+
+    pool = RenderPool(max_workers=2, max_queue=0)
+    monkeypatch.setattr(main, "render_pool", pool)
+    main.render_cache.clear()
+    # Одно место занято чужой работой и освобождается, пока страницы уже собираются
+    release = threading.Event()
+    busy = threading.Thread(target=pool.call, args=(release.wait,))
+    busy.start()
+    threading.Timer(0.3, release.set).start()
+
+    book_data = sample_book.getvalue()
+    files = [("background", ("background.png", sample_background, "image/png"))]
+    files += [("books", (f"book{index}.png", book_data, "image/png")) for index in range(30)]
+    response = client.post("/upload/pages/", files=files, data={"per_page": "12"})
+    busy.join()
+    pool.shutdown()
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert sorted(archive.namelist()) == [f"bookshelf_page00{number}.png" for number in (1, 2, 3)]
+
+def test_upload_pages_rejects_overfull_page(sample_background, sample_book):
+    """Тест страницы, на которую не помещаются книги без auto_scale"""
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/pages/", files=files, data={"per_page": "50"})
+    assert response.status_code == 422
+    assert "auto_scale" in response.json()["error"]
+
+def test_registered_background_variants_are_memory_mapped(sample_background, sample_book, tmp_path, monkeypatch):
+    """Тест сборки с зарегистрированным фоном без его декодирования"""
+    import os
+    import main
+    import render
+    from assets import AssetStore
+
+    store = AssetStore(str(tmp_path), 3600, 1 << 30, 60)
+    monkeypatch.setattr(main, "asset_store", store)
+    main.render_cache.clear()
+
+    background_id = client.post("/assets", files={"file": ("background.png", sample_background, "image/png")},
+                                data={"kind": "background"}).json()["id"]
+    book_id = client.post("/assets", files={"file": ("book1.png", sample_book, "image/png")}).json()["id"]
+    assert os.path.getsize(store.variant_path(background_id, 1920, 1080)) == 1920 * 1080 * 4
+
+    mapped = store.load_background(background_id, 1920, 1080)
+    assert mapped.readonly and mapped.getpixel((0, 0)) == (255, 255, 255, 255)
+    assert store.load_background(background_id, 2560, 1440) is None
+
+    def fail_decode(*args):
+        raise AssertionError("фон не должен декодироваться")
+    monkeypatch.setattr(render, "decode_for_size", fail_decode)
+    rendered = client.post("/render/", data={"background": background_id, "book1": book_id})
+    assert rendered.status_code == 200
+    result = Image.open(io.BytesIO(rendered.content))
+    assert result.getpixel((0, 0))[:3] == (255, 255, 255)
+    assert result.getpixel((1919, 1079))[:3] == (0, 0, 255)
+
+def test_mapped_backgrounds_are_bounded(tmp_path):
+    """Тест ограничения числа отображенных в память фонов: вытесненные закрывают свои файлы"""
+    import os
+    from assets import AssetStore
+
+    store = AssetStore(str(tmp_path), 3600, 1 << 30, 60, max_mapped=2)
+    for index in range(5):
+        store.save_background(f"{index:064x}", Image.new('RGBA', (16, 9), 'white'))
+    open_before = len(os.listdir("/proc/self/fd"))
+    for index in range(5):
+        assert store.load_background(f"{index:064x}", 16, 9).size == (16, 9)
+    assert len(os.listdir("/proc/self/fd")) - open_before <= 2
+    # Последний фон по-прежнему в кеше
+    assert store.load_background(f"{4:064x}", 16, 9) is store.load_background(f"{4:064x}", 16, 9)
+
+def test_asset_store_cleanup(tmp_path):
+    """Тест удаления давно не использованных изображений из /assets вместе с вариантами фона"""
+    import os
+    import time
+    from assets import AssetStore
+
+    store = AssetStore(str(tmp_path), max_age=3600, max_bytes=1500, janitor_interval=0)
+    ids = [f"{index:064x}" for index in range(4)]
+
+    def save(asset_id, age):
+        store.save(asset_id, io.BytesIO(b"x" * 100))
+        store.save_background(asset_id, Image.new('RGBA', (16, 9), 'white'))
+        mtime = time.time() - age
+        for path in (store.path(asset_id), store.variant_path(asset_id, 16, 9)):
+            os.utime(path, (mtime, mtime))
+
+    save(ids[0], 7200)
+    save(ids[1], 30)
+    # Использованное изображение становится самым новым
+    save(ids[2], 40)
+    assert store.get(ids[2]) is not None
+    assert store.load_background(ids[1], 16, 9) is not None
+    save(ids[3], 0)
+    store.cleanup()
+
+    # Старше max_age - удалено, самое давнее из остальных вытеснено по объему (по 676 байт на изображение)
+    assert store.get(ids[0]) is None and not os.path.exists(store.variant_path(ids[0], 16, 9))
+    assert store.get(ids[1]) is None and not os.path.exists(store.variant_path(ids[1], 16, 9))
+    assert store.load_background(ids[1], 16, 9) is None
+    assert store.get(ids[2]) is not None and store.get(ids[3]) is not None
+    assert os.path.exists(store.variant_path(ids[2], 16, 9))
+
+def test_metrics_and_stage_timings(sample_background, sample_book):
+    """Тест этапов сборки в Server-Timing и метрик на /metrics"""
+    import main
+
+    main.render_cache.clear()
+    main.tile_cache.clear()
+    # Обложка крупнее книги, чтобы сборка прошла и через масштабирование
+    large_book = io.BytesIO()
+    Image.new('RGBA', (300, 450), 'blue').save(large_book, format='PNG')
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", large_book.getvalue(), "image/png")
+    }
+    response = client.post("/upload/", files=files)
+    timing = response.headers["Server-Timing"]
+    for stage in ("read", "validate", "decode", "resize", "composite", "encode"):
+        assert f"{stage};dur=" in timing
+    client.post("/upload/", files={"background": ("background.png", b"not an image", "image/png"),
+                                   "book1": ("book1.png", b"", "image/png")})
+    # Разные ошибки с одним кодом 422 различаются причиной
+    sample_background.seek(0)
+    client.post("/upload/", files=files, data={"output_format": "gif"})
+    sample_background.seek(0)
+    wide_book = io.BytesIO()
+    Image.new('RGBA', (400, 300), 'blue').save(wide_book, format='PNG')
+    client.post("/upload/", files={"background": ("background.png", sample_background, "image/png"),
+                                   "book1": ("book1.png", wide_book.getvalue(), "image/png")})
+
+    metrics = client.get("/metrics")
+    assert metrics.status_code == 200
+    assert metrics.headers["content-type"].startswith("text/plain")
+    text = metrics.text
+    assert 'bookshelf_http_requests_total{path="/upload/",method="POST",status="200"}' in text
+    assert 'bookshelf_http_errors_total{path="/upload/",reason="unsupported_format"}' in text
+    assert 'bookshelf_http_errors_total{path="/upload/",reason="unknown_output_format"}' in text
+    assert 'bookshelf_http_errors_total{path="/upload/",reason="book_ratio"}' in text
+    assert 'bookshelf_stage_duration_seconds_bucket{stage="decode",le="+Inf"}' in text
+    assert 'bookshelf_cache_misses_total{cache="tile"}' in text
+    assert "bookshelf_render_pool_pending 0" in text
+    assert main.http_bytes_out.value(path="/upload/") > 0
+
+def test_request_profiling_opt_in(sample_background, sample_book, tmp_path, monkeypatch):
+    """Тест профилирования отдельного запроса по заголовку"""
+    import pstats
+    import main
+    from profiling import RequestProfiler
+
+    files = {
+        "background": ("background.png", sample_background.getvalue(), "image/png"),
+        "book1": ("book1.png", sample_book.getvalue(), "image/png")
+    }
+    # Пока профилирование выключено настройкой, заголовок ничего не меняет
+    monkeypatch.setattr(main, "request_profiler", None)
+    response = client.post("/upload/", files=files, headers={"X-Bookshelf-Profile": "1"})
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+
+    monkeypatch.setattr(main, "request_profiler", RequestProfiler(str(tmp_path), top_n=10))
+    response = client.post("/upload/", files=files)
+    assert "X-Profile-Id" not in response.headers
+
+    response = client.post("/upload/?debug_profile=1", files=files)
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+
+    summary = client.get(f"/profiles/{profile_id}").json()
+    assert "render_image" in summary["functions"]
+    assert 0 < len(summary["allocations"]) <= 10
+    stats = client.get(f"/profiles/{profile_id}/pstats")
+    assert stats.status_code == 200
+    profile_path = tmp_path / "downloaded.prof"
+    profile_path.write_bytes(stats.content)
+    assert pstats.Stats(str(profile_path)).total_calls > 0
+    assert client.get("/profiles/unknown").status_code == 404
+
+def test_static_assets_hashed_and_precompressed():
+    """Тест статических файлов с хешем в имени, долгим кешированием и сжатием"""
+    import re
+
+    page = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert page.headers["Content-Encoding"] == "gzip"
+    script_url = re.search(r'src="(/static/scripts\.[0-9a-f]{12}\.js)"', page.text).group(1)
+    assert re.search(r'href="/static/styles\.[0-9a-f]{12}\.css"', page.text)
+
+    script = client.get(script_url, headers={"Accept-Encoding": "gzip"})
+    assert script.status_code == 200
+    assert script.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert script.headers["Content-Encoding"] == "gzip"
+    assert "validateAndUploadBooks" in script.text
+
+    identity = client.get(script_url, headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in identity.headers
+    assert identity.headers["ETag"] != script.headers["ETag"]
+    assert client.get(script_url, headers={"If-None-Match": script.headers["ETag"]}).status_code == 304
+
+    # Старое имя по-прежнему работает, но с проверкой по ETag
+    assert client.get("/static/scripts.js").headers["Cache-Control"] == "no-cache"
+    assert client.get("/static/missing.js").status_code == 404
+
+def test_presized_inputs_skip_resize(sample_background, sample_book):
+    """Тест фона и обложки, уже уменьшенных в браузере: сервер их не масштабирует"""
+    import main
+
+    main.render_cache.clear()
+    main.tile_cache.clear()
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+    assert response.status_code == 200
+    assert "decode;dur=" in response.headers["Server-Timing"]
+    assert "resize;dur=" not in response.headers["Server-Timing"]
+
+def test_bulk_builder_resumes_by_content_hash(sample_background, tmp_path):
+    """Тест сборки полок из папки с обложками и повторного запуска только для новых обложек"""
+    import json
+    import os
+    from bulk import build_shelves
+
+    covers = tmp_path / "covers"
+    (covers / "nested").mkdir(parents=True)
+    for index in range(5):
+        folder = covers / "nested" if index % 2 else covers
+        Image.new('RGB', (240, 360), (index * 40, 0, 0)).save(folder / f"cover{index}.png")
+        os.utime(folder / f"cover{index}.png", (1000 + index, 1000 + index))
+    (covers / "notes.txt").write_text("не обложка")
+    Image.new('RGB', (500, 300)).save(covers / "square.png")
+    os.utime(covers / "square.png", (2000, 2000))
+    # Заголовок целый, данные обрезаны: ошибка видна только при декодировании
+    truncated = io.BytesIO()
+    Image.effect_noise((240, 360), 64).save(truncated, format='PNG')
+    (covers / "truncated.png").write_bytes(truncated.getvalue()[:len(truncated.getvalue()) // 2])
+    os.utime(covers / "truncated.png", (1500, 1500))
+    background = tmp_path / "background.png"
+    background.write_bytes(sample_background.getvalue())
+    output = tmp_path / "shelves"
+
+    stats = build_shelves(str(covers), str(background), str(output), per_shelf=2, workers=1, log=lambda _: None)
+    assert stats == {"rendered": 4, "skipped": 0, "cover_errors": 2, "shelf_errors": 0}
+    records = [json.loads(line) for line in (output / "manifest.jsonl").read_text().splitlines()]
+    assert len(records) == 4
+    books = {book["file"]: book for record in records for book in record["books"]}
+    assert books[os.path.join("nested", "cover1.png")]["width"] == 240
+    assert "error" in books["square.png"]
+    assert "error" in books["truncated.png"] and "position" not in books["truncated.png"]
+    # Полка только из неподходящих обложек не собирается, но остается в манифесте
+    assert sum(record["output"] is None for record in records) == 1
+    for record in records:
+        if record["output"] is not None:
+            assert Image.open(output / record["output"]).size == (1920, 1080)
+
+    # Повторный запуск ничего не собирает, новая обложка попадает только в последнюю полку
+    assert build_shelves(str(covers), str(background), str(output), per_shelf=2, workers=1,
+                         log=lambda _: None)["rendered"] == 0
+    Image.new('RGB', (240, 360), 'green').save(covers / "cover_new.png")
+    stats = build_shelves(str(covers), str(background), str(output), per_shelf=2, workers=1, log=lambda _: None)
+    assert stats["rendered"] == 1 and stats["skipped"] == 3
+
+def test_near_duplicate_covers_share_tile(sample_background, tmp_path, monkeypatch):
+    """Тест индекса перцептивных хешей: та же обложка в другом формате и размере берет общую уменьшенную копию"""
+    import main
+    from cover_index import CoverIndex
+
+    monkeypatch.setattr(main, "cover_index", CoverIndex(str(tmp_path / "covers.idx")))
+    main.render_cache.clear()
+    main.tile_cache.clear()
+
+    cover = Image.linear_gradient('L').resize((240, 360)).convert('RGB')
+    cover.paste((200, 30, 30), (0, 0, 120, 180))
+    png_cover = io.BytesIO()
+    cover.save(png_cover, format='PNG')
+    jpeg_cover = io.BytesIO()
+    cover.resize((480, 720)).save(jpeg_cover, format='JPEG', quality=80)
+
+    for name, data, media_type in (("book.png", png_cover, "image/png"), ("book.jpg", jpeg_cover, "image/jpeg")):
+        sample_background.seek(0)
+        data.seek(0)
+        files = {"background": ("background.png", sample_background, "image/png"),
+                 "book1": (name, data, media_type)}
+        response = client.post("/upload/", files=files, data={"resolution": "1920x1080"})
+        assert response.status_code == 200
+    # Вторая загрузка - то же изображение из кеша: новых уменьшенных копий нет
+    assert main.tile_cache.stats()["entries"] == 2
+    assert main.render_cache.stats()["entries"] == 1
+
+    # Обложка другого цвета остается отдельной
+    sample_background.seek(0)
+    other_cover = io.BytesIO()
+    Image.new('RGB', (240, 360), 'green').save(other_cover, format='PNG')
+    other_cover.seek(0)
+    files = {"background": ("background.png", sample_background, "image/png"),
+             "book1": ("green.png", other_cover, "image/png")}
+    assert client.post("/upload/", files=files, data={"resolution": "1920x1080"}).status_code == 200
+    assert main.tile_cache.stats()["entries"] == 3
+
+    stats = client.get("/covers/duplicates").json()
+    assert stats["covers"] == 3
+    assert stats["duplicates"] == 1
+    assert stats["near_duplicate_hits"] == 1
+
+    # Индекс читается из файла после перезапуска
+    reloaded = CoverIndex(str(tmp_path / "covers.idx"))
+    assert reloaded.stats()["duplicates"] == 1
+    from render import ImageInput
+    jpeg_cover.seek(0)
+    source = ImageInput.from_bytes(jpeg_cover.read())
+    assert reloaded.canonical_digest(source) == main.cover_index.canonical_digest(source)
+
+def test_cover_index_disabled_skips_pool(sample_background, sample_book, monkeypatch):
+    """Тест выключенного индекса обложек: сборка не отправляет обложки в пул ради пустого шага"""
+    import main
+
+    def fail_canonical(book_inputs):
+        raise AssertionError("индекс выключен, обложки не должны проверяться")
+    monkeypatch.setattr(main, "cover_index", None)
+    monkeypatch.setattr(main, "canonical_books", fail_canonical)
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    assert client.post("/upload/", files=files).status_code == 200
+
+def test_cover_index_shared_file(tmp_path):
+    """Тест индекса обложек: два процесса дописывают один файл и не путают обложки друг друга"""
+    from cover_index import CoverIndex
+    from render import ImageInput
+
+    def cover_input(color, size=(240, 360), fmt='PNG'):
+        cover = Image.linear_gradient('L').resize(size).convert('RGB')
+        cover.paste(color, (0, 0, size[0] // 2, size[1] // 2))
+        data = io.BytesIO()
+        cover.save(data, format=fmt)
+        return ImageInput.from_bytes(data.getvalue())
+
+    path = str(tmp_path / "covers.idx")
+    first, second = CoverIndex(path), CoverIndex(path)
+    first.load()
+    second.load()
+    red, green = cover_input((200, 30, 30)), cover_input((30, 200, 30))
+    red_copy = cover_input((200, 30, 30), (480, 720), 'JPEG')
+    assert first.canonical_digest(red) == red.digest
+    assert second.canonical_digest(green) == green.digest
+    assert first.canonical_digest(red_copy) == red.digest
+
+    reloaded = CoverIndex(path)
+    assert reloaded.canonical_digest(green) == green.digest
+    assert reloaded.canonical_digest(red) == red.digest
+    assert reloaded.canonical_digest(red_copy) == red.digest
+    assert reloaded.stats()["duplicates"] == 1
+
+def test_cover_index_remembers_unindexed(tmp_path, monkeypatch):
+    """Тест индекса обложек: полупрозрачная обложка декодируется один раз, в том числе после перезапуска"""
+    import cover_index
+    from render import ImageInput
+
+    calls = []
+    image_hashes = cover_index.image_hashes
+    monkeypatch.setattr(cover_index, "image_hashes", lambda image: calls.append(1) or image_hashes(image))
+    data = io.BytesIO()
+    Image.new('RGBA', (240, 360), (200, 30, 30, 128)).save(data, format='PNG')
+    source = ImageInput.from_bytes(data.getvalue())
+
+    path = str(tmp_path / "covers.idx")
+    index = cover_index.CoverIndex(path)
+    assert index.canonical_digest(source) == source.digest
+    assert index.canonical_digest(source) == source.digest
+    reloaded = cover_index.CoverIndex(path)
+    assert reloaded.canonical_digest(source) == source.digest
+    assert len(calls) == 1
+    assert reloaded.stats()["not_indexed"] == 1 and reloaded.stats()["covers"] == 0
+
+def test_upload_preview(sample_background, sample_book):
+    """Тест превью: та же полка на уменьшенном холсте в JPEG, с теми же проверками"""
+    import main
+
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", sample_book, "image/png")
+    }
+    response = client.post("/upload/preview/", files=files, data={"resolution": "1920x1080"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    preview = Image.open(io.BytesIO(response.content))
+    assert preview.size == (1920 // main.PREVIEW_SCALE, 1080 // main.PREVIEW_SCALE)
+    # Обложка в правом нижнем углу, как на полноразмерной полке
+    red, green, blue = preview.convert("RGB").getpixel((preview.width - 5, preview.height - 5))
+    assert blue > 200 and red < 60 and green < 60
+
+    sample_background.seek(0)
+    wide_book = io.BytesIO()
+    Image.new('RGBA', (400, 300), 'blue').save(wide_book, format='PNG')
+    wide_book.seek(0)
+    files = {
+        "background": ("background.png", sample_background, "image/png"),
+        "book1": ("book1.png", wide_book, "image/png")
+    }
+    response = client.post("/upload/preview/", files=files, data={"resolution": "1920x1080"})
+    assert response.status_code == 422
+    assert "error" in response.json()
+
+def test_ready_after_startup(tmp_path, monkeypatch):
+    """Тест готовности: /ready отвечает 200 только после запуска и прогрева, с отчетом о времени запуска"""
+    import main
+    from PIL import Image
+    from jobs import JobQueue, JobWorkers
+
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), str(tmp_path / "jobs"))
+    monkeypatch.setattr(main, "job_queue", queue)
+    monkeypatch.setattr(main, "job_workers", JobWorkers(queue, main.run_render_job, 1, 0.01, 600, 3600))
+    # Запуск запрещает загрузку остальных модулей Pillow; после теста они снова доступны
+    monkeypatch.setattr(Image, "_initialized", Image._initialized)
+
+    loaded_formats = set(Image.OPEN)
+    with TestClient(app) as started_client:
+        response = started_client.get("/ready")
+        assert response.status_code == 200
+        report = response.json()
+        assert report["ready"] is True
+        assert report["total_seconds"] > 0
+        assert {"import", "plugins", "static", "jobs", "prewarm"} <= set(report["phases"])
+        # При запуске загружаются только модули принимаемых форматов
+        assert set(Image.OPEN) - loaded_formats <= {"PNG", "JPEG", "WEBP"}
+        assert {"PNG", "JPEG", "WEBP"} <= set(Image.OPEN)
+        assert 'bookshelf_startup_seconds{phase="prewarm"}' in started_client.get("/metrics").text
+
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert "error" in response.json()
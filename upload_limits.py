@@ -0,0 +1,126 @@
+import hashlib
+import re
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+# Размер блока при потоковом чтении загруженных файлов
+CHUNK_SIZE = 1024 * 1024
+
+TOO_LARGE_MESSAGE = "Слишком большой запрос"
+FILE_TOO_LARGE_MESSAGE = "Один из файлов слишком большой"
+
+# Запас на заголовки части multipart (имя поля, имя файла, тип), которые считаются вместе с файлом
+PART_HEADERS_ALLOWANCE = 16 * 1024
+
+BOUNDARY_PATTERN = re.compile(rb'boundary="?([^";]+)"?', re.IGNORECASE)
+
+
+class RequestTooLarge(HTTPException):
+    """Тело запроса превысило лимит. Ответ 413 формирует обработчик в main.py."""
+
+    def __init__(self, detail=TOO_LARGE_MESSAGE):
+        super().__init__(status_code=413, detail=detail)
+
+
+class MultipartPartLimit:
+    """Считает байты текущей части тела multipart/form-data по мере поступления.
+
+    Части разделяются строкой "\r\n--<boundary>"; разделитель может
+    прийти разрезанным на два блока, поэтому хвост предыдущего блока
+    просматривается вместе со следующим. Размер части включает ее
+    заголовки, поэтому к лимиту добавляется PART_HEADERS_ALLOWANCE.
+    """
+
+    def __init__(self, boundary, max_bytes):
+        self.delimiter = b"\r\n--" + boundary
+        self.max_bytes = max_bytes + PART_HEADERS_ALLOWANCE
+        self._tail = b""
+        self._offset = 0
+        self._part_start = 0
+
+    def feed(self, chunk):
+        data = self._tail + chunk
+        data_start = self._offset - len(self._tail)
+        index = data.find(self.delimiter)
+        while index >= 0:
+            # В одном блоке может закончиться несколько частей: проверяется каждая
+            self._check(data_start + index)
+            self._part_start = data_start + index + len(self.delimiter)
+            index = data.find(self.delimiter, index + len(self.delimiter))
+        self._offset += len(chunk)
+        self._tail = data[-(len(self.delimiter) - 1):]
+        self._check(self._offset)
+
+    def _check(self, part_end):
+        if part_end - self._part_start > self.max_bytes:
+            raise RequestTooLarge(FILE_TOO_LARGE_MESSAGE)
+
+
+class RequestSizeLimitMiddleware:
+    """Ограничивает размер тела запроса и, если задан max_file_bytes, каждого файла в нем.
+
+    Если Content-Length больше лимита, запрос отклоняется сразу, не читая
+    тело. Иначе байты считаются по мере поступления, и чтение прерывается
+    на первом блоке, который выходит за лимит, так что в память и во
+    временные файлы попадает не больше max_bytes. В multipart/form-data
+    так же считается каждая часть (MultipartPartLimit): слишком большой
+    файл обрывает чтение, не дожидаясь конца запроса.
+    """
+
+    def __init__(self, app, max_bytes, max_file_bytes=None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({"error": TOO_LARGE_MESSAGE}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        part_limit = None
+        content_type = dict(scope["headers"]).get(b"content-type", b"")
+        boundary = BOUNDARY_PATTERN.search(content_type)
+        if self.max_file_bytes is not None and content_type.startswith(b"multipart/form-data") and boundary:
+            part_limit = MultipartPartLimit(boundary.group(1), self.max_file_bytes)
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b"")
+                received += len(body)
+                if received > self.max_bytes:
+                    raise RequestTooLarge()
+                if part_limit is not None:
+                    part_limit.feed(body)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def check_upload_size(upload, max_bytes):
+    """Проверяет точный размер одного загруженного файла (Starlette считает его при разборе формы).
+
+    Во время чтения запроса файл уже ограничен RequestSizeLimitMiddleware,
+    но с запасом на заголовки части; здесь ответ называет сам файл.
+    """
+    if upload.size is not None and upload.size > max_bytes:
+        raise RequestTooLarge(f"Файл {upload.filename} слишком большой")
+
+
+def file_digest(f):
+    """SHA-256 файла, прочитанного блоками, без загрузки его целиком в память."""
+    f.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+    f.seek(0)
+    return digest.hexdigest()
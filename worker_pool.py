@@ -0,0 +1,113 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PoolSaturated(Exception):
+    """Все потоки заняты и очередь заполнена."""
+
+
+class RenderPool:
+    """Ограниченный пул потоков для тяжелой работы с Pillow.
+
+    Pillow отпускает GIL при декодировании, масштабировании и кодировании,
+    поэтому потоки загружают все ядра и не блокируют цикл событий.
+    Одновременно в пуле может быть не больше max_workers + max_queue задач,
+    остальные отклоняются исключением PoolSaturated.
+
+    Место в пуле освобождается, когда задача действительно закончилась в
+    потоке: отмена ожидающей корутины (например, клиент отключился) снимает
+    из очереди только еще не начатую задачу. Потоки создаются при первой
+    задаче и после shutdown создаются заново.
+
+    Фоновые задачи из своих потоков вызывают call, а части уже принятого
+    запроса (страницы одного архива) - run_waiting: обе не отклоняют
+    задачу, а ждут свободного места.
+    """
+
+    def __init__(self, max_workers, max_queue):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._pending = 0
+        # Корутины run_waiting, ждущие места: (цикл событий, future)
+        self._waiters = []
+
+    @property
+    def pending(self):
+        """Количество выполняемых и ожидающих задач."""
+        return self._pending
+
+    @property
+    def _full(self):
+        return self._pending >= self.max_workers + self.max_queue
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+            self._slot_freed.notify()
+            waiters, self._waiters = self._waiters, []
+        # Будим всех: место займет тот, кто успеет, остальные снова встанут в ожидание
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def _submit(self, fn, args, kwargs):
+        """Отправляет задачу в потоки; место в пуле уже занято вызывающим кодом под блокировкой."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="render")
+            executor = self._executor
+        try:
+            future = executor.submit(functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._full:
+                raise PoolSaturated()
+            self._pending += 1
+        return await asyncio.wrap_future(self._submit(fn, args, kwargs))
+
+    async def run_waiting(self, fn, *args, **kwargs):
+        """Как run, но при заполненном пуле ждет свободного места вместо PoolSaturated."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if not self._full:
+                    self._pending += 1
+                    break
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            try:
+                await waiter
+            finally:
+                with self._lock:
+                    if (loop, waiter) in self._waiters:
+                        self._waiters.remove((loop, waiter))
+        return await asyncio.wrap_future(self._submit(fn, args, kwargs))
+
+    def call(self, fn, *args, **kwargs):
+        """Выполняет fn в пуле из другого потока, дожидаясь свободного места, и возвращает результат."""
+        with self._lock:
+            while self._full:
+                self._slot_freed.wait()
+            self._pending += 1
+        return self._submit(fn, args, kwargs).result()
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
@@ -0,0 +1,37 @@
+import zipfile
+
+
+class ZipStream:
+    """ZIP-архив, который отдается клиенту частями по мере добавления файлов.
+
+    zipfile пишет в объект без seek() и tell(), поэтому размер и CRC каждого
+    файла записываются после его данных (data descriptor), и весь архив в
+    памяти не накапливается: add() и close() возвращают только новые байты.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        # Изображения уже сжаты, повторно их не сжимаем
+        self._archive = zipfile.ZipFile(self, "w", compression=zipfile.ZIP_STORED)
+
+    def write(self, data):
+        # Вызывается zipfile
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _drain(self):
+        chunk = b"".join(self._chunks)
+        self._chunks.clear()
+        return chunk
+
+    def add(self, name, data):
+        self._archive.writestr(name, data)
+        return self._drain()
+
+    def close(self):
+        """Оглавление архива; после него файлы добавлять нельзя."""
+        self._archive.close()
+        return self._drain()